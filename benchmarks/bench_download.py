@@ -0,0 +1,72 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Throughput of the segmented download engine against a single stream
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+# The local server caps every connection at --rate bytes per second, the way a CDN edge
+# limits one TCP stream, so more segments should scale until the machine itself is the limit.
+#
+#   python benchmarks/bench_download.py --size 256 --rate 16
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+import network
+import downloader
+from tqdm import tqdm
+from servers import FileServer
+
+# Function to create a progress bar that draws nothing
+def quiet_progress(total, initial=0):
+    """Function to keep tqdm output out of the timings."""
+    return tqdm(total=total, initial=initial, disable=True)
+
+# Function to download the way download_file did before the engine existed
+def baseline_download(url, destination):
+    """Function to stream url into destination over one connection, 1 KB at a time."""
+    with network.get_session().get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(destination, 'wb') as file:
+            for data in response.iter_content(1024):
+                file.write(data)
+
+# Function to time one download strategy
+def measure(name, size, function):
+    """Function to run function once and print its throughput."""
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    print(f"{name:<28} {seconds:7.2f} s  {size / seconds / 1024 / 1024:8.1f} MB/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare single-stream and segmented downloads against a local Range server.")
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    parser.add_argument("--rate", type=float, default=16, help="per-connection cap in MB/s, 0 for none")
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="segment counts to try")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    payload = os.urandom(size)
+    with FileServer({"/InstallAssistant.pkg": payload}, rate=args.rate * 1024 * 1024) as server, tempfile.TemporaryDirectory() as folder:
+        url = server.url("/InstallAssistant.pkg")
+        destination = os.path.join(folder, "InstallAssistant.pkg")
+        print(f"{args.size} MB file, {args.rate:g} MB/s per connection")
+
+        measure("baseline, 1 KB reads", size, lambda: baseline_download(url, destination))
+        measure("download_stream", size, lambda: downloader.download_stream(url, destination, quiet_progress))
+        for segments in args.segments:
+            measure(f"download_ranged x{segments}", size, lambda: downloader.download(url, destination, segments, 1024 * 1024, False, quiet_progress))
+
+if __name__ == "__main__":
+    main()
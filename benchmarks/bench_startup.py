@@ -0,0 +1,86 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Startup time of loading the source catalogs from JSON and from the index
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+# Every measurement runs in a fresh interpreter, like a new DarwinFetch run, inside a scratch
+# copy of data/. Importing sources (and requests with it) costs the same on both paths and is
+# left out of the timings. --scale repeats the offline entries (with distinct builds) to show
+# how both paths grow with the catalog.
+#
+#   python benchmarks/bench_startup.py --scale 1 10 100
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+# Loads every catalog and prints the seconds it took
+PROBE = """
+import time
+import sources
+start = time.perf_counter()
+for source_type in sources.SOURCES:
+    sources.load_sources(source_type)
+print(time.perf_counter() - start)
+"""
+
+# Function to build a scratch data/ folder with a scaled offline catalog
+def prepare(folder, scale):
+    """Function to copy the source files into folder/data, repeating the offline entries scale times."""
+    data = os.path.join(folder, "data")
+    os.makedirs(data)
+    for name in ("recovery_sources.json", "ppc_sources.json"):
+        shutil.copy(os.path.join(ROOT, "data", name), data)
+
+    with open(os.path.join(ROOT, "data", "offline_sources.json"), 'r') as file:
+        entries = json.load(file)
+    scaled = [dict(entry, build=f"{entry.get('build')}-{copy}") for copy in range(scale) for entry in entries]
+    with open(os.path.join(data, "offline_sources.json"), 'w') as file:
+        json.dump(scaled, file, indent=4)
+    return len(scaled)
+
+# Function to time loading the catalogs in new interpreters
+def measure(folder, runs):
+    """Function to return the median seconds of runs fresh loads in folder."""
+    environment = dict(os.environ, PYTHONPATH=SRC)
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE], cwd=folder, env=environment, capture_output=True, text=True, check=True)
+        timings.append(float(output.stdout))
+    return statistics.median(timings)
+
+# Function to compile the index of a scratch folder
+def compile_index(folder):
+    """Function to run sources.compile_index() in folder, as update_sources does."""
+    environment = dict(os.environ, PYTHONPATH=SRC)
+    subprocess.run([sys.executable, "-c", "import sources; sources.compile_index()"], cwd=folder, env=environment, check=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare catalog load times from JSON and from the precompiled index.")
+    parser.add_argument("--scale", type=int, nargs="+", default=[1, 10, 100], help="times the offline catalog is repeated")
+    parser.add_argument("--runs", type=int, default=7, help="fresh interpreters per measurement")
+    args = parser.parse_args()
+
+    print(f"{'offline entries':>16} {'JSON':>10} {'index':>10} {'speedup':>8}")
+    for scale in args.scale:
+        with tempfile.TemporaryDirectory() as folder:
+            count = prepare(folder, scale)
+            from_json = measure(folder, args.runs)
+            compile_index(folder)
+            from_index = measure(folder, args.runs)
+        print(f"{count:>16} {from_json * 1000:>8.1f}ms {from_index * 1000:>8.1f}ms {from_json / from_index:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Speedup of parallel chunk hashing in verify_image by thread count
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+# Builds a synthetic image with a chunklist of 10 MB chunks like Apple's, then hashes it with
+# verify_chunks at every thread count. The image is read once before timing so the page cache
+# holds it and the numbers show hashing rather than the disk.
+#
+#   python benchmarks/bench_verify.py --size 4
+
+import io
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import macrecovery
+
+# Size of the chunks in Apple's BaseSystem chunklists
+CHUNK_SIZE = 10 * 1024 * 1024  # 10 MB
+
+# Function to write a synthetic image and return its chunklist entries
+def build_image(path, size):
+    """Function to write size bytes of pseudo-random data to path, returning [(chunk size, sha256)]."""
+    block = os.urandom(CHUNK_SIZE)
+    chunks = []
+    with open(path, 'wb') as file:
+        written = 0
+        while written < size:
+            # Vary every chunk a little so no two hashes are the same
+            data = (written.to_bytes(8, 'little') + block[8:])[:size - written]
+            file.write(data)
+            chunks.append((len(data), hashlib.sha256(data).digest()))
+            written += len(data)
+    return chunks
+
+# Function to time verify_chunks with a number of threads
+def measure(path, chunks, workers):
+    """Function to return the seconds verify_chunks takes with workers threads."""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        macrecovery.verify_chunks(path, chunks, workers)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Time parallel chunk hashing of a synthetic recovery image.")
+    parser.add_argument("--size", type=float, default=4, help="image size in GB")
+    parser.add_argument("--workers", type=int, nargs="+", help="thread counts to try, defaults to powers of two up to the core count")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    workers = args.workers or sorted({1 << power for power in range(cores.bit_length())} | {cores})
+    size = int(args.size * 1024 * 1024 * 1024)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "BaseSystem.dmg")
+        chunks = build_image(path, size)
+        print(f"{size / 1024 ** 3:.1f} GB image, {len(chunks)} chunks, {cores} cores")
+        measure(path, chunks, cores)
+
+        baseline = None
+        for count in workers:
+            seconds = measure(path, chunks, count)
+            baseline = baseline or seconds
+            print(f"{count:3d} threads  {seconds:7.2f} s  {size / seconds / 1024 ** 2:8.1f} MB/s  {baseline / seconds:5.2f}x")
+
+        # A corrupted chunk has to be reported by its index, whatever the thread count
+        with open(path, 'r+b') as file:
+            file.seek(CHUNK_SIZE * (len(chunks) // 2))
+            file.write(b'\xff' * 16)
+        try:
+            measure(path, chunks, cores)
+        except RuntimeError as e:
+            print(f"Corrupted image: {e}")
+
+if __name__ == "__main__":
+    main()
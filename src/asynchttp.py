@@ -0,0 +1,351 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - asyncio HTTP/1.1 client following the shared network settings
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import ssl
+import base64
+import asyncio
+import network
+import requests
+from urllib.parse import urljoin, urlsplit, unquote
+from urllib.request import getproxies, proxy_bypass
+from requests.structures import CaseInsensitiveDict
+
+# Timeout (connect, read) in seconds when the caller does not give one
+DEFAULT_TIMEOUT = (15, 60)
+
+# Redirects followed by one GET before giving up
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# Amount of body data read per iteration
+BLOCK_SIZE = 1024 * 1024  # 1 MB
+
+class HttpError(RuntimeError):
+    """Raised when an asyncio HTTP request fails."""
+
+class HttpTimeout(HttpError):
+    """Raised when a server does not answer within the connect or read timeout."""
+
+class HttpNetworkError(HttpError):
+    """Raised when a request fails below HTTP, e.g. a refused or reset connection or a malformed response."""
+
+class HttpStatusError(HttpError):
+    """Raised when the final response of a request has an error status."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+# Function to await a socket operation within a timeout
+async def guard(awaitable, timeout, url):
+    """Function to await a connection step, turning timeouts and socket errors into HttpError subclasses."""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError as e:
+        raise HttpTimeout(f"{url} did not answer within {timeout} seconds") from e
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+        raise HttpNetworkError(f"\"{e}\" when connecting to {url}") from e
+
+# Function to read the status line and headers of a response or a proxy's CONNECT answer
+async def read_head(reader, timeout, url):
+    """Function to return (status, reason, headers), raising HttpNetworkError when they are malformed."""
+    status_line = await guard(reader.readline(), timeout, url)
+    if not status_line:
+        raise HttpNetworkError(f"Connection to {url} closed before the response")
+    try:
+        fields = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        status = int(fields[1])
+    except (ValueError, IndexError) as e:
+        raise HttpNetworkError(f"Malformed response from {url}") from e
+    reason = fields[2] if len(fields) > 2 else ""
+
+    headers = CaseInsensitiveDict()
+    while True:
+        line = await guard(reader.readline(), timeout, url)
+        if line in (b"\r\n", b"\n", b""):
+            return status, reason, headers
+        name, _, value = line.decode("latin-1").partition(":")
+        name, value = name.strip(), value.strip()
+        # Repeated headers are joined like requests does
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+
+class Connection:
+    """Keep-alive HTTP/1.1 connection of the client's pool."""
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    def close(self):
+        self.writer.close()
+
+class Response:
+    """HTTP/1.1 response whose body is read from its connection as it is awaited."""
+
+    def __init__(self, client, connection, url, method, status, reason, headers):
+        self.client = client
+        self.connection = connection
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+        length = headers.get("Content-Length")
+        self.remaining = None if self.chunked or length is None else int(length)
+        self.chunk_left = 0
+        if method == "HEAD" or status in (204, 304):
+            self.chunked, self.remaining = False, 0
+        # Without a length or chunking the body ends with the connection
+        self.reusable = headers.get("Connection", "").lower() != "close" and (self.chunked or self.remaining is not None)
+        self.done = self.remaining == 0
+
+    async def read(self, size=BLOCK_SIZE):
+        """Function to return up to size bytes of the body, b'' once it is complete."""
+        if self.done:
+            return b''
+        reader = self.connection.reader
+        timeout = self.client.timeout[1]
+
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await guard(reader.readline(), timeout, self.url)
+                try:
+                    self.chunk_left = int(line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise HttpNetworkError(f"Malformed chunked response from {self.url}")
+                if self.chunk_left == 0:
+                    # Skip the trailers up to the closing empty line
+                    while (await guard(reader.readline(), timeout, self.url)).strip():
+                        pass
+                    self.done = True
+                    return b''
+            data = await guard(reader.read(min(size, self.chunk_left)), timeout, self.url)
+            if not data:
+                raise HttpNetworkError(f"Connection to {self.url} closed mid-chunk")
+            self.chunk_left -= len(data)
+            if self.chunk_left == 0:
+                await guard(reader.readexactly(2), timeout, self.url)
+            return data
+
+        if self.remaining is None:
+            data = await guard(reader.read(size), timeout, self.url)
+            self.done = not data
+            return data
+
+        data = await guard(reader.read(min(size, self.remaining)), timeout, self.url)
+        if not data:
+            raise HttpNetworkError(f"Connection to {self.url} closed with {self.remaining} bytes missing")
+        self.remaining -= len(data)
+        self.done = self.remaining == 0
+        return data
+
+    async def content(self):
+        """Function to read the whole body."""
+        parts = []
+        while True:
+            data = await self.read()
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+    def close(self):
+        """Function to hand the connection back to the pool, or close it when the body was not read to the end."""
+        if self.connection is None:
+            return
+        if self.done and self.reusable:
+            self.client.release(self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+
+class AsyncHttpClient:
+    """Keep-alive HTTP/1.1 client on non-blocking asyncio streams, for code that runs many requests on one event loop.
+
+    It follows the settings of the requests session in network.py: pool_maxsize idle connections per
+    host, retries with exponential backoff on connection errors and RETRY_STATUSES, the CA bundle,
+    and the HTTP(S)_PROXY and NO_PROXY environment variables. Every failure is an HttpError.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        options = network.options()
+        self.timeout = timeout
+        self.pool_maxsize = options["pool_maxsize"]
+        self.retries = options["retries"]
+        self.backoff_factor = options["backoff_factor"]
+        self.proxies = getproxies()
+        self.idle = {}
+        self.context = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Function to close the idle connections of the pool."""
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle.clear()
+
+    def release(self, connection):
+        """Function to keep a finished connection for the next request to its host."""
+        connection.reused = True
+        connections = self.idle.setdefault(connection.key, [])
+        if len(connections) < self.pool_maxsize:
+            connections.append(connection)
+        else:
+            connection.close()
+
+    def ssl_context(self):
+        """Function to return the TLS settings, with the same CA bundle as the requests session."""
+        if self.context is None:
+            self.context = ssl.create_default_context(cafile=requests.certs.where())
+        return self.context
+
+    def proxy_for(self, parts):
+        """Function to return the split URL of the proxy a request goes through, None to connect directly."""
+        proxy = self.proxies.get(parts.scheme)
+        if not proxy or proxy_bypass(parts.hostname):
+            return None
+        proxy = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+        if proxy.scheme != "http" or not proxy.hostname:
+            raise HttpNetworkError(f"Unsupported proxy {proxy.geturl()} for {parts.geturl()}")
+        return proxy
+
+    @staticmethod
+    def proxy_headers(proxy):
+        """Function to return the Proxy-Authorization header for a proxy URL with credentials."""
+        if proxy.username is None:
+            return {}
+        credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}".encode("utf-8")
+        return {"Proxy-Authorization": "Basic " + base64.b64encode(credentials).decode("ascii")}
+
+    async def connect(self, key, parts, proxy, url):
+        """Function to return an idle connection for key, or open a new one, tunnelling HTTPS through the proxy."""
+        connections = self.idle.get(key, [])
+        while connections:
+            connection = connections.pop()
+            if not connection.reader.at_eof():
+                return connection
+            connection.close()
+
+        _, host, port, _ = key
+        context = self.ssl_context() if parts.scheme == "https" else None
+        if proxy is None:
+            reader, writer = await guard(asyncio.open_connection(host, port, ssl=context), self.timeout[0], url)
+            return Connection(key, reader, writer)
+
+        reader, writer = await guard(asyncio.open_connection(proxy.hostname, proxy.port or 80), self.timeout[0], url)
+        connection = Connection(key, reader, writer)
+        if context is None:
+            return connection
+        try:
+            lines = [f"CONNECT {host}:{port} HTTP/1.1", f"Host: {host}:{port}"]
+            lines += [f"{name}: {value}" for name, value in self.proxy_headers(proxy).items()]
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            await guard(writer.drain(), self.timeout[1], url)
+            status, reason, _ = await read_head(reader, self.timeout[1], url)
+            if status != 200:
+                raise HttpNetworkError(f"Proxy refused the tunnel to {host}:{port} with \"{status} {reason}\"")
+            await guard(writer.start_tls(context, server_hostname=host), self.timeout[0], url)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    async def exchange(self, method, url, headers, body=None):
+        """Function to send one request and read the status line and headers of its response."""
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise HttpError(f"Unsupported URL {url}")
+        proxy = self.proxy_for(parts)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port, proxy.netloc if proxy is not None else None)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        headers = dict(headers)
+        if proxy is not None and parts.scheme == "http":
+            # Plain HTTP goes to the proxy with the full URL instead of through a tunnel
+            target = url
+            headers.update(self.proxy_headers(proxy))
+
+        given = {name.lower() for name in headers}
+        lines = [f"{method} {target} HTTP/1.1"]
+        if "host" not in given:
+            lines.append(f"Host: {parts.netloc}")
+        if "accept-encoding" not in given:
+            lines.append("Accept-Encoding: identity")
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b'')
+
+        while True:
+            connection = await self.connect(key, parts, proxy, url)
+            try:
+                connection.writer.write(request)
+                await guard(connection.writer.drain(), self.timeout[1], url)
+                status, reason, response_headers = await read_head(connection.reader, self.timeout[1], url)
+            except HttpNetworkError:
+                connection.close()
+                if connection.reused:
+                    # The server dropped an idle keep-alive connection, retry on a fresh one
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            return Response(self, connection, url, method, status, reason, response_headers)
+
+    async def send(self, method, url, headers, body=None):
+        """Function to return the response to a request, following redirects of GET requests."""
+        for _ in range(MAX_REDIRECTS + 1):
+            response = await self.exchange(method, url, headers, body)
+            location = response.headers.get("Location")
+            if method != "GET" or response.status not in REDIRECT_STATUSES or not location:
+                return response
+            response.close()
+            url = urljoin(url, location)
+            # The Host header belongs to the previous URL
+            headers = {name: value for name, value in headers.items() if name.lower() != "host"}
+        raise HttpError(f"Too many redirects when connecting to {url}")
+
+    def retry_delay(self, attempt, response=None):
+        """Function to return the seconds to wait before retry number attempt, honouring Retry-After."""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        return self.backoff_factor * (2 ** attempt)
+
+    async def request(self, method, url, headers, body=None):
+        """Function to return the response to a request, retrying like the requests session and raising HttpStatusError on error statuses."""
+        attempt = 0
+        while True:
+            try:
+                response = await self.send(method, url, headers, body)
+            except (HttpTimeout, HttpNetworkError):
+                if attempt >= self.retries:
+                    raise
+                await asyncio.sleep(self.retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status in network.RETRY_STATUSES and attempt < self.retries:
+                response.close()
+                await asyncio.sleep(self.retry_delay(attempt, response))
+                attempt += 1
+                continue
+
+            if response.status >= 400:
+                response.close()
+                raise HttpStatusError(f"\"{response.status} {response.reason}\" when connecting to {url}", response.status)
+            return response
@@ -0,0 +1,285 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Content-addressed cache of downloaded packages
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import platform
+import threading
+from contextlib import contextmanager
+
+# Default cache settings, can be overridden from data/config.json
+DEFAULT_CACHE_DIR = "cache"
+DEFAULT_CACHE_MAX_SIZE = 64 * 1024 * 1024 * 1024  # 64 GB
+
+# Linux ioctl used to make a copy-on-write clone of a file (FICLONE)
+FICLONE = 0x40049409
+
+# Function to make a copy-on-write clone of a file where the filesystem supports it
+def clone_file(source, destination):
+    """Function to reflink source to destination, raising OSError when cloning is not possible."""
+    system = platform.system()
+
+    if system == "Linux":
+        import fcntl
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(destination)
+                raise
+    elif system == "Darwin":
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(source), os.fsencode(destination), 0) != 0:
+            raise OSError(ctypes.get_errno(), "clonefile failed")
+    else:
+        raise OSError("Cloning is not supported on this platform")
+
+# Function to take an exclusive lock on an open file that other processes respect
+def lock_file(file):
+    """Function to block until this process holds the lock of file, released by unlock_file or closing the file."""
+    if platform.system() == "Windows":
+        import msvcrt
+        file.seek(0)
+        # LK_LOCK gives up after 10 seconds, keep trying like flock would
+        while True:
+            try:
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+    else:
+        import fcntl
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+# Function to release a lock taken with lock_file
+def unlock_file(file):
+    """Function to let other processes take the lock of file."""
+    if platform.system() == "Windows":
+        import msvcrt
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+# Function to place a file at a destination without copying its data when possible
+def link_file(source, destination):
+    """Function to hard-link, else reflink, else copy source to destination."""
+    if os.path.exists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+
+    try:
+        clone_file(source, destination)
+        return
+    except OSError:
+        pass
+
+    shutil.copyfile(source, destination)
+
+class DownloadCache:
+    """Directory of downloaded packages keyed by content, evicted least recently used first.
+
+    The index may be shared with other processes, such as a serve proxy and a client using the same
+    cache_dir, so every change to it happens under index.lock. Hits recorded by lookup() are kept in
+    memory until flush() or the next change to the index writes them.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.objects = os.path.join(directory, "objects")
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock_path = os.path.join(directory, "index.lock")
+        self.lock = threading.Lock()
+        # Last parsed index with the signature of the file it came from
+        self.index_cache = None
+        # Keys looked up since the last write of the index, with when they were used
+        self.used = {}
+        os.makedirs(self.objects, exist_ok=True)
+
+    @staticmethod
+    def key(url, size, chunks=None):
+        """Function to return the cache key of a package, from its integrity chunks when known, else its URL and size."""
+        hash_ctx = hashlib.sha256()
+        if chunks:
+            # Same content published under different URLs shares one entry
+            for _, chunk_size, chunk_sha256 in chunks:
+                hash_ctx.update(chunk_size.to_bytes(8, 'little'))
+                hash_ctx.update(chunk_sha256)
+        else:
+            hash_ctx.update(f"{url}\n{size}".encode('utf-8'))
+        return hash_ctx.hexdigest()
+
+    def object_path(self, key):
+        """Function to return the path of a cache object."""
+        return os.path.join(self.objects, key)
+
+    @contextmanager
+    def locked(self):
+        """Function to hold the index against the other threads and processes using the cache."""
+        with self.lock, open(self.lock_path, 'a+b') as lock:
+            lock_file(lock)
+            try:
+                yield
+            finally:
+                unlock_file(lock)
+
+    def index_signature(self):
+        """Function to return what tells index.json apart from the copy parsed last, None when it is missing."""
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load_index(self):
+        """Function to read the cache index, parsing it again only when it changed, empty when it is missing or unreadable."""
+        signature = self.index_signature()
+        if self.index_cache is not None and self.index_cache[0] == signature:
+            return self.index_cache[1]
+        try:
+            with open(self.index_path, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            index = {}
+        self.index_cache = (signature, index)
+        return index
+
+    def merge_used(self, index):
+        """Function to move the hits lookup() kept in memory into index."""
+        for key, last_used in self.used.items():
+            if key in index:
+                index[key]["last_used"] = max(index[key].get("last_used", 0), last_used)
+        self.used = {}
+
+    def save_index(self, index):
+        """Function to atomically write the cache index together with the hits lookup() kept in memory."""
+        self.merge_used(index)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(index, file, indent=4)
+        os.replace(temp_path, self.index_path)
+        self.index_cache = (self.index_signature(), index)
+
+    def flush(self):
+        """Function to write the hits recorded by lookup() to the index."""
+        with self.locked():
+            if self.used:
+                self.save_index(self.load_index())
+
+    def entry(self, key):
+        """Function to return a copy of the index entry of key, None when it is not cached."""
+        with self.lock:
+            entry = self.load_index().get(key)
+            return dict(entry) if entry is not None else None
+
+    def fetch(self, key, destination, size=None):
+        """Function to link a cached package to destination, returning False on a cache miss."""
+        with self.locked():
+            index = self.load_index()
+            entry = index.get(key)
+            path = self.object_path(key)
+
+            if entry is None or not os.path.exists(path) or (size and os.path.getsize(path) != size):
+                if entry is not None:
+                    index.pop(key)
+                    self.save_index(index)
+                return False
+
+            link_file(path, destination)
+            entry["last_used"] = time.time()
+            self.save_index(index)
+            return True
+
+    def lookup(self, key):
+        """Function to return the path of a cached object and mark it as used, or None on a cache miss.
+
+        Called for every request the proxy serves, so it only rereads the index when another process
+        changed it and leaves writing the hit to flush().
+        """
+        with self.lock:
+            entry = self.load_index().get(key)
+            path = self.object_path(key)
+
+            if entry is None or not os.path.exists(path):
+                return None
+
+            self.used[key] = time.time()
+            return path
+
+    def discard_urls(self, urls):
+        """Function to drop the entries stored for any of urls, returning how many were dropped."""
+        with self.locked():
+            index = self.load_index()
+            stale = [key for key, entry in index.items() if entry.get("url") in urls]
+            for key in stale:
+                del index[key]
+                try:
+                    os.remove(self.object_path(key))
+                except FileNotFoundError:
+                    pass
+            if stale:
+                self.save_index(index)
+            return len(stale)
+
+    def discard(self, key):
+        """Function to drop one entry and its object, for a file that changed upstream."""
+        with self.locked():
+            index = self.load_index()
+            self.used.pop(key, None)
+            if index.pop(key, None) is not None:
+                self.save_index(index)
+            try:
+                os.remove(self.object_path(key))
+            except FileNotFoundError:
+                pass
+
+    def store(self, key, source, url=None, validator=None):
+        """Function to add a finished download to the cache and evict old entries above the size cap.
+
+        validator is the ETag or Last-Modified the file was sent with, so the proxy can revalidate it.
+        """
+        size = os.path.getsize(source)
+        if size > self.max_size:
+            return
+
+        with self.locked():
+            link_file(source, self.object_path(key))
+            index = self.load_index()
+            index[key] = {"url": url, "size": size, "last_used": time.time(), "validator": validator}
+            # Pending hits count for the eviction order
+            self.merge_used(index)
+            self.evict(index, keep=key)
+            self.save_index(index)
+
+    def evict(self, index, keep=None):
+        """Function to drop least recently used entries until the cache fits in max_size."""
+        total = sum(entry.get("size", 0) for entry in index.values())
+
+        for key in sorted(index, key=lambda entry_key: index[entry_key].get("last_used", 0)):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= index.pop(key).get("size", 0)
+            try:
+                os.remove(self.object_path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,28 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Binary layout of chunklists and integrityDataV1 files
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import struct
+
+# Header: magic, header size, file version, chunk method, signature method, chunk count, chunk offset, signature offset
+ChunkListHeader = struct.Struct('<4sIBBBxQQQ')
+assert ChunkListHeader.size == 0x24
+
+# Entry per chunk: chunk size and its SHA-256
+Chunk = struct.Struct('<I32s')
+assert Chunk.size == 0x24
+
+# Function to place chunk entries in the file they describe
+def chunk_offsets(entries):
+    """Function to turn (size, sha256) chunk entries into [(offset, size, sha256)]."""
+    chunks = []
+    offset = 0
+    for chunk_size, chunk_sha256 in entries:
+        chunks.append((offset, chunk_size, chunk_sha256))
+        offset += chunk_size
+    return chunks
@@ -0,0 +1,485 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Download engine used for offline and PowerPC packages
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import bisect
+import itertools
+import threading
+import network
+import mirrors
+import requests
+from tqdm import tqdm
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+from journal import ResumeJournal, validator_from_headers
+from integrity import IntegrityError, IntegrityVerifier, fetch_integrity_data
+from concurrent.futures import ThreadPoolExecutor
+
+# Default tuning values, can be overridden from data/config.json
+DEFAULT_SEGMENTS = 8
+DEFAULT_MIN_SEGMENT_SIZE = 64 * 1024 * 1024  # 64 MB
+
+# Amount of data read from the socket per iteration
+BLOCK_SIZE = 1024 * 1024  # 1 MB
+
+# Number of times a single segment is retried before giving up
+SEGMENT_RETRIES = 3
+
+# Number of packages of one source that are fetched at the same time
+DEFAULT_PARALLEL_DOWNLOADS = 4
+
+# Timeout (connect, read) in seconds for every request made by the engine
+REQUEST_TIMEOUT = (15, 60)
+
+# Lock used to serialize seek + write on platforms without os.pwrite
+_seek_lock = threading.Lock()
+
+class RemoteChanged(requests.exceptions.RequestException):
+    """Raised when an If-Range request shows the remote file changed since the journal was written."""
+
+class DownloadCancelled(requests.exceptions.RequestException):
+    """Raised when a download is stopped through its cancel event."""
+
+# Function to create the default progress bar of a single download
+def default_progress(total, initial=0):
+    """Function to create a standalone tqdm bar for one file."""
+    return tqdm(total=total, initial=initial, unit='iB', unit_scale=True)
+
+class ProgressGroup:
+    """Aggregate tqdm display with one bar for the total bytes and one bar per file."""
+
+    def __init__(self, total_size):
+        self.total = tqdm(total=total_size, desc="Total", unit='iB', unit_scale=True, position=0)
+        self.lock = threading.Lock()
+        self.positions = itertools.count(1)
+
+    def factory(self, name):
+        """Function to return a progress factory for one file, placed on its own line."""
+        position = next(self.positions)
+        previous = []
+
+        def create(total, initial=0):
+            # A restarted transfer must not count its discarded bytes twice
+            if previous:
+                self.add(-previous.pop().counted)
+            bar = GroupBar(self, name, position, total, initial)
+            previous.append(bar)
+            return bar
+
+        return create
+
+    def add(self, size):
+        """Function to move the total bar by size bytes."""
+        with self.lock:
+            self.total.update(size)
+
+    def close(self):
+        """Function to close the total bar."""
+        self.total.close()
+
+class GroupBar:
+    """Per-file bar of a ProgressGroup that also feeds the total bar."""
+
+    def __init__(self, group, name, position, total, initial):
+        self.group = group
+        self.bar = tqdm(total=total, initial=initial, desc=name, unit='iB', unit_scale=True, position=position)
+        self.counted = initial
+        group.add(initial)
+
+    def update(self, size):
+        self.bar.update(size)
+        self.counted += size
+        self.group.add(size)
+
+    def close(self):
+        self.bar.close()
+
+# Function to probe a URL for its size, HTTP Range support and validator
+def probe_url(url):
+    """Function to return (size, accepts_ranges, validator) for a remote file using a HEAD request, or a streamed GET when HEAD is refused."""
+    try:
+        response = network.get_session().head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        # Some servers and CDN edges reject HEAD (405, 403), ask for the first byte instead
+        return probe_url_get(url)
+    total_size = int(response.headers.get('content-length', 0))
+    accepts_ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+    return total_size, accepts_ranges, validator_from_headers(response.headers)
+
+# Function to probe a URL with a GET request for servers that do not answer HEAD
+def probe_url_get(url):
+    """Function to return (size, accepts_ranges, validator) from the headers of a one-byte range GET, without reading the body."""
+    with network.get_session().get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        accepts_ranges = response.status_code == 206
+        if accepts_ranges:
+            # Content-Range is "bytes 0-0/123456789", or "bytes 0-0/*" when the size is unknown
+            length = response.headers.get('content-range', '/0').rsplit('/', 1)[-1]
+            total_size = int(length) if length.isdigit() else 0
+        else:
+            total_size = int(response.headers.get('content-length', 0))
+        return total_size, accepts_ranges, validator_from_headers(response.headers)
+
+# Function to split the missing parts of a file into ranges for the worker pool
+def plan_segments(gaps, segments, min_segment_size, boundaries=None):
+    """Function to split [start, stop) gaps into roughly `segments` ranges of at least min_segment_size bytes."""
+    total = sum(stop - start for start, stop in gaps)
+    target = max(1, min_segment_size, total // max(1, segments))
+    ranges = []
+
+    for start, stop in gaps:
+        count = max(1, (stop - start) // target)
+        step = (stop - start) // count
+        piece_start = start
+        for index in range(1, count):
+            piece_stop = start + index * step
+            if boundaries:
+                # Keep every integrity chunk inside a single segment so it is hashed in order
+                position = bisect.bisect_left(boundaries, piece_stop)
+                piece_stop = boundaries[position] if position < len(boundaries) else stop
+            if piece_start < piece_stop < stop:
+                ranges.append((piece_start, piece_stop))
+                piece_start = piece_stop
+        ranges.append((piece_start, stop))
+
+    return ranges
+
+# Function to reserve disk space for a file before it is written
+def preallocate(fd, size):
+    """Function to preallocate `size` bytes for an open file descriptor."""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Filesystem does not support fallocate, fall back to a sparse file
+            pass
+    os.ftruncate(fd, size)
+
+# Function to write a buffer at a given offset of an open file descriptor
+def write_at(fd, data, offset):
+    """Function to write data at offset without moving a shared file position."""
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+
+# Function to persist the journal once the data it describes is on disk
+def sync_journal(fd, journal):
+    """Function to flush the partial file and then save its journal."""
+    os.fsync(fd)
+    journal.save()
+
+# Function to check whether a transfer has to stop
+def stopped(abort, cancel=None):
+    """Function to return True when either the file's own abort or the outer cancel event is set."""
+    return abort.is_set() or (cancel is not None and cancel.is_set())
+
+# Function to read a response body as soon as data arrives
+def iter_available(response, size):
+    """Function to yield at most size bytes at a time without waiting for a full block, so a trickling mirror reaches its StallWatch."""
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:
+        # urllib3 before 2.0 only reads whole blocks
+        yield from response.iter_content(size)
+        return
+    while True:
+        # Same translation of urllib3 errors as Response.iter_content
+        try:
+            data = read1(size, decode_content=True)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        if not data:
+            return
+        yield data
+
+# Function to fetch a single byte range into an open file descriptor
+def fetch_segment(mirror_set, fd, start, stop, journal, persist, progress, progress_lock, abort, cancel=None, verifier=None):
+    """Function to download bytes [start, stop) of a file into fd, retrying from the last written byte on the next mirror."""
+    offset = start
+    attempts = 0
+
+    while offset < stop:
+        if stopped(abort, cancel):
+            return
+
+        url = mirror_set.current()
+        headers = {'Range': f'bytes={offset}-{stop - 1}'}
+        # Validators are only comparable on the mirror that sent the one in the journal
+        conditional = journal.validator is not None and mirror_set.validator(url) == journal.validator
+        if conditional:
+            headers['If-Range'] = journal.validator
+        watch = mirrors.StallWatch(url) if mirror_set.alternatives() else None
+        began = time.monotonic()
+        received_from = offset
+
+        try:
+            with network.get_session().get(url, headers=headers, stream=True, timeout=mirror_set.timeout(REQUEST_TIMEOUT)) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    if conditional:
+                        raise RemoteChanged(f"{url} changed on the server, partial data cannot be reused")
+                    raise requests.exceptions.RequestException(f"Server ignored range request for bytes {offset}-{stop - 1}")
+
+                # Waiting for full blocks would hide a trickling mirror from its StallWatch
+                blocks = response.iter_content(BLOCK_SIZE) if watch is None else iter_available(response, BLOCK_SIZE)
+                for data in blocks:
+                    if stopped(abort, cancel):
+                        return
+                    # Never write past the end of this segment
+                    data = data[:stop - offset]
+                    write_at(fd, data, offset)
+                    if verifier is not None:
+                        verifier.feed(offset, data)
+                    save_due = journal.mark(offset, offset + len(data))
+                    offset += len(data)
+                    with progress_lock:
+                        progress.update(len(data))
+                    throttled = time.monotonic()
+                    network.throttle(len(data))
+                    if save_due and persist:
+                        sync_journal(fd, journal)
+                    if offset >= stop:
+                        break
+                    if watch is not None:
+                        watch.update(len(data), time.monotonic() - throttled)
+
+            if offset < stop:
+                raise requests.exceptions.RequestException(f"Connection closed early at byte {offset} of segment {start}-{stop - 1}")
+            mirrors.stats.record(url, offset - received_from, time.monotonic() - began)
+
+        except RemoteChanged:
+            raise
+        except requests.exceptions.RequestException:
+            mirror_set.failed(url)
+            attempts += 1
+            # Every mirror gets its turn before the segment gives up
+            if attempts > SEGMENT_RETRIES + len(mirror_set.urls) - 1:
+                raise
+
+# Function to download a file over one or more concurrent HTTP range requests
+def download_ranged(mirror_set, destination, total_size, validator, segments=DEFAULT_SEGMENTS, min_segment_size=DEFAULT_MIN_SEGMENT_SIZE, resume=True, progress_factory=default_progress, cancel=None, verifier=None):
+    """Function to download the missing byte ranges of a file into destination using parallel range requests spread over its mirrors."""
+    url = mirror_set.key
+    journal = ResumeJournal.load(destination, url) if resume else None
+    # The journal may come from a different mirror than the fastest one today
+    matches = journal is not None and any(journal.matches(total_size, mirror_validator) for mirror_validator in [validator] + list(mirror_set.validators.values()))
+    fresh = not (matches and os.path.getsize(destination) == total_size)
+
+    if fresh:
+        journal = ResumeJournal(destination, url, total_size, validator)
+    else:
+        tqdm.write(f"Resuming {os.path.basename(destination)}, {journal.completed()} of {total_size} bytes already on disk.")
+
+    # Only keep a journal on disk when the server gives us something to check it against
+    persist = resume and validator is not None
+    boundaries = None
+    if verifier is not None:
+        verifier.reset()
+        verifier.check_completed(journal)
+        boundaries = verifier.boundaries()
+    else:
+        # Bytes written from now on are not checked, a later verified run has to hash them
+        journal.verified = False
+    ranges = plan_segments(journal.missing(), segments, min_segment_size, boundaries)
+    progress = progress_factory(total_size, journal.completed())
+    progress_lock = threading.Lock()
+    abort = threading.Event()
+
+    if fresh and os.path.exists(destination):
+        # Replace rather than truncate, the old file may be hard-linked into the cache
+        os.remove(destination)
+
+    fd = os.open(destination, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        if fresh:
+            preallocate(fd, total_size)
+            if persist:
+                journal.save()
+
+        with ThreadPoolExecutor(max_workers=max(1, len(ranges))) as executor:
+            futures = [executor.submit(fetch_segment, mirror_set, fd, start, stop, journal, persist, progress, progress_lock, abort, cancel, verifier) for start, stop in ranges]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException as e:
+                # Stop the remaining segments as soon as one of them fails
+                abort.set()
+                executor.shutdown(wait=True)
+                if isinstance(e, IntegrityError):
+                    # Corrupt data must not be resumed from, start over on the next run
+                    journal.remove()
+                elif persist and not isinstance(e, RemoteChanged):
+                    sync_journal(fd, journal)
+                raise
+
+        if stopped(abort, cancel):
+            # Cancelled from outside, keep the journal so the next run can resume
+            if persist:
+                sync_journal(fd, journal)
+            raise DownloadCancelled(f"Download of {url} was cancelled")
+
+        try:
+            if verifier is not None:
+                verifier.finish()
+        finally:
+            journal.remove()
+    finally:
+        os.close(fd)
+        progress.close()
+
+# Function to download a file over a single HTTP connection
+def download_stream(url, destination, progress_factory=default_progress, cancel=None, verifier=None):
+    """Function to download url into destination using a single streamed request."""
+    with network.get_session().get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()  # Raise an HTTPError for bad responses
+        total_size = int(response.headers.get('content-length', 0))
+        progress = progress_factory(total_size)
+
+        # Replace rather than truncate, the old file may be hard-linked into the cache
+        if os.path.exists(destination):
+            os.remove(destination)
+
+        try:
+            with open(destination, 'wb') as file:
+                if verifier is not None:
+                    verifier.reset()
+                for data in response.iter_content(BLOCK_SIZE):
+                    if cancel is not None and cancel.is_set():
+                        raise DownloadCancelled(f"Download of {url} was cancelled")
+                    if verifier is not None:
+                        verifier.feed(file.tell(), data)
+                    progress.update(len(data))
+                    file.write(data)
+                    network.throttle(len(data))
+            if verifier is not None:
+                verifier.finish()
+        finally:
+            progress.close()
+
+# Function to get the URL a package is known by
+def primary_url(url):
+    """Function to return the first URL of a mirror list, or url itself when it is a single URL."""
+    return url[0] if isinstance(url, (list, tuple)) else url
+
+# Function to pick the best transfer strategy for a URL
+def download(url, destination, segments=DEFAULT_SEGMENTS, min_segment_size=DEFAULT_MIN_SEGMENT_SIZE, resume=True, progress_factory=default_progress, cancel=None, verifier=None):
+    """Function to download url, or the fastest of a list of mirror URLs, using resumable ranged segments when the server allows it."""
+    proxied = network.via_proxy(primary_url(url))
+    if proxied != primary_url(url):
+        # The LAN proxy stands in for every mirror, and a single stream lets it fill its cache in order
+        url = proxied
+        segments = 1
+
+    if isinstance(url, (list, tuple)) and len(url) > 1:
+        # Chunk hashes catch a mirror serving different bytes, without them only matching validators may be mixed
+        mirror_set, total_size, accepts_ranges, validator = mirrors.rank_mirrors(url, verifier is not None)
+    else:
+        url = primary_url(url)
+        total_size, accepts_ranges, validator = probe_url(url)
+        mirror_set = mirrors.MirrorSet([url], {url: validator})
+
+    try:
+        if not accepts_ranges or total_size <= 0:
+            # Without ranges a failed mirror means starting over on the next one
+            for attempt in range(len(mirror_set.urls)):
+                stream_url = mirror_set.current()
+                try:
+                    download_stream(stream_url, destination, progress_factory, cancel, verifier)
+                    return
+                except DownloadCancelled:
+                    raise
+                except requests.exceptions.RequestException:
+                    mirror_set.failed(stream_url)
+                    if attempt == len(mirror_set.urls) - 1:
+                        raise
+
+        # Small files are not worth splitting over several connections
+        if total_size < 2 * min_segment_size:
+            segments = 1
+
+        try:
+            download_ranged(mirror_set, destination, total_size, validator, segments, min_segment_size, resume, progress_factory, cancel, verifier)
+        except RemoteChanged as e:
+            tqdm.write(f"{e}, starting over.")
+            ResumeJournal(destination, mirror_set.key, total_size, validator).remove()
+            download_ranged(mirror_set, destination, total_size, validator, segments, min_segment_size, False, progress_factory, cancel, verifier)
+    finally:
+        mirrors.stats.save()
+
+# Function to download several files at once from a bounded worker pool
+def download_all(jobs, parallel=DEFAULT_PARALLEL_DOWNLOADS, segments=DEFAULT_SEGMENTS, min_segment_size=DEFAULT_MIN_SEGMENT_SIZE, resume=True, verify=True, cache=None, on_start=None, on_complete=None):
+    """Function to download (url, destination, expected_size, integrity_url) jobs concurrently, returning [(destination, error)] in job order.
+
+    url is a single URL or a list of mirror URLs, the first one identifying the package in the cache.
+    on_start(destination, size) runs in the worker before a job starts and may block to hold it back,
+    on_complete(destination) runs as soon as a job's file is in place.
+    """
+    group = ProgressGroup(sum(size or 0 for _, _, size, _ in jobs))
+    cancel = threading.Event()
+
+    def run(job, factory):
+        url, destination, size, integrity_url = job
+        if on_start is not None:
+            on_start(destination, size or 0)
+        chunks = fetch_integrity_data(integrity_url) if integrity_url and (verify or cache is not None) else None
+
+        if cache is not None:
+            key = cache.key(primary_url(url), size, chunks)
+            if cache.fetch(key, destination, size):
+                factory(size or 0, size or 0).close()
+                tqdm.write(f"{os.path.basename(destination)} found in the download cache.")
+                if on_complete is not None:
+                    on_complete(destination)
+                return
+
+        verifier = IntegrityVerifier(chunks, destination) if verify and chunks else None
+        download(url, destination, segments, min_segment_size, resume, factory, cancel, verifier)
+
+        if cache is not None:
+            cache.store(key, destination, primary_url(url))
+        if on_complete is not None:
+            on_complete(destination)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            # Jobs are submitted in the given order, so the largest package should come first
+            futures = [executor.submit(run, job, group.factory(os.path.basename(job[1]))) for job in jobs]
+            results = []
+            try:
+                for job, future in zip(jobs, futures):
+                    try:
+                        future.result()
+                        results.append((job[1], None))
+                    except (requests.exceptions.RequestException, IntegrityError) as e:
+                        results.append((job[1], e))
+            except BaseException:
+                # Interrupted, stop every running transfer and drop the queued ones
+                cancel.set()
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+    finally:
+        group.close()
+
+    return results
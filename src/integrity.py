@@ -0,0 +1,168 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Package verification against Apple's integrityDataV1 files
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import mmap
+import bisect
+import hashlib
+import network
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from chunklist import ChunkListHeader, Chunk, chunk_offsets
+
+# Timeout (connect, read) in seconds for integrity data requests
+REQUEST_TIMEOUT = (15, 60)
+
+class IntegrityError(RuntimeError):
+    """Raised when downloaded data does not match its integrity data."""
+
+# Function to parse an integrityDataV1 file into chunk offsets, sizes and hashes
+def parse_integrity_data(data):
+    """Function to return [(offset, size, sha256)] from integrityDataV1 bytes, which use the chunklist layout."""
+    if len(data) < ChunkListHeader.size:
+        raise IntegrityError("Integrity data is truncated")
+
+    header = data[:ChunkListHeader.size]
+    magic, header_size, file_version, chunk_method, signature_method, chunk_count, chunk_offset, signature_offset = ChunkListHeader.unpack(header)
+    if magic != b'CNKL' or header_size != ChunkListHeader.size or file_version != 1 or chunk_method != 1:
+        raise IntegrityError("Integrity data has an unknown format")
+    if chunk_offset != ChunkListHeader.size or signature_offset != chunk_offset + Chunk.size * chunk_count or len(data) < signature_offset:
+        raise IntegrityError("Integrity data is truncated")
+
+    # Unsigned integrity data ends with the SHA-256 of everything before it
+    if signature_method == 2 and hashlib.sha256(data[:signature_offset]).digest() != data[signature_offset:signature_offset + 32]:
+        raise IntegrityError("Integrity data digest mismatch")
+
+    return chunk_offsets(Chunk.unpack_from(data, chunk_offset + index * Chunk.size) for index in range(chunk_count))
+
+# Function to download and parse the integrity data of a package
+def fetch_integrity_data(url):
+    """Function to fetch an integrityDataURL and return its parsed chunks."""
+    response = network.get_session().get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return parse_integrity_data(response.content)
+
+class IntegrityVerifier:
+    """Hashes package data as it is written, chunk by chunk, even when several segments write at once."""
+
+    def __init__(self, chunks, destination):
+        self.chunks = chunks
+        self.destination = destination
+        self.starts = [offset for offset, _, _ in chunks]
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Function to forget all progress, used when a download starts over."""
+        with self.lock:
+            self.pending = {}  # chunk index -> (hash context, next expected offset)
+            self.done = set()
+
+    def boundaries(self):
+        """Function to return the chunk start offsets, so download segments can be aligned to them."""
+        return self.starts
+
+    def check_completed(self, journal):
+        """Function to account for the chunks a resume journal already has on disk before the download continues.
+
+        Chunks are only trusted without hashing when the journal says its bytes were verified as they
+        were written. Otherwise every chunk inside the completed ranges is hashed from disk, and a chunk
+        that fails is dropped from the journal so it is fetched again.
+        """
+        ranges = [tuple(entry) for entry in journal.ranges]
+        for index, (offset, size, chunk_sha256) in enumerate(self.chunks):
+            if not any(start <= offset and offset + size <= stop for start, stop in ranges):
+                continue
+            if not journal.verified and hashlib.sha256(self.read_back(offset, offset + size)).digest() != chunk_sha256:
+                journal.unmark(offset, offset + size)
+                continue
+            with self.lock:
+                self.done.add(index)
+        # Everything still in the journal has now been checked, new bytes are checked as they arrive
+        journal.verified = True
+
+    def read_back(self, start, stop):
+        """Function to read bytes already on disk, used to catch up on a chunk that was partially written before."""
+        with open(self.destination, 'rb') as file:
+            file.seek(start)
+            return file.read(stop - start)
+
+    def feed(self, offset, data):
+        """Function to hash data written at offset, raising IntegrityError as soon as a chunk mismatches."""
+        view = memoryview(data)
+        while view:
+            index = bisect.bisect_right(self.starts, offset) - 1
+            if index < 0 or index >= len(self.chunks) or offset >= self.chunks[index][0] + self.chunks[index][1]:
+                raise IntegrityError(f"{os.path.basename(self.destination)} is larger than its integrity data")
+
+            chunk_offset, chunk_size, chunk_sha256 = self.chunks[index]
+            part = view[:chunk_offset + chunk_size - offset]
+
+            with self.lock:
+                hash_ctx, expected = self.pending.get(index, (None, chunk_offset))
+            if hash_ctx is None:
+                hash_ctx = hashlib.sha256()
+            if expected != offset:
+                # Only the first write into a resumed chunk can start past the chunk start
+                hash_ctx.update(self.read_back(expected, offset))
+
+            hash_ctx.update(part)
+            offset += len(part)
+            view = view[len(part):]
+
+            if offset == chunk_offset + chunk_size:
+                with self.lock:
+                    self.pending.pop(index, None)
+                    self.done.add(index)
+                if hash_ctx.digest() != chunk_sha256:
+                    raise IntegrityError(f"{os.path.basename(self.destination)} chunk {index + 1} failed verification")
+            else:
+                with self.lock:
+                    self.pending[index] = (hash_ctx, offset)
+
+    def finish(self):
+        """Function to verify the chunks that were not completed while streaming, reading them back from disk."""
+        with self.lock:
+            remaining = [index for index in range(len(self.chunks)) if index not in self.done]
+            pending = dict(self.pending)
+
+        # Chunks whose tail was already on disk from an earlier run end up here
+        for index in remaining:
+            chunk_offset, chunk_size, chunk_sha256 = self.chunks[index]
+            hash_ctx, expected = pending.get(index, (hashlib.sha256(), chunk_offset))
+            data = self.read_back(expected, chunk_offset + chunk_size)
+            if expected + len(data) != chunk_offset + chunk_size:
+                raise IntegrityError(f"{os.path.basename(self.destination)} ended early in chunk {index + 1}")
+            hash_ctx.update(data)
+            if hash_ctx.digest() != chunk_sha256:
+                raise IntegrityError(f"{os.path.basename(self.destination)} chunk {index + 1} failed verification")
+
+# Function to verify a file that is already on disk
+def verify_file(path, chunks, workers=None):
+    """Function to check a file against parsed integrity data on workers threads, raising IntegrityError on the first bad chunk."""
+    expected_size = sum(size for _, size, _ in chunks)
+    actual_size = os.path.getsize(path)
+    if actual_size != expected_size:
+        raise IntegrityError(f"{os.path.basename(path)} is {actual_size} bytes, expected {expected_size}")
+    if actual_size == 0:
+        return
+
+    # hashlib releases the GIL on large buffers, so chunks are hashed on all cores straight from the mapping
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping, memoryview(mapping) as view:
+        def chunk_valid(chunk):
+            offset, size, chunk_sha256 = chunk
+            return hashlib.sha256(view[offset:offset + size]).digest() == chunk_sha256
+
+        executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        try:
+            for index, valid in enumerate(executor.map(chunk_valid, chunks)):
+                if not valid:
+                    raise IntegrityError(f"{os.path.basename(path)} chunk {index + 1} failed verification")
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
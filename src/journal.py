@@ -0,0 +1,133 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Progress journal used to resume interrupted downloads
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import json
+import threading
+
+# Extension of the sidecar file stored next to a partial download
+JOURNAL_SUFFIX = ".journal"
+
+# Amount of newly written data after which the journal is persisted again
+JOURNAL_INTERVAL = 32 * 1024 * 1024  # 32 MB
+
+# Function to get the journal path belonging to a destination file
+def journal_path(destination):
+    """Function to return the sidecar journal path for a destination file."""
+    return destination + JOURNAL_SUFFIX
+
+# Function to pick the validator used in If-Range requests from response headers
+def validator_from_headers(headers):
+    """Function to return the ETag, or Last-Modified when no ETag is sent, from response headers."""
+    lowered = {key.lower(): value for key, value in headers.items()}
+    return lowered.get("etag") or lowered.get("last-modified")
+
+class ResumeJournal:
+    """Sidecar record of the byte ranges of a partial file that are already on disk."""
+
+    def __init__(self, destination, url, size, validator, ranges=None, verified=False):
+        self.destination = destination
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.ranges = ranges or []  # Sorted, merged list of [start, stop) pairs
+        self.verified = verified    # True when every completed byte was checked against integrity data
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, destination, url):
+        """Function to load the journal of a partial file, or None when it cannot be resumed."""
+        path = journal_path(destination)
+        if not os.path.exists(path) or not os.path.exists(destination):
+            return None
+
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("url") != url or not data.get("validator"):
+            return None
+
+        ranges = [list(entry) for entry in data.get("ranges", [])]
+        return cls(destination, url, data.get("size"), data["validator"], ranges, data.get("verified", False))
+
+    def matches(self, size, validator):
+        """Function to check that the remote file is still the one this journal describes."""
+        if self.size is not None and size and self.size != size:
+            return False
+        return validator is not None and self.validator == validator
+
+    def mark(self, start, stop):
+        """Function to record bytes [start, stop) as written, returning True when a save is due."""
+        with self.lock:
+            self.pending += stop - start
+            merged = []
+            for entry in self.ranges:
+                if entry[1] < start or entry[0] > stop:
+                    merged.append(entry)
+                else:
+                    start = min(start, entry[0])
+                    stop = max(stop, entry[1])
+            merged.append([start, stop])
+            merged.sort()
+            self.ranges = merged
+            return self.pending >= JOURNAL_INTERVAL
+
+    def unmark(self, start, stop):
+        """Function to forget bytes [start, stop), so they are fetched again."""
+        with self.lock:
+            remaining = []
+            for entry in self.ranges:
+                if entry[0] < start:
+                    remaining.append([entry[0], min(entry[1], start)])
+                if entry[1] > stop:
+                    remaining.append([max(entry[0], stop), entry[1]])
+            self.ranges = [entry for entry in remaining if entry[0] < entry[1]]
+
+    def completed(self):
+        """Function to return the number of bytes already on disk."""
+        with self.lock:
+            return sum(stop - start for start, stop in self.ranges)
+
+    def missing(self):
+        """Function to return the [start, stop) ranges that still have to be fetched."""
+        with self.lock:
+            gaps = []
+            offset = 0
+            for start, stop in self.ranges:
+                if start > offset:
+                    gaps.append((offset, start))
+                offset = max(offset, stop)
+            if self.size is None:
+                gaps.append((offset, None))
+            elif offset < self.size:
+                gaps.append((offset, self.size))
+            return gaps
+
+    def save(self):
+        """Function to atomically write the journal next to the partial file."""
+        path = journal_path(self.destination)
+        temp_path = path + ".tmp"
+
+        with self.lock:
+            data = {"url": self.url, "size": self.size, "validator": self.validator, "ranges": self.ranges, "verified": self.verified}
+            self.pending = 0
+            with open(temp_path, 'w') as file:
+                json.dump(data, file)
+            os.replace(temp_path, path)
+
+    def remove(self):
+        """Function to delete the journal once the download is complete."""
+        try:
+            os.remove(journal_path(self.destination))
+        except FileNotFoundError:
+            pass
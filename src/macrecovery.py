@@ -7,22 +7,45 @@ Copyright (c) 2019, vit9696
 """
 
 import argparse
+import asyncio
 import binascii
 import hashlib
 import json
 import linecache
 import os
 import random
-import struct
+import shlex
 import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from http.cookies import SimpleCookie
 
 try:
-    from urllib.request import Request, HTTPError, urlopen
     from urllib.parse import urlparse
 except ImportError:
-    from urllib2 import Request, HTTPError, urlopen
     from urlparse import urlparse
 
+import asynchttp
+import network
+from cache import link_file
+from chunklist import ChunkListHeader, Chunk, chunk_offsets
+from integrity import IntegrityVerifier, verify_file
+from journal import ResumeJournal, validator_from_headers
+
+RECOVERY_URL = 'http://osrecovery.apple.com'
+
+# Timeout (connect, read) in seconds for every recovery server and image request.
+REQUEST_TIMEOUT = (15, 60)
+
+# Number of recovery requests or image streams in flight at once.
+DEFAULT_CONCURRENCY = 16
+
+# Seconds a session or image info query may take before it fails with RecoveryTimeout.
+DEFAULT_QUERY_TIMEOUT = 30
+
 SELF_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIR = os.path.join(SELF_DIR, '..', 'data')
 
@@ -45,22 +68,161 @@ INFO_SIGN_SESS = 'CT'
 INFO_REQURED = [INFO_PRODUCT, INFO_IMAGE_LINK, INFO_IMAGE_HASH, INFO_IMAGE_SESS, INFO_SIGN_LINK, INFO_SIGN_HASH, INFO_SIGN_SESS]
 
 
-def run_query(url, headers, post=None, raw=False):
-    if post is not None:
-        data = '\n'.join([entry + '=' + post[entry] for entry in post])
-        if sys.version_info[0] >= 3:
-            data = data.encode('utf-8')
-    else:
-        data = None
-    req = Request(url=url, headers=headers, data=data)
-    try:
-        response = urlopen(req)
-        if raw:
-            return response
-        return dict(response.info()), response.read()
-    except HTTPError as e:
-        print(f'ERROR: "{e}" when connecting to {url}')
-        sys.exit(1)
+class RecoveryError(RuntimeError):
+    """
+    Raised when the recovery server refuses a query or answers with something unusable.
+    """
+
+
+class SessionExpired(RecoveryError):
+    """
+    Raised when the recovery server rejects the session cookie.
+    """
+
+
+class VerificationError(RecoveryError):
+    """
+    Raised when a downloaded image or chunklist fails verification.
+    """
+
+
+class RecoveryTimeout(RecoveryError):
+    """
+    Raised when a recovery request does not finish within its timeout.
+    """
+
+
+class RecoveryNetworkError(RecoveryError):
+    """
+    Raised when a recovery request fails below HTTP, e.g. a refused or reset connection.
+    """
+
+
+# Outcome of download_recovery: product name, saved image and chunklist paths, and the raw image info.
+RecoveryResult = namedtuple('RecoveryResult', ['product', 'image', 'chunklist', 'info'])
+
+# Answers of get_image_info kept between runs, see InfoCache.
+INFO_CACHE_PATH = os.path.join(DATA_DIR, 'recovery_info_cache.json')
+INFO_CACHE_TTL = 12 * 60 * 60
+INFO_CACHE_VERSION = 1
+
+# Session cookies kept between runs, see SessionManager.
+SESSION_PATH = os.path.join(DATA_DIR, 'recovery_session.json')
+SESSION_LIFETIME = 15 * 60
+SESSION_MARGIN = 30
+
+# Responses meaning the session cookie is no longer accepted.
+SESSION_STATUSES = (401, 403)
+
+# One board to stage recovery for in download_recovery_batch.
+RecoveryTarget = namedtuple('RecoveryTarget', ['board_id', 'os_type', 'outdir', 'mlb', 'diag'], defaults=['default', 'com.apple.recovery.boot', MLB_ZERO, False])
+
+
+def encode_post(post):
+    data = '\n'.join([entry + '=' + post[entry] for entry in post])
+    if sys.version_info[0] >= 3:
+        data = data.encode('utf-8')
+    return data
+
+
+def run_client(call, session=None, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Await `call(client)` on a new AsyncRecoveryClient in its own event loop, for the synchronous entry points.
+    """
+
+    async def run():
+        async with AsyncRecoveryClient(concurrency, sessions=session) as client:
+            return await call(client)
+
+    return asyncio.run(run())
+
+
+def run_query(url, headers, post=None):
+    return run_client(lambda client: client.query(url, headers, post))
+
+
+def recovery_host():
+    return urlparse(RECOVERY_URL).netloc
+
+
+class RateLimiter:
+    """
+    Spread calls evenly so that at most `rate` of them start per second, 0 disables the limit.
+    """
+
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def reserve(self):
+        """
+        Book the next start, returning the seconds to wait before it.
+        """
+
+        if not self.interval:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        return max(0, delay)
+
+
+class InfoCache:
+    """
+    On-disk cache of get_image_info answers keyed by (server, bid, mlb, os_type, diag), expiring after `ttl` seconds.
+    With `refresh` set, cached answers are ignored but fresh ones are still stored.
+    """
+
+    def __init__(self, path=INFO_CACHE_PATH, ttl=INFO_CACHE_TTL, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.entries = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+            if data.get('version') == INFO_CACHE_VERSION:
+                self.entries = data.get('entries', {})
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    @staticmethod
+    def key(bid, mlb, os_type, diag):
+        return '|'.join([RECOVERY_URL, bid, mlb, 'diag' if diag else os_type])
+
+    def get(self, key):
+        if self.refresh:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return entry['info']
+
+    def put(self, key, info):
+        with self.lock:
+            self.entries[key] = {'time': time.time(), 'info': info}
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            now = time.time()
+            entries = {key: entry for key, entry in self.entries.items() if now - entry['time'] <= self.ttl}
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as fh:
+                json.dump({'version': INFO_CACHE_VERSION, 'entries': entries}, fh, indent=1)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+
+
+# Cache used by the metadata actions, set up by main() and left as None when caching is off.
+info_cache = None
 
 
 def generate_id(id_type, id_value=None):
@@ -74,8 +236,7 @@ def product_mlb(mlb):
 
 def mlb_from_eeee(eeee):
     if len(eeee) != 4:
-        print('ERROR: Invalid EEEE code length!')
-        sys.exit(1)
+        raise RecoveryError('Invalid EEEE code length!')
 
     return f'00000000000{eeee}00'
 
@@ -90,13 +251,6 @@ def int_from_unsigned_bytes(byte_list, byteorder):
 # zhangyoufu https://gist.github.com/MCJack123/943eaca762730ca4b7ae460b731b68e7#gistcomment-3061078 2021-10-08
 Apple_EFI_ROM_public_key_1 = 0xC3E748CAD9CD384329E10E25A91E43E1A762FF529ADE578C935BDDF9B13F2179D4855E6FC89E9E29CA12517D17DFA1EDCE0BEBF0EA7B461FFE61D94E2BDF72C196F89ACD3536B644064014DAE25A15DB6BB0852ECBD120916318D1CCDEA3C84C92ED743FC176D0BACA920D3FCF3158AFF731F88CE0623182A8ED67E650515F75745909F07D415F55FC15A35654D118C55A462D37A3ACDA08612F3F3F6571761EFCCBCC299AEE99B3A4FD6212CCFFF5EF37A2C334E871191F7E1C31960E010A54E86FA3F62E6D6905E1CD57732410A3EB0C6B4DEFDABE9F59BF1618758C751CD56CEF851D1C0EAA1C558E37AC108DA9089863D20E2E7E4BF475EC66FE6B3EFDCF
 
-ChunkListHeader = struct.Struct('<4sIBBBxQQQ')
-assert ChunkListHeader.size == 0x24
-
-Chunk = struct.Struct('<I32s')
-assert Chunk.size == 0x24
-
-
 def verify_chunklist(cnkpath):
     with open(cnkpath, 'rb') as f:
         hash_ctx = hashlib.sha256()
@@ -132,33 +286,155 @@ def verify_chunklist(cnkpath):
         assert f.read(1) == b''
 
 
-def get_session(args):
+def session_lifetime(morsel):
+    """
+    Seconds a session cookie stays valid, from its Max-Age or Expires attribute, else SESSION_LIFETIME.
+    """
+
+    try:
+        if morsel['max-age']:
+            return int(morsel['max-age'])
+        if morsel['expires']:
+            return parsedate_to_datetime(morsel['expires']).timestamp() - time.time()
+    except (TypeError, ValueError):
+        pass
+    return SESSION_LIFETIME
+
+
+def session_query():
+    """
+    Return the (url, headers) of a new session request.
+    """
+
     headers = {
-        'Host': 'osrecovery.apple.com',
-        'Connection': 'close',
+        'Host': recovery_host(),
         'User-Agent': 'InternetRecovery/1.0',
     }
+    return RECOVERY_URL + '/', headers
 
-    headers, _ = run_query('http://osrecovery.apple.com/', headers)
 
-    if args.verbose:
+def fetch_session(verbose=False):
+    """
+    Ask the recovery server for a new session cookie, returning (cookie, expiry time).
+    """
+
+    headers, _ = run_query(*session_query())
+    return session_from_headers(headers, verbose)
+
+
+def session_from_headers(headers, verbose=False):
+    """
+    Pick the session cookie out of the headers of a session response, returning (cookie, expiry time).
+    """
+
+    if verbose:
         print('Session headers:')
         for header in headers:
             print(f'{header}: {headers[header]}')
 
     for header in headers:
         if header.lower() == 'set-cookie':
-            cookies = headers[header].split('; ')
-            for cookie in cookies:
-                return cookie if cookie.startswith('session=') else ...
+            cookies = SimpleCookie()
+            cookies.load(headers[header])
+            if 'session' in cookies:
+                morsel = cookies['session']
+                return 'session=' + morsel.value, time.time() + session_lifetime(morsel)
+
+    raise RecoveryError('No session in headers ' + str(headers))
+
+
+class SessionManager:
+    """
+    Hand out the recovery session cookie, reusing it across workers and runs until it expires.
+    A cookie reported through invalidate() is replaced once, however many workers saw it fail.
+    """
 
-    raise RuntimeError('No session in headers ' + str(headers))
+    def __init__(self, path=SESSION_PATH, verbose=False):
+        self.path = path
+        self.verbose = verbose
+        self.lock = threading.RLock()
+        self.sessions = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                self.sessions = json.load(fh)
+        except (OSError, ValueError):
+            self.sessions = {}
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as fh:
+                json.dump(self.sessions, fh, indent=1)
+            os.replace(temp_path, self.path)
+        except OSError:
+            # Not being able to persist the cookie only costs a round trip next run.
+            pass
+
+    def get(self):
+        with self.lock:
+            cookie = self.cached()
+            if cookie is None:
+                cookie, expires = fetch_session(self.verbose)
+                self.store(cookie, expires)
+            return cookie
+
+    def cached(self):
+        """
+        Return the stored cookie while it is still valid, else None.
+        """
+
+        with self.lock:
+            if self.sessions is None:
+                self.load()
+            entry = self.sessions.get(RECOVERY_URL)
+            if entry is None or entry['expires'] - SESSION_MARGIN <= time.time():
+                return None
+            return entry['cookie']
+
+    def store(self, cookie, expires):
+        with self.lock:
+            if self.sessions is None:
+                self.load()
+            self.sessions[RECOVERY_URL] = {'cookie': cookie, 'expires': expires}
+            self.save()
+
+    def invalidate(self, cookie):
+        with self.lock:
+            if self.sessions is None:
+                self.load()
+            entry = self.sessions.get(RECOVERY_URL)
+            if entry is not None and entry['cookie'] == cookie:
+                del self.sessions[RECOVERY_URL]
+                self.save()
+
+
+# Shared by every action and worker of the process.
+session_manager = SessionManager()
+
+
+def get_session(args=None):
+    """
+    Return the shared SessionManager, accepted by get_image_info wherever a session cookie is.
+    """
+
+    if args is not None and args.verbose:
+        session_manager.verbose = True
+    return session_manager
 
 
 def get_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+    return run_client(lambda client: client.get_image_info(bid, mlb, diag, os_type, cid), session)
+
+
+def image_info_query(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+    """
+    Return the (url, headers, post) of an image info request.
+    """
+
     headers = {
-        'Host': 'osrecovery.apple.com',
-        'Connection': 'close',
+        'Host': recovery_host(),
         'User-Agent': 'InternetRecovery/1.0',
         'Cookie': session,
         'Content-Type': 'text/plain',
@@ -173,13 +449,19 @@ def get_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', ci
     }
 
     if diag:
-        url = 'http://osrecovery.apple.com/InstallationPayload/Diagnostics'
+        url = RECOVERY_URL + '/InstallationPayload/Diagnostics'
     else:
-        url = 'http://osrecovery.apple.com/InstallationPayload/RecoveryImage'
+        url = RECOVERY_URL + '/InstallationPayload/RecoveryImage'
         post['os'] = os_type
 
-    headers, output = run_query(url, headers, post)
+    return url, headers, post
+
+
+def query_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+    return run_client(lambda client: client.query_image_info(session, bid, mlb, diag, os_type, cid))
 
+
+def parse_image_info(output):
     output = output.decode('utf-8')
     info = {}
     for line in output.split('\n'):
@@ -191,16 +473,31 @@ def get_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', ci
 
     for k in INFO_REQURED:
         if k not in info:
-            raise RuntimeError(f'Missing key {k}')
+            raise RecoveryError(f'Missing key {k}')
 
     return info
 
 
-def save_image(url, sess, filename='', directory=''):
+def cached_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', limiter=None):
+    """
+    get_image_info through info_cache, for queries that only need the answer and not fresh asset tokens.
+    Only queries that reach the server wait for `limiter`.
+    """
+
+    return run_client(lambda client: client.cached_image_info(bid, mlb, diag, os_type, limiter), session)
+
+
+def image_request(url, sess, filename='', directory='', resume=True):
+    """
+    Prepare the download of an image, returning (url, path, headers, journal, offset).
+    offset is where a resumable partial file ends, the headers then ask for the rest.
+    """
+
+    # Go through the DarwinFetch LAN proxy when one is configured
+    url = network.via_proxy(url)
     purl = urlparse(url)
     headers = {
         'Host': purl.hostname,
-        'Connection': 'close',
         'User-Agent': 'InternetRecovery/1.0',
         'Cookie': '='.join(['AssetToken', sess])
     }
@@ -211,43 +508,108 @@ def save_image(url, sess, filename='', directory=''):
     if filename == '':
         filename = os.path.basename(purl.path)
     if filename.find('/') >= 0 or filename == '':
-        raise RuntimeError('Invalid save path ' + filename)
+        raise RecoveryError('Invalid save path ' + filename)
+
+    path = os.path.join(directory, filename)
+
+    # Continue from the end of a previous partial download when its journal still matches.
+    journal = ResumeJournal.load(path, url) if resume else None
+    offset = 0
+    if journal is not None:
+        gaps = journal.missing()
+        if len(gaps) == 1 and gaps[0][0] <= os.path.getsize(path):
+            offset = gaps[0][0]
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = journal.validator
 
     print(f'Saving {url} to {directory}/{filename}...')
+    return url, path, headers, journal, offset
+
+
+class ImageWriter:
+    """
+    Write an image response to disk, checking it against (size, sha256) chunklist entries when given
+    and keeping the resume journal up to date.
+    A 206 answer continues the partial file at `offset`, anything else starts it over.
+    """
 
-    with open(os.path.join(directory, filename), 'wb') as fh:
-        response = run_query(url, headers, raw=True)
-        size = 0
-        while True:
-            chunk = response.read(2**20)
-            if not chunk:
-                break
-            fh.write(chunk)
-            size += len(chunk)
-            print(f'\r{size / (2**20)} MBs downloaded...', end='')
-            sys.stdout.flush()
+    def __init__(self, url, path, offset, status, headers, journal, resume=True, chunks=None):
+        # Bytes kept from a previous run are read back and checked by the verifier as well.
+        self.verifier = IntegrityVerifier(chunk_offsets(chunks), path) if chunks is not None else None
+        if offset > 0 and status == 206:
+            print(f'Resuming from {offset / (2**20)} MBs...')
+            fh = open(path, 'r+b')
+            fh.seek(offset)
+            fh.truncate()
+        else:
+            # Server sent the whole file, either fresh or because the validator changed.
+            offset = 0
+            length = headers.get('Content-Length')
+            journal = ResumeJournal(path, url, int(length) if length else None, validator_from_headers(headers))
+            fh = open(path, 'wb')
+
+        self.fh = fh
+        self.journal = journal
+        self.size = offset
+        self.persist = resume and journal.validator is not None
+        if self.persist:
+            journal.save()
+
+    def write(self, chunk):
+        if self.verifier is not None:
+            self.verifier.feed(self.size, chunk)
+        self.fh.write(chunk)
+        if self.journal.mark(self.size, self.size + len(chunk)) and self.persist:
+            self.sync()
+        self.size += len(chunk)
+        print(f'\r{self.size / (2**20)} MBs downloaded...', end='')
+        sys.stdout.flush()
+
+    def sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.journal.save()
+
+    def finish(self):
+        if self.verifier is not None:
+            # Reading chunks back from disk needs everything written out first.
+            self.fh.flush()
+            self.verifier.finish()
+        self.journal.remove()
         print('\rDownload complete!\t\t\t\t\t')
 
-    return os.path.join(directory, os.path.basename(filename))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self.fh:
+            if exc_type is None:
+                return
+            if issubclass(exc_type, RuntimeError) and not issubclass(exc_type, RecoveryError):
+                # Corrupt data must not be resumed from, start over on the next run.
+                self.journal.remove()
+            elif self.persist:
+                self.sync()
+
 
+def save_image(url, sess, filename='', directory='', resume=True, chunks=None):
+    return run_client(lambda client: client.save_image(url, sess, filename, directory, resume, chunks))
 
-def verify_image(dmgpath, cnkpath):
+
+def verify_image(dmgpath, cnkpath, workers=None):
     print('Verifying image with chunklist...')
 
-    with open(dmgpath, 'rb') as dmgf:
-        cnkcount = 0
-        for cnksize, cnkhash in verify_chunklist(cnkpath):
-            cnkcount += 1
-            print(f'\rChunk {cnkcount} ({cnksize} bytes)', end='')
-            sys.stdout.flush()
-            cnk = dmgf.read(cnksize)
-            if len(cnk) != cnksize:
-                raise RuntimeError(f'Invalid chunk {cnkcount} size: expected {cnksize}, read {len(cnk)}')
-            if hashlib.sha256(cnk).digest() != cnkhash:
-                raise RuntimeError(f'Invalid chunk {cnkcount}: hash mismatch')
-        if dmgf.read(1) != b'':
-            raise RuntimeError('Invalid image: larger than chunklist')
-        print('\rImage verification complete!\t\t\t\t\t')
+    # Check the chunklist signature before spending time on the image.
+    verify_chunks(dmgpath, list(verify_chunklist(cnkpath)), workers)
+
+
+def verify_chunks(dmgpath, cnklist, workers=None):
+    """
+    Hash the image against (size, sha256) chunklist entries on `workers` threads, raising IntegrityError on the first bad chunk.
+    """
+
+    verify_file(dmgpath, chunk_offsets(cnklist), workers)
+    print('Image verification complete!')
 
 
 def action_download(args):
@@ -278,29 +640,313 @@ def action_download(args):
     fg=B2E6AA07DB9088BE5BDB38DB2EA824FDDFB6C3AC5272203B32D89F9D8E3528DC
     """
 
-    session = get_session(args)
-    info = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=args.diagnostics, os_type=args.os_type)
-    if args.verbose:
-        print(info)
-    print(f'Downloading {info[INFO_PRODUCT]}...')
-    dmgname = '' if args.basename == '' else args.basename + '.dmg'
-    dmgpath = save_image(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], dmgname, args.outdir)
-    cnkname = '' if args.basename == '' else args.basename + '.chunklist'
-    cnkpath = save_image(info[INFO_SIGN_LINK], info[INFO_SIGN_SESS], cnkname, args.outdir)
     try:
-        verify_image(dmgpath, cnkpath)
-        return 0
-    except Exception as err:
-        if isinstance(err, AssertionError) and str(err) == '':
-            try:
-                tb = sys.exc_info()[2]
-                while tb.tb_next:
-                    tb = tb.tb_next
-                err = linecache.getline(tb.tb_frame.f_code.co_filename, tb.tb_lineno, tb.tb_frame.f_globals).strip()
-            except Exception:
-                err = "Invalid chunklist"
+        result = download_recovery(args.board_id, args.mlb, args.os_type, args.diagnostics, args.outdir, args.basename,
+                                   not args.no_resume, args.verify_after, args.verbose)
+    except VerificationError as err:
         print(f'\rImage verification failed. ({err})')
         return 1
+    print(f'Saved {result.product} to {result.image}')
+    return 0
+
+
+def verification_message(err):
+    """
+    Describe a verification failure, using the failing assert line when the assertion has no message.
+    """
+
+    if isinstance(err, AssertionError) and str(err) == '':
+        try:
+            tb = err.__traceback__
+            while tb.tb_next:
+                tb = tb.tb_next
+            return linecache.getline(tb.tb_frame.f_code.co_filename, tb.tb_lineno, tb.tb_frame.f_globals).strip()
+        except Exception:
+            return 'Invalid chunklist'
+    return str(err)
+
+
+def download_recovery(board_id=RECENT_MAC, mlb=MLB_ZERO, os_type='default', diag=False, outdir='com.apple.recovery.boot',
+                      basename='', resume=True, verify_after=False, verbose=False, session=None):
+    """
+    Download and verify a recovery image in-process, returning a RecoveryResult.
+
+    Raises RecoveryError when the server cannot provide the image, VerificationError when the
+    image or its chunklist is invalid, and RecoveryTimeout or RecoveryNetworkError on network errors.
+    """
+
+    if session is None:
+        session = get_session()
+    info = get_image_info(session, bid=board_id, mlb=mlb, diag=diag, os_type=os_type)
+    if verbose:
+        print(info)
+    return fetch_image(info, outdir, basename, resume, verify_after)
+
+
+def fetch_image(info, outdir, basename='', resume=True, verify_after=False):
+    """
+    Download and verify the image and chunklist described by get_image_info output, returning a RecoveryResult.
+    """
+
+    return run_client(lambda client: client.fetch_image(info, outdir, basename, resume, verify_after))
+
+
+class AsyncRecoveryClient:
+    """
+    Run session, image info and image requests to the recovery server on one event loop.
+
+    Requests go through an asynchttp.AsyncHttpClient, so they follow the retry, proxy and pool settings of
+    network.py. At most `concurrency` requests are in flight, every failure is a RecoveryError, and cancelling
+    an awaiting task stops the transfer behind it with its resume journal kept.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_QUERY_TIMEOUT, sessions=None):
+        self.timeout = timeout
+        self.sessions = sessions if sessions is not None else session_manager
+        self.slots = asyncio.Semaphore(max(1, concurrency))
+        self.session_lock = asyncio.Lock()
+        self.http = asynchttp.AsyncHttpClient(REQUEST_TIMEOUT)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.http.close()
+
+    @contextmanager
+    def errors(self, headers):
+        """
+        Turn asynchttp errors of a request sent with `headers` into RecoveryError subclasses.
+        """
+
+        try:
+            yield
+        except asynchttp.HttpStatusError as e:
+            if e.status in SESSION_STATUSES and 'Cookie' in headers:
+                raise SessionExpired(str(e)) from e
+            raise RecoveryError(str(e)) from e
+        except asynchttp.HttpTimeout as e:
+            raise RecoveryTimeout(str(e)) from e
+        except asynchttp.HttpError as e:
+            raise RecoveryNetworkError(str(e)) from e
+
+    async def query(self, url, headers, post=None):
+        """
+        Run a recovery server query, returning (headers, content).
+        """
+
+        body = encode_post(post) if post is not None else None
+
+        async def fetch():
+            with self.errors(headers):
+                response = await self.http.request('GET' if body is None else 'POST', url, headers, body)
+                try:
+                    return response.headers, await response.content()
+                finally:
+                    response.close()
+
+        async with self.slots:
+            try:
+                return await asyncio.wait_for(fetch(), self.timeout)
+            except asyncio.TimeoutError as e:
+                raise RecoveryTimeout(f'{url} did not answer within {self.timeout} seconds') from e
+
+    async def get_session(self):
+        """
+        Return a valid session cookie, fetching one only once however many tasks ask.
+        """
+
+        if not isinstance(self.sessions, SessionManager):
+            return self.sessions
+        cookie = self.sessions.cached()
+        if cookie is None:
+            async with self.session_lock:
+                cookie = self.sessions.cached()
+                if cookie is None:
+                    headers, _ = await self.query(*session_query())
+                    cookie, expires = session_from_headers(headers, self.sessions.verbose)
+                    self.sessions.store(cookie, expires)
+        return cookie
+
+    async def get_image_info(self, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+        """
+        Query the image info of a board, renewing the session once when it is rejected.
+        """
+
+        cookie = await self.get_session()
+        try:
+            return await self.query_image_info(cookie, bid, mlb, diag, os_type, cid)
+        except SessionExpired:
+            if not isinstance(self.sessions, SessionManager):
+                raise
+            # Other tasks pick up the renewed cookie as well.
+            self.sessions.invalidate(cookie)
+            return await self.query_image_info(await self.get_session(), bid, mlb, diag, os_type, cid)
+
+    async def query_image_info(self, cookie, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
+        _, output = await self.query(*image_info_query(cookie, bid, mlb, diag, os_type, cid))
+        return parse_image_info(output)
+
+    async def cached_image_info(self, bid, mlb=MLB_ZERO, diag=False, os_type='default', limiter=None):
+        """
+        get_image_info through info_cache, for queries that only need the answer and not fresh asset tokens.
+        Only queries that reach the server wait for `limiter`.
+        """
+
+        key = InfoCache.key(bid, mlb, os_type, diag)
+        info = info_cache.get(key) if info_cache is not None else None
+        if info is None:
+            if limiter is not None:
+                await asyncio.sleep(limiter.reserve())
+            info = await self.get_image_info(bid, mlb, diag, os_type)
+            if info_cache is not None:
+                info_cache.put(key, info)
+        return info
+
+    async def get_image_infos(self, targets, rate=0):
+        """
+        Query many RecoveryTargets at once, returning {target: info or RecoveryError}.
+        """
+
+        limiter = RateLimiter(rate)
+
+        async def resolve(target):
+            await asyncio.sleep(limiter.reserve())
+            try:
+                return await self.get_image_info(target.board_id, target.mlb, target.diag, target.os_type)
+            except RecoveryError as err:
+                return err
+
+        return dict(zip(targets, await asyncio.gather(*(resolve(target) for target in targets))))
+
+    async def save_image(self, url, sess, filename='', directory='', resume=True, chunks=None, timeout=None):
+        """
+        Stream an image to disk, returning its path. Cancelling or timing out keeps the partial file resumable.
+        With `chunks`, (size, sha256) chunklist entries, every chunk is checked as soon as it is complete.
+        """
+
+        url, path, headers, journal, offset = image_request(url, sess, filename, directory, resume)
+
+        async def stream():
+            with self.errors(headers):
+                response = await self.http.request('GET', url, headers)
+            try:
+                with ImageWriter(url, path, offset, response.status, response.headers, journal, resume, chunks) as writer:
+                    while True:
+                        # Translated here so ImageWriter keeps the journal of an interrupted transfer.
+                        with self.errors(headers):
+                            chunk = await response.read(2**20)
+                        if not chunk:
+                            break
+                        writer.write(chunk)
+                        await asyncio.sleep(network.throttle_delay(len(chunk)))
+                    writer.finish()
+            finally:
+                response.close()
+            return path
+
+        async with self.slots:
+            try:
+                return await asyncio.wait_for(stream(), timeout)
+            except asyncio.TimeoutError as e:
+                raise RecoveryTimeout(f'Download of {url} did not finish within {timeout} seconds') from e
+
+    async def fetch_image(self, info, outdir, basename='', resume=True, verify_after=False):
+        """
+        Download and verify the image and chunklist of an image info answer, returning a RecoveryResult.
+        """
+
+        print(f'Downloading {info[INFO_PRODUCT]}...')
+        dmgname = '' if basename == '' else basename + '.dmg'
+        cnkname = '' if basename == '' else basename + '.chunklist'
+        image = (info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS])
+        chunklist = (info[INFO_SIGN_LINK], info[INFO_SIGN_SESS])
+        try:
+            if verify_after:
+                dmgpath = await self.save_image(*image, dmgname, outdir, resume)
+                cnkpath = await self.save_image(*chunklist, cnkname, outdir, resume)
+                # Hashing the whole image belongs on the thread pool, not the event loop.
+                await asyncio.to_thread(verify_image, dmgpath, cnkpath)
+            else:
+                # Fetch and check the chunklist first, then verify every chunk while the image streams in.
+                cnkpath = await self.save_image(*chunklist, cnkname, outdir, resume)
+                chunks = list(verify_chunklist(cnkpath))
+                print('Verifying image with chunklist while downloading...')
+                dmgpath = await self.save_image(*image, dmgname, outdir, resume, chunks)
+                print('Image verification complete!')
+        except RecoveryError:
+            raise
+        except (RuntimeError, AssertionError, NotImplementedError) as err:
+            raise VerificationError(verification_message(err)) from err
+
+        return RecoveryResult(info[INFO_PRODUCT], dmgpath, cnkpath, info)
+
+
+def resolve_images(targets, session=None, jobs=8, rate=0):
+    """
+    Query image info for many RecoveryTargets at once, returning {target: info or exception}.
+    """
+
+    return run_client(lambda client: client.get_image_infos(targets, rate), session, jobs)
+
+
+def download_recovery_batch(targets, resume=True, verify_after=False, jobs=8, downloads=4, rate=0, session=None):
+    """
+    Stage recovery for many RecoveryTargets, downloading every distinct image (by AH hash) only once.
+
+    Image info is resolved with `jobs` concurrent queries and distinct images are fetched `downloads` at a time,
+    all on one event loop. The first target of each group gets the real files, the others get links to them.
+    Returns {target: RecoveryResult or exception}.
+    """
+
+    targets = list(dict.fromkeys(targets))
+
+    async def stage_all():
+        async with AsyncRecoveryClient(max(jobs, downloads), sessions=session) as client:
+            resolved = await client.get_image_infos(targets, rate)
+
+            results = {}
+            groups = {}
+            for target in targets:
+                info = resolved[target]
+                if isinstance(info, Exception):
+                    results[target] = info
+                else:
+                    groups.setdefault(info[INFO_IMAGE_HASH], []).append(target)
+
+            streams = asyncio.Semaphore(max(1, downloads))
+
+            async def stage(group):
+                first = group[0]
+                try:
+                    async with streams:
+                        result = await client.fetch_image(resolved[first], first.outdir, resume=resume, verify_after=verify_after)
+                except (RecoveryError, OSError) as err:
+                    # A full disk or unwritable outdir fails this image only, not the whole batch
+                    return {target: err for target in group}
+
+                staged = {first: result}
+                for target in group[1:]:
+                    image = os.path.join(target.outdir, os.path.basename(result.image))
+                    chunklist = os.path.join(target.outdir, os.path.basename(result.chunklist))
+                    try:
+                        os.makedirs(target.outdir, exist_ok=True)
+                        if os.path.abspath(image) != os.path.abspath(result.image):
+                            link_file(result.image, image)
+                            link_file(result.chunklist, chunklist)
+                    except OSError as err:
+                        staged[target] = err
+                        continue
+                    staged[target] = RecoveryResult(result.product, image, chunklist, resolved[target])
+                return staged
+
+            print(f'Resolved {len(targets)} targets to {len(groups)} distinct images.')
+            for staged in await asyncio.gather(*(stage(group) for group in groups.values())):
+                results.update(staged)
+            return results
+
+    results = asyncio.run(stage_all())
+    return {target: results[target] for target in targets}
 
 
 def action_selfcheck(args):
@@ -321,12 +967,12 @@ def action_selfcheck(args):
     """
 
     session = get_session(args)
-    valid_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_VALID, diag=False, os_type='default')
-    valid_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_VALID, diag=False, os_type='latest')
-    product_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_PRODUCT, diag=False, os_type='default')
-    product_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_PRODUCT, diag=False, os_type='latest')
-    generic_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='default')
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
+    valid_default = cached_image_info(session, bid=RECENT_MAC, mlb=MLB_VALID, diag=False, os_type='default')
+    valid_latest = cached_image_info(session, bid=RECENT_MAC, mlb=MLB_VALID, diag=False, os_type='latest')
+    product_default = cached_image_info(session, bid=RECENT_MAC, mlb=MLB_PRODUCT, diag=False, os_type='default')
+    product_latest = cached_image_info(session, bid=RECENT_MAC, mlb=MLB_PRODUCT, diag=False, os_type='latest')
+    generic_default = cached_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='default')
+    generic_latest = cached_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
 
     if args.verbose:
         print(valid_default)
@@ -371,10 +1017,10 @@ def action_verify(args):
     Try to verify MLB serial number.
     """
     session = get_session(args)
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
-    uvalid_default = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=False, os_type='default')
-    uvalid_latest = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=False, os_type='latest')
-    uproduct_default = get_image_info(session, bid=args.board_id, mlb=product_mlb(args.mlb), diag=False, os_type='default')
+    generic_latest = cached_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
+    uvalid_default = cached_image_info(session, bid=args.board_id, mlb=args.mlb, diag=False, os_type='default')
+    uvalid_latest = cached_image_info(session, bid=args.board_id, mlb=args.mlb, diag=False, os_type='latest')
+    uproduct_default = cached_image_info(session, bid=args.board_id, mlb=product_mlb(args.mlb), diag=False, os_type='default')
 
     if args.verbose:
         print(generic_latest)
@@ -401,13 +1047,46 @@ def action_verify(args):
     return 0
 
 
+async def guess_model(client, model, version, mlb, generic_latest, limiter):
+    """
+    Check a single board for action_guess, returning (supported entry or None, warning or None).
+    """
+
+    try:
+        if mlb.startswith('000'):
+            # For anonymous lookup check when given model does not match latest.
+            model_latest = await client.cached_image_info(model, MLB_ZERO, False, 'latest', limiter)
+
+            if model_latest[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
+                if version == 'current':
+                    return None, f'WARN: Skipped {model} due to using latest product {model_latest[INFO_PRODUCT]} instead of {generic_latest[INFO_PRODUCT]}'
+                return None, None
+
+            user_default = await client.cached_image_info(model, mlb, False, 'default', limiter)
+
+            if user_default[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
+                return [version, user_default[INFO_PRODUCT], generic_latest[INFO_PRODUCT]], None
+        else:
+            # For normal lookup check when given model has mismatching normal and latest.
+            user_latest = await client.cached_image_info(model, mlb, False, 'latest', limiter)
+
+            user_default = await client.cached_image_info(model, mlb, False, 'default', limiter)
+
+            if user_latest[INFO_PRODUCT] != user_default[INFO_PRODUCT]:
+                return [version, user_default[INFO_PRODUCT], user_latest[INFO_PRODUCT]], None
+
+    except Exception as e:
+        return None, f'WARN: Failed to check {model}, exception: {e}'
+
+    return None, None
+
+
 def action_guess(args):
     """
     Attempt to guess which model does this MLB belong.
     """
 
     mlb = args.mlb
-    anon = mlb.startswith('000')
 
     with open(args.board_db, 'r', encoding='utf-8') as fh:
         db = json.load(fh)
@@ -416,38 +1095,22 @@ def action_guess(args):
 
     session = get_session(args)
 
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
-
-    for model in db:
-        try:
-            if anon:
-                # For anonymous lookup check when given model does not match latest.
-                model_latest = get_image_info(session, bid=model, mlb=MLB_ZERO, diag=False, os_type='latest')
-
-                if model_latest[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
-                    if db[model] == 'current':
-                        print(f'WARN: Skipped {model} due to using latest product {model_latest[INFO_PRODUCT]} instead of {generic_latest[INFO_PRODUCT]}')
-                    continue
-
-                user_default = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='default')
-
-                if user_default[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
-                    supported[model] = [db[model], user_default[INFO_PRODUCT], generic_latest[INFO_PRODUCT]]
-            else:
-                # For normal lookup check when given model has mismatching normal and latest.
-                user_latest = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='latest')
-
-                user_default = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='default')
-
-                if user_latest[INFO_PRODUCT] != user_default[INFO_PRODUCT]:
-                    supported[model] = [db[model], user_default[INFO_PRODUCT], user_latest[INFO_PRODUCT]]
+    # Boards are checked concurrently on one event loop, but results are reported in board database order.
+    async def sweep():
+        async with AsyncRecoveryClient(args.jobs, sessions=session) as client:
+            generic_latest = await client.cached_image_info(RECENT_MAC, MLB_ZERO, False, 'latest')
+            limiter = RateLimiter(args.rate)
+            return await asyncio.gather(*(guess_model(client, model, db[model], mlb, generic_latest, limiter) for model in db))
 
-        except Exception as e:
-            print(f'WARN: Failed to check {model}, exception: {e}')
+    for model, (entry, warning) in zip(db, asyncio.run(sweep())):
+        if warning:
+            print(warning)
+        if entry:
+            supported[model] = entry
 
     if len(supported) > 0:
         print(f'SUCCESS: MLB {mlb} looks supported for:')
-        for model in supported.items():
+        for model in supported:
             print(f'- {model}, up to {supported[model][0]}, default: {supported[model][1]}, latest: {supported[model][2]}')
         return 0
 
@@ -455,7 +1118,7 @@ def action_guess(args):
     return None
 
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(description='Gather recovery information for Macs')
     parser.add_argument('action', choices=['download', 'selfcheck', 'verify', 'guess'],
                         help='Action to perform: "download" - performs recovery downloading,'
@@ -475,26 +1138,85 @@ def main():
                         help=f'use specified os type, defaults to default {MLB_ZERO}')
     parser.add_argument('-diag', '--diagnostics', action='store_true', help='download diagnostics image')
     parser.add_argument('-v', '--verbose', action='store_true', help='print debug information')
+    parser.add_argument('--no-resume', action='store_true', help='always download from scratch instead of resuming partial files')
+    parser.add_argument('--verify-after', action='store_true',
+                        help='verify the image by reading it back after downloading instead of while downloading')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='number of boards checked at the same time by guess, defaults to 8')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='maximum recovery server queries per second for guess, defaults to unlimited')
+    parser.add_argument('--recovery-url', type=str, default=RECOVERY_URL,
+                        help=f'use a different recovery server, defaults to {RECOVERY_URL}')
+    parser.add_argument('--cache-ttl', type=int, default=INFO_CACHE_TTL,
+                        help=f'seconds selfcheck, verify and guess reuse recovery server answers, 0 disables, defaults to {INFO_CACHE_TTL}')
+    parser.add_argument('--refresh', action='store_true', help='ignore cached recovery server answers and query again')
     parser.add_argument('-db', '--board-db', type=str, default=os.path.join(DATA_DIR, 'boards.json'),
                         help='use custom board list for checking, defaults to boards.json')
+    parser.add_argument('--lan-proxy', type=str, default='',
+                        help='download images through a DarwinFetch LAN proxy (main.py serve), e.g. http://10.0.0.2:8470')
+    return parser
+
 
-    args = parser.parse_args()
+def resolve_mlb(args):
+    """
+    Fill in args.mlb from args.code when one is given, raising RecoveryError for an unusable MLB.
+    """
 
     if args.code != '':
         args.mlb = mlb_from_eeee(args.code)
 
     if len(args.mlb) != 17:
-        print('ERROR: Cannot use MLBs in non 17 character format!')
+        raise RecoveryError('Cannot use MLBs in non 17 character format!')
+    return args
+
+
+def parse_command(command):
+    """
+    Parse the macrecovery arguments of a recovery source command for in-process use.
+    Raises RecoveryError on bad input instead of exiting like the command line does.
+    """
+
+    try:
+        args = build_parser().parse_args(shlex.split(command))
+    except (SystemExit, ValueError) as err:
+        raise RecoveryError(f'Invalid recovery command "{command}"') from err
+    return resolve_mlb(args)
+
+
+def main():
+    global RECOVERY_URL, info_cache
+
+    args = build_parser().parse_args()
+
+    RECOVERY_URL = args.recovery_url.rstrip('/')
+
+    try:
+        resolve_mlb(args)
+    except RecoveryError as e:
+        print(f'ERROR: {e}')
         sys.exit(1)
 
-    if args.action == 'download':
-        return action_download(args)
-    if args.action == 'selfcheck':
-        return action_selfcheck(args)
-    if args.action == 'verify':
-        return action_verify(args)
-    if args.action == 'guess':
-        return action_guess(args)
+    if args.cache_ttl > 0:
+        info_cache = InfoCache(ttl=args.cache_ttl, refresh=args.refresh)
+
+    if args.lan_proxy:
+        network.set_lan_proxy(args.lan_proxy)
+
+    try:
+        if args.action == 'download':
+            return action_download(args)
+        if args.action == 'selfcheck':
+            return action_selfcheck(args)
+        if args.action == 'verify':
+            return action_verify(args)
+        if args.action == 'guess':
+            return action_guess(args)
+    except RecoveryError as e:
+        print(f'ERROR: {e}')
+        return 1
+    finally:
+        if info_cache is not None:
+            info_cache.save()
 
     assert False
 
@@ -9,16 +9,25 @@
 
 import os
 import json
-import py7zr
+import cache
 import click
 import shutil
-import zipfile
-import hashlib
+import sources
 import platform
+import network
 import requests
+import integrity
 import subprocess
-from tqdm import tqdm
+import downloader
+import sucatalog
+import proxy
+import unpack
+import torrent
+import transfers
+import macrecovery
+from transfers import extract_filename_from_url
 from urllib.parse import unquote_plus
+import xml.etree.ElementTree as ElementTree
 
 # Function to determine the host operating system
 def get_host_os():
@@ -100,16 +109,34 @@ def toggle_bypass_update_check():
 
     print(f"Bypass Sources Update Check set to: {config['bypass_update_check']}")
 
+# Parsed config together with the (mtime, size) of the file it was read from
+_config_cache = None
+
 def load_config():
-    """Function to load the config from data/config.json."""
+    """Function to load the config from data/config.json, re-reading it only when the file changed."""
+    global _config_cache
+
     config_path = os.path.join("data", "config.json")
-    config = {"show_full_source_info": False, "show_beta_installers": False, "bypass_update_check": False}
+    config = {"show_full_source_info": False, "show_beta_installers": False, "bypass_update_check": False,
+              "download_segments": downloader.DEFAULT_SEGMENTS, "min_segment_size": downloader.DEFAULT_MIN_SEGMENT_SIZE,
+              "resume_downloads": True, "parallel_downloads": downloader.DEFAULT_PARALLEL_DOWNLOADS,
+              "http_pool_connections": network.DEFAULT_POOL_CONNECTIONS, "http_pool_maxsize": network.DEFAULT_POOL_MAXSIZE,
+              "http_retries": network.DEFAULT_RETRIES, "http_backoff": network.DEFAULT_BACKOFF,
+              "verify_integrity": True, "cache_enabled": True, "cache_dir": cache.DEFAULT_CACHE_DIR,
+              "cache_max_size": cache.DEFAULT_CACHE_MAX_SIZE, "bandwidth_limit": 0,
+              "disk_reserve": unpack.DEFAULT_DISK_RESERVE, "unpack_expansion": unpack.DEFAULT_EXPANSION, "torrent_max_peers": torrent.DEFAULT_MAX_PEERS,
+              "lan_proxy": "", "serve_allowed_hosts": [], "serve_revalidate_after": proxy.DEFAULT_REVALIDATE_AFTER}
 
     if os.path.exists(config_path):
-        with open(config_path, 'r') as file:
-            config = json.load(file)
+        signature = sources.file_signature(config_path)
+        if _config_cache is None or _config_cache[0] != signature:
+            with open(config_path, 'r') as file:
+                _config_cache = (signature, json.load(file))
 
-        print("Config loaded successfully.")
+            print("Config loaded successfully.")
+
+        # Hand out a copy so callers can change it before save_config
+        config = dict(_config_cache[1])
     else:
         print("Config file not found. Creating a new one.")
         save_config(config)
@@ -118,96 +145,100 @@ def load_config():
 
 def save_config(config):
     """Function to save the config to data/config.json."""
+    global _config_cache
+
     config_path = os.path.join("data", "config.json")
+    _config_cache = None
 
     with open(config_path, 'w') as file:
         json.dump(config, file, indent=4)
 
     print("Config saved successfully.")
 
-# Function to download a file from a given URL via HTTP/HTTPS
-def download_file(url, destination):
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Raise an HTTPError for bad responses
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024  # 1 KB
-        progress_bar = tqdm(total=total_size, unit='iB', unit_scale=True)
+# Function to queue the packages of an offline source
+def offline_jobs(source):
+    """Function to create the download folder of an offline source and return (folder_path, jobs), largest package first."""
+    folder_path = os.path.join("downloads", f"{source.get('version', 'Unknown Version')}_{source.get('build', 'Unknown Build')}")
+    os.makedirs(folder_path, exist_ok=True)
 
-        with open(destination, 'wb') as file:
-            for data in response.iter_content(block_size):
-                progress_bar.update(len(data))
-                file.write(data)
+    jobs = []
+    for package in sort_packages_by_size(source.get("packages", [])):
+        package_url = package.get("url", "Unknown URL")
+        package_filename = extract_filename_from_url(package_url)
+        package_destination = os.path.join(folder_path, package_filename)
 
-        progress_bar.close()
-        print(f"\nDownload completed. File saved to: {destination}")
+        print(f"Downloading: {package_filename}")
+        print(f"URL: {package_url}")
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error downloading file: {e}")
+        jobs.append((sources.package_mirrors(package), package_destination, package.get("size"), package.get("integrityDataURL")))
+
+    return folder_path, jobs
 
-# Function to extract the filename from a given URL
-def extract_filename_from_url(url):
-    """Extracts the filename from a given URL."""
-    return URLdec(os.path.basename(url))
+# Function to queue the packages of a PowerPC source
+def powerpc_jobs(source, config):
+    """Function to create the download folder of a PowerPC source and return (folder_path, backend, jobs), the backend picked by its method."""
+    folder_path = os.path.join("downloads", f"{source.get('version', 'Unknown Version')}_{source.get('build', 'Unknown Build')}")
+    os.makedirs(folder_path, exist_ok=True)
+
+    backend = transfers.get_backend(source.get("method"), config)
+    return folder_path, backend, backend.jobs(source, folder_path)
 
 # Function to sort packages by size
 def sort_packages_by_size(packages):
     """Sorts the packages by size in descending order."""
     return sorted(packages, key=lambda x: x.get("size", 0), reverse=True)
 
-def pycheck():
-    """Function to check if python3 is available, otherwise fallback to python."""
+# Function to download a recovery image in-process from a source's macrecovery command
+def recovery_download(command):
+    """Function to run a macrecovery download without a subprocess, returning its RecoveryResult or None when it failed."""
     try:
-        # Try running python3 to see if it's available
-        os.system("python3 -V")
-        return "python3"
-    except Exception:
-        # If python3 is not available, use python
-        return "python"
-
-# Function to unpack files in a given folder
-def unpacker(folder_path):
-    """Function to unpack .7z and .zip files in a given folder and delete them after unpacking."""
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            # Skip hidden files (e.g., .DS_Store)
-            if file.startswith('.'):
-                continue
-            
-            file_path = os.path.join(root, file)
-            extraction_path = os.path.splitext(file_path)[0]
+        args = macrecovery.parse_command(command)
+    except macrecovery.RecoveryError as e:
+        # Bad input must not take the whole menu down with it
+        print(f"Cannot run this source's command: {e}")
+        return None
 
-            # Create a directory for extraction
-            os.makedirs(extraction_path, exist_ok=True)
-
-            try:
-                if file.endswith(".zip"):
-                    # Unpack .zip file using zipfile
-                    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                        zip_ref.extractall(extraction_path)
-
-                elif file.endswith(".7z"):
-                    # Unpack .7z file using py7zr
-                    with py7zr.SevenZipFile(file_path, mode='r') as z:
-                        z.extractall(extraction_path)
-
-                # Remove the original file after unpacking
-                os.remove(file_path)
-
-                print(f"Successfully unpacked: {file}")
-
-            except zipfile.BadZipFile:
-                print(f"Error: {file} is not a valid zip file.")
-            except py7zr.exceptions.Bad7zFile:
-                print(f"Error: {file} is not a valid 7z file.")
-            except Exception as e:
-                print(f"Error unpacking {file}: {e}")
-
-@click.command()
-def main():
+    try:
+        return macrecovery.download_recovery(args.board_id, args.mlb, args.os_type, args.diagnostics, args.outdir, args.basename,
+                                             not args.no_resume, args.verify_after, args.verbose)
+    except macrecovery.VerificationError as e:
+        print(f"Image verification failed for {args.board_id}: {e}")
+    except macrecovery.RecoveryError as e:
+        print(f"Recovery server error for {args.board_id}: {e}")
+    except requests.exceptions.RequestException as e:
+        print(f"Error downloading recovery for {args.board_id}: {e}")
+    except OSError as e:
+        # Disk full or an unwritable outdir
+        print(f"Error saving recovery for {args.board_id}: {e}")
+    return None
+
+# Function to download archives and unpack each one as soon as it is complete
+def download_and_unpack(batches, config, folder_path, workers=None):
+    """Function to run (backend, jobs) batches, extracting every finished download while the next ones are still running, returning True when all downloads succeeded."""
+    extractor = unpack.ArchiveExtractor(folder_path, workers)
+    # Hold new downloads back until they fit on disk together with everything they unpack to
+    guard = unpack.DiskGuard(folder_path, extractor, config.get("disk_reserve", unpack.DEFAULT_DISK_RESERVE),
+                             config.get("unpack_expansion", unpack.DEFAULT_EXPANSION))
+    try:
+        success = all([backend.download(jobs, guard.wait, guard.submit) for backend, jobs in batches])
+    finally:
+        print(f"Unpacking files downloaded to {folder_path}...")
+        extractor.wait()
+    return success
+
+@click.group(invoke_without_command=True)
+@click.option("--parallel", type=int, default=None, help="Files downloaded at the same time across all targets, defaults to parallel_downloads.")
+@click.option("--limit-rate", default=None, help="Combined bandwidth cap for all downloads, e.g. 500K, 20M or 1G per second.")
+@click.pass_context
+def main(ctx, parallel, limit_rate):
     """Main entry point for DarwinFetch."""
+    if ctx.invoked_subcommand is not None:
+        ctx.obj = {"parallel": parallel, "limit_rate": limit_rate}
+        return
+
     print("Loading configuration!")
     config = load_config()
+    network.configure_from_config(config)
 
     # Create the 'downloads' directory if it doesn't exist
     os.makedirs("downloads", exist_ok=True)
@@ -221,9 +252,10 @@ def main():
         print("1. Download Offline Installer")
         print("2. Download RecoveryOS Installer")
         print("3. Download PowerPC Installer")
-        print("4. Update Sources")
-        print("5. Settings")
-        print("6. Exit")
+        print("4. Verify Offline Installer")
+        print("5. Update Sources")
+        print("6. Settings")
+        print("7. Exit")
 
         choice = click.prompt("Enter your choice", type=int)
 
@@ -234,10 +266,12 @@ def main():
         elif choice == 3:
             download_powerpc_installer()
         elif choice == 4:
-            update_sources()
+            verify_offline_menu()
         elif choice == 5:
-            settings_menu()
+            update_sources()
         elif choice == 6:
+            settings_menu()
+        elif choice == 7:
             print("Exiting. Goodbye!")
             break
         else:
@@ -274,13 +308,10 @@ def download_offline_installer():
         # Convert the user input to an integer
         choice = int(choice)
 
-        # Read offline sources from the JSON file
-        sources_file_path = os.path.join("data", "offline_sources.json")
-
-        if os.path.exists(sources_file_path):
-            with open(sources_file_path, 'r') as file:
-                sources_data = json.load(file)
+        # Look up offline sources in the catalog
+        sources_data = sources.load_sources("offline")
 
+        if sources_data is not None:
             # Validate the user's choice
             if 1 <= choice <= len(sources_data):
                 selected_source = sources_data[choice - 1]
@@ -295,31 +326,12 @@ def download_offline_installer():
 
                 print(f"\nSelected Source: {name} {version} ({build}) - {identifier} ({date})")
 
-                # Create a new folder in 'downloads' based on version and build
-                folder_name = f"{version}_{build}"
-                folder_path = os.path.join("downloads", folder_name)
-                os.makedirs(folder_path, exist_ok=True)
+                if selected_source.get("packages"):
+                    # Queue each package for the created folder, largest first
+                    folder_path, jobs = offline_jobs(selected_source)
 
-                # Get the packages from the selected source
-                packages = selected_source.get("packages", [])
-
-                if packages:
-                    # Sort packages by size in descending order
-                    sorted_packages = sort_packages_by_size(packages)
-
-                    # Download each package into the created folder
-                    for package in sorted_packages:
-                        package_url = package.get("url", "Unknown URL")
-                        package_filename = extract_filename_from_url(package_url)
-                        package_destination = os.path.join(folder_path, package_filename)
-
-                        print(f"Downloading: {package_filename}")
-                        print(f"URL: {package_url}")
-
-                        # Download the package file
-                        download_file(package_url, package_destination)
-
-                        print(f"Downloaded to: {package_destination}")
+                    # Download the package files concurrently
+                    transfers.download_files(jobs, config)
                 else:
                     print("No packages available for this source.")
             else:
@@ -330,6 +342,272 @@ def download_offline_installer():
     except ValueError:
         print("Invalid input. Please enter a valid source number or 'c' to cancel.")
 
+# Function to verify the packages of an offline installer that are already on disk
+def verify_offline_installer(source, folder_path):
+    """Function to check every package of an offline source in folder_path against its integrity data."""
+    all_valid = True
+
+    for package in sort_packages_by_size(source.get("packages", [])):
+        package_filename = extract_filename_from_url(package.get("url", "Unknown URL"))
+        package_path = os.path.join(folder_path, package_filename)
+        integrity_url = package.get("integrityDataURL")
+
+        if not os.path.exists(package_path):
+            print(f"Missing: {package_filename}")
+            all_valid = False
+            continue
+
+        if not integrity_url:
+            print(f"Skipped: {package_filename} has no integrity data")
+            continue
+
+        try:
+            integrity.verify_file(package_path, integrity.fetch_integrity_data(integrity_url))
+            print(f"Verified: {package_filename}")
+        except integrity.IntegrityError as e:
+            print(f"Failed: {e}")
+            all_valid = False
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching integrity data for {package_filename}: {e}")
+            all_valid = False
+
+    return all_valid
+
+def verify_offline_menu():
+    """Function to handle verifying a downloaded Offline Installer."""
+    clear_screen()
+
+    config = load_config()
+    parse_offline_sources(config)
+
+    # Get user input to choose a source
+    choice = click.prompt("Enter the number of the source to verify (or 'c' to cancel)", type=str)
+
+    # Check if the user wants to cancel
+    if choice.lower() == 'c':
+        print("Verification canceled.")
+        return
+
+    try:
+        choice = int(choice)
+
+        sources_data = sources.load_sources("offline") or []
+
+        if 1 <= choice <= len(sources_data):
+            selected_source = sources_data[choice - 1]
+            folder_name = f"{selected_source.get('version')}_{selected_source.get('build')}"
+            verify_offline_installer(selected_source, os.path.join("downloads", folder_name))
+        else:
+            print("Invalid choice. Please enter a valid source number.")
+
+    except ValueError:
+        print("Invalid input. Please enter a valid source number or 'c' to cancel.")
+
+@main.command()
+@click.option("--build", required=True, help="Build of the offline installer to verify, e.g. 23F5059e.")
+@click.option("--folder", default=None, help="Folder holding the packages, defaults to downloads/<version>_<build>.")
+def verify(build, folder):
+    """Verify downloaded offline installer packages against Apple's integrity data."""
+    catalog = sources.get_catalog("offline")
+    source = catalog.find_build(build) if catalog is not None else None
+    if source is None:
+        raise click.ClickException(f"No offline source with build {build}.")
+
+    folder_path = folder or os.path.join("downloads", f"{source.get('version')}_{build}")
+    if not verify_offline_installer(source, folder_path):
+        raise SystemExit(1)
+
+@main.command()
+@click.option("--catalog", default=sucatalog.DEFAULT_CATALOG_URL, show_default=True, help="Software update catalog to read, a URL or a local file.")
+@click.option("--output", default=sources.local_source_path("offline"), show_default=True, help="File the ingested offline sources are kept in, listed together with the upstream ones.")
+@click.option("--replace", is_flag=True, help="Replace the file instead of merging into it.")
+def ingest(catalog, output, replace):
+    """Build offline sources directly from an Apple software update catalog."""
+    network.configure_from_config(load_config())
+
+    try:
+        entries = sucatalog.ingest_catalog(catalog)
+    except (OSError, requests.exceptions.RequestException, ElementTree.ParseError) as e:
+        raise click.ClickException(f"Error reading catalog: {e}")
+
+    if not replace and os.path.exists(output):
+        with open(output, 'r') as file:
+            entries = sources.merge_entries(json.load(file), entries)
+
+    # The upstream offline sources file is left alone, so update checks keep matching it
+    sources.write_atomic(output, json.dumps(entries, indent=2, sort_keys=True).encode('utf-8'))
+    print(f"Wrote {len(entries)} ingested offline sources to {output}.")
+
+# Function to turn a size such as 20M into bytes
+def parse_size(text):
+    """Function to parse a byte count with an optional K, M or G suffix (powers of 1024)."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper().rstrip("B")
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise click.BadParameter(f"Invalid size: {text}")
+
+# Function to load the config of a subcommand with the global options applied
+def command_config(ctx):
+    """Function to return the config with --parallel and --limit-rate applied and configure the shared scheduler."""
+    config = load_config()
+    options = ctx.find_root().obj or {}
+
+    if options.get("parallel"):
+        config["parallel_downloads"] = options["parallel"]
+    if options.get("limit_rate"):
+        config["bandwidth_limit"] = parse_size(options["limit_rate"])
+
+    network.configure_from_config(config)
+    return config
+
+# Function to select sources by build for a subcommand
+def select_sources(source_type, builds, all_non_beta):
+    """Function to return the entries matching builds, plus every non-beta entry when all_non_beta is set."""
+    catalog = sources.get_catalog(source_type)
+    if catalog is None:
+        raise click.ClickException(f"No {source_type} sources found, run the update first.")
+
+    selected = []
+    for build in builds:
+        source = catalog.find_build(build)
+        if source is None:
+            raise click.ClickException(f"No {source_type} source with build {build}.")
+        selected.append(source)
+    if all_non_beta:
+        selected.extend(source for source in catalog.by_beta[False] if source not in selected)
+
+    if not selected:
+        raise click.ClickException("Nothing to fetch, pass --build or --all-non-beta.")
+    return selected
+
+@main.command(name="list")
+@click.option("--type", "source_type", type=click.Choice(list(sources.SOURCES)), default="offline", show_default=True, help="Sources to list.")
+@click.option("--beta/--no-beta", default=None, help="Only list beta, or only non-beta, sources.")
+@click.option("--json", "as_json", is_flag=True, help="Print the matching entries as JSON.")
+def list_sources(source_type, beta, as_json):
+    """List available sources without the interactive menu."""
+    catalog = sources.get_catalog(source_type)
+    if catalog is None:
+        raise click.ClickException(f"No {source_type} sources found, run the update first.")
+
+    entries = catalog.entries if beta is None else catalog.by_beta[beta]
+    if as_json:
+        print(json.dumps(entries, indent=2))
+        return
+
+    for entry in entries:
+        beta_label = " (beta)" if entry.get("beta") else ""
+        print(f"{entry.get('build', ''):<12} {entry.get('version', ''):<10} {entry.get('name', '')}{beta_label} {entry.get('date', '')}".rstrip())
+
+@main.command()
+@click.option("--build", "builds", multiple=True, help="Build to fetch, can be given several times.")
+@click.option("--all-non-beta", is_flag=True, help="Fetch every non-beta build.")
+@click.option("--type", "source_type", type=click.Choice(["offline", "powerpc"]), default="offline", show_default=True, help="Sources to fetch from.")
+@click.pass_context
+def fetch(ctx, builds, all_non_beta, source_type):
+    """Download installers by build through one shared download scheduler."""
+    config = command_config(ctx)
+    selected = select_sources(source_type, builds, all_non_beta)
+
+    # Every package of every target goes into one queue per transfer backend, so --parallel caps the whole run
+    jobs = []
+    batches = {}
+    for source in selected:
+        print(f"\nQueued: {source.get('name')} {source.get('version')} ({source.get('build')})")
+        if source_type == "offline":
+            jobs.extend(offline_jobs(source)[1])
+            continue
+        try:
+            _, backend, source_jobs = powerpc_jobs(source, config)
+        except transfers.TransferError as e:
+            raise click.ClickException(str(e))
+        batches.setdefault(backend.method, (backend, []))[1].extend(source_jobs)
+
+    if source_type == "powerpc":
+        # Archives of every target are unpacked while the rest are still downloading
+        success = download_and_unpack(list(batches.values()), config, "downloads")
+    else:
+        success = transfers.download_files(jobs, config)
+
+    if not success:
+        raise SystemExit(1)
+
+@main.command()
+@click.option("--board", "boards", multiple=True, help="Board ID to fetch recovery for, can be given several times.")
+@click.option("--all-boards", is_flag=True, help="Fetch recovery for every board in data/boards.json.")
+@click.option("--build", "builds", multiple=True, help="Recovery source build to fetch, can be given several times.")
+@click.option("--os-type", type=click.Choice(["default", "latest"]), default="latest", show_default=True, help="Recovery image requested for board targets.")
+@click.option("--outdir", default=os.path.join("downloads", "recovery"), show_default=True, help="Folder for board targets, one subfolder per board.")
+@click.option("--jobs", type=int, default=8, show_default=True, help="Recovery server queries made at the same time.")
+@click.pass_context
+def recovery(ctx, boards, all_boards, builds, os_type, outdir, jobs):
+    """Download recovery images for many boards or builds, fetching each distinct image once."""
+    config = command_config(ctx)
+
+    if all_boards:
+        with open(os.path.join("data", "boards.json"), 'r') as file:
+            boards = list(boards) + list(json.load(file))
+
+    targets = []
+    for board in boards:
+        board_dir = os.path.join(outdir, board, "com.apple.recovery.boot")
+        targets.append((board, macrecovery.RecoveryTarget(board, os_type, board_dir)))
+    if builds:
+        for source in select_sources("recovery", builds, False):
+            try:
+                args = macrecovery.parse_command(source.get("command", ""))
+            except macrecovery.RecoveryError as e:
+                raise click.ClickException(f"Recovery source {source.get('build')}: {e}")
+            targets.append((source.get("build"), macrecovery.RecoveryTarget(args.board_id, args.os_type, args.outdir, args.mlb, args.diagnostics)))
+    if not targets:
+        raise click.ClickException("Nothing to fetch, pass --board, --all-boards or --build.")
+
+    # Boards sharing an image hash download it once, the rest get links to it
+    parallel = config.get("parallel_downloads", downloader.DEFAULT_PARALLEL_DOWNLOADS)
+    results = macrecovery.download_recovery_batch([target for _, target in targets], config.get("resume_downloads", True), jobs=jobs, downloads=parallel)
+
+    failed = False
+    for name, target in targets:
+        result = results[target]
+        if isinstance(result, Exception):
+            failed = True
+            print(f"{name}: failed ({result})")
+        else:
+            print(f"{name}: {result.image}")
+    if failed:
+        raise SystemExit(1)
+
+@main.command()
+@click.option("--host", default=proxy.DEFAULT_HOST, show_default=True, help="Address to listen on.")
+@click.option("--port", type=int, default=proxy.DEFAULT_PORT, show_default=True, help="Port to listen on.")
+@click.option("--allow-host", "allowed_hosts", multiple=True, help="Extra upstream host to serve besides Apple's, can be given several times.")
+@click.pass_context
+def serve(ctx, host, port, allowed_hosts):
+    """Share downloads with the network as a caching proxy, clients point lan_proxy at it."""
+    config = command_config(ctx)
+    # The proxy itself always goes upstream directly
+    network.set_lan_proxy(None)
+    download_cache = cache.DownloadCache(config.get("cache_dir", cache.DEFAULT_CACHE_DIR), config.get("cache_max_size", cache.DEFAULT_CACHE_MAX_SIZE))
+    hosts = proxy.DEFAULT_ALLOWED_HOSTS + tuple(config.get("serve_allowed_hosts", [])) + allowed_hosts
+
+    try:
+        server = proxy.ProxyServer((host, port), download_cache, hosts, config.get("serve_revalidate_after", proxy.DEFAULT_REVALIDATE_AFTER))
+    except OSError as e:
+        raise click.ClickException(f"Cannot listen on {host}:{port}: {e}")
+
+    print(f"Serving downloads from {', '.join(hosts)} on http://{host}:{port}/")
+    print("Set \"lan_proxy\" to this host's address and port in data/config.json on the clients. Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nProxy stopped.")
+    finally:
+        server.server_close()
+
 def download_recovery_installer():
     """Function to handle downloading the RecoveryOS Installer."""
     clear_screen()
@@ -357,13 +635,10 @@ def download_recovery_installer():
         # Convert the user input to an integer
         choice = int(choice)
 
-        # Read recovery sources from the JSON file
-        sources_file_path = os.path.join("data", "recovery_sources.json")
-
-        if os.path.exists(sources_file_path):
-            with open(sources_file_path, 'r') as file:
-                sources_data = json.load(file)
+        # Look up recovery sources in the catalog
+        sources_data = sources.load_sources("recovery")
 
+        if sources_data is not None:
             # Validate the user's choice
             if 1 <= choice <= len(sources_data):
                 selected_source = sources_data[choice - 1]
@@ -376,16 +651,14 @@ def download_recovery_installer():
 
                 print(f"\nSelected Source: {name} {version} ({build}) - {identifier}")
 
-                # Run the macrecovery.py script with the provided command
+                # Run the macrecovery download in-process with the provided command
                 command = selected_source.get("command", "")
                 if command:
                     print(f"Running command: {command}")
 
-                     # Determine the Python command using pycheck
-                    python_command = pycheck()
-
-                    # Execute the command
-                    os.system(f"{python_command} src/macrecovery.py {command}")
+                    result = recovery_download(command)
+                    if result is not None:
+                        print(f"Recovery image saved to: {result.image}")
 
                     print("Command execution completed.")
                 else:
@@ -425,13 +698,10 @@ def download_powerpc_installer():
         # Convert the user input to an integer
         choice = int(choice)
 
-        # Read PowerPC sources from the JSON file
-        sources_file_path = os.path.join("data", "ppc_sources.json")
-
-        if os.path.exists(sources_file_path):
-            with open(sources_file_path, 'r') as file:
-                sources_data = json.load(file)
+        # Look up PowerPC sources in the catalog
+        sources_data = sources.load_sources("powerpc")
 
+        if sources_data is not None:
             # Validate the user's choice
             if 1 <= choice <= len(sources_data):
                 selected_source = sources_data[choice - 1]
@@ -445,33 +715,15 @@ def download_powerpc_installer():
                 print(f"\nSelected Source: {name} {version} ({build}) - {identifier}")
 
                 if packages:
-                    # Create a folder to save the downloaded files
-                    folder_name = f"{version}_{build}"
-                    folder_path = os.path.join("downloads", folder_name)
-                    os.makedirs(folder_path, exist_ok=True)
+                    # Create a folder to save the downloaded files and queue every package on the source's transfer method
+                    try:
+                        folder_path, backend, jobs = powerpc_jobs(selected_source, config)
+                    except transfers.TransferError as e:
+                        print(e)
+                        return
 
-                    for package in packages:
-                        package_name = package.get("name", "Unknown Package")
-                        package_url = package.get("url")
-
-                        if package_url:
-                            # Extract filename from package URL
-                            filename = extract_filename_from_url(package_url)
-
-                            # Print initialization text
-                            print(f"\nInitializing download of {package_name}")
-
-                            # Construct destination path
-                            destination = os.path.join(folder_path, filename)
-
-                            # Download the package file
-                            download_file(package_url, destination)
-                        else:
-                            print(f"No URL found for package: {package_name}")
-
-                    # Begin cleaning folder for downloaded files                    
-                    print(f"Unpacking files downloaded from sources...")
-                    unpacker(folder_path)
+                    # Download the package files, unpacking each one while the next downloads
+                    download_and_unpack([(backend, jobs)], config, folder_path)
 
                 else:
                     print("No packages available for this source.")
@@ -484,6 +736,20 @@ def download_powerpc_installer():
     except ValueError:
         print("Invalid input. Please enter a valid source number or 'c' to cancel.")
 
+# Function to drop cached packages a source update stopped publishing
+@sources.on_change
+def invalidate_download_cache(delta):
+    """Function to remove the download cache entries of the package URLs a SourceDelta removed or changed."""
+    config = load_config()
+    stale = delta.stale_urls()
+    if not stale or not config.get("cache_enabled", True):
+        return
+
+    download_cache = cache.DownloadCache(config.get("cache_dir", cache.DEFAULT_CACHE_DIR), config.get("cache_max_size", cache.DEFAULT_CACHE_MAX_SIZE))
+    dropped = download_cache.discard_urls(stale)
+    if dropped:
+        print(f"Dropped {dropped} cached packages no longer published by the {delta.source_type} sources.")
+
 # Function to update sources
 def update_sources():
     """Function to handle updating sources."""
@@ -495,73 +761,30 @@ def update_sources():
     if config["bypass_update_check"]:
         print("Bypassing sources update check as per settings.")
     else:
-        # Perform the update check
-        # URL for the offline, recovery, and PowerPC sources JSON files
-        offline_sources_url = "https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/offline_sources.json"
-        recovery_sources_url = "https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/recovery_sources.json"
-        powerpc_sources_url = "https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/ppc_sources.json"
-
-        # Check if offline source needs updating
-        offline_destination = os.path.join("data", "offline_sources.json")
-        if not check_sources("offline"):
-            download_file(offline_sources_url, offline_destination)
-            print(f"Offline sources updated. File saved to {offline_destination}.")
-        else:
-            print("Offline sources are already up to date.")
+        # Only sources that changed upstream are downloaded, unchanged ones cost a single 304
+        for source_type, label in [("offline", "Offline"), ("recovery", "Recovery"), ("powerpc", "PowerPC")]:
+            try:
+                delta = sources.update_source(source_type)
+                if delta:
+                    print(f"{label} sources updated ({delta.summary()}). File saved to {sources.source_path(source_type)}.")
+                else:
+                    print(f"{label} sources are already up to date.")
+            except requests.exceptions.RequestException as e:
+                print(f"Error updating {label.lower()} sources: {e}")
 
-        # Check if recovery source needs updating
-        recovery_destination = os.path.join("data", "recovery_sources.json")
-        if not check_sources("recovery"):
-            download_file(recovery_sources_url, recovery_destination)
-            print(f"Recovery sources updated. File saved to {recovery_destination}.")
-        else:
-            print("Recovery sources are already up to date.")
-        
-        # Check if PowerPC source needs updating
-        powerpc_destination = os.path.join("data", "ppc_sources.json")
-        if not check_sources("powerpc"):
-            download_file(powerpc_sources_url, powerpc_destination)
-            print(f"PowerPC sources updated. File saved to {powerpc_destination}.")
-        else:
-            print("PowerPC sources are already up to date.")
+    # Precompile the sources so listing and downloading skip the JSON parse, unchanged sources are kept as they are
+    sources.compile_index()
+    print("Sources index compiled.")
 
 # Function to check if the local source file matches the remote source file
 def check_sources(source_type):
     """Function to check if the local source file matches the remote source file."""
-    # URL for the source JSON file
-    source_url = None
-    local_destination = None
-    if source_type == "offline":
-        source_url = "https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/offline_sources.json"
-        local_destination = os.path.join("data", "offline_sources.json")
-    elif source_type == "recovery":
-        source_url = "https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/recovery_sources.json"
-        local_destination = os.path.join("data", "recovery_sources.json")
-    elif source_type == "powerpc":
-        source_url = "https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/ppc_sources.json"
-        local_destination = os.path.join("data", "ppc_sources.json")
-    else:
+    if source_type not in sources.SOURCES:
         print("Invalid source type.")
         return False
 
     try:
-        # Check if the local file exists
-        if not os.path.exists(local_destination):
-            return False
-
-        # Download the remote source file temporarily
-        response = requests.get(source_url, stream=True)
-        response.raise_for_status()
-
-        # Calculate SHA-256 hash of the downloaded content
-        remote_hash = hashlib.sha256(response.content).hexdigest()
-
-        # Calculate SHA-256 hash of the local source file
-        with open(local_destination, 'rb') as local_file:
-            local_hash = hashlib.sha256(local_file.read()).hexdigest()
-
-        # Compare hashes and return the result
-        return remote_hash == local_hash
+        return sources.check_source(source_type)
 
     except requests.exceptions.RequestException as e:
         print(f"Error checking source: {e}")
@@ -599,13 +822,10 @@ def parse_offline_sources(config):
     """Function to parse and display sources."""
     print("Available Sources:")
 
-    # Read sources from the JSON file
-    sources_file_path = os.path.join("data", "offline_sources.json")
-
-    if os.path.exists(sources_file_path):
-        with open(sources_file_path, 'r') as file:
-            sources_data = json.load(file)
+    # Look up sources in the catalog
+    sources_data = sources.load_sources("offline")
 
+    if sources_data is not None:
         # Iterate over each entry and display the information
         for index, source in enumerate(sources_data, start=1):
             name = source.get("name", "Unknown Name")
@@ -655,13 +875,10 @@ def parse_recovery_sources(config):
     """Function to parse and display recoveryOS sources."""
     print("Available Sources:")
 
-    # Read sources from the JSON file
-    sources_file_path = os.path.join("data", "recovery_sources.json")
-
-    if os.path.exists(sources_file_path):
-        with open(sources_file_path, 'r') as file:
-            sources_data = json.load(file)
+    # Look up sources in the catalog
+    sources_data = sources.load_sources("recovery")
 
+    if sources_data is not None:
         # Iterate over each entry and display the information
         for index, source in enumerate(sources_data, start=1):
             name = source.get("name", "Unknown Name")
@@ -693,13 +910,10 @@ def parse_powerpc_sources(config):
     """Function to parse and display PowerPC sources."""
     print("Available PowerPC Sources:")
 
-    # Read sources from the JSON file
-    sources_file_path = os.path.join("data", "ppc_sources.json")
-
-    if os.path.exists(sources_file_path):
-        with open(sources_file_path, 'r') as file:
-            sources_data = json.load(file)
+    # Look up sources in the catalog
+    sources_data = sources.load_sources("powerpc")
 
+    if sources_data is not None:
         # Iterate over each entry and display the information
         for index, source in enumerate(sources_data, start=1):
             name = source.get("name", "Unknown Name")
@@ -0,0 +1,265 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Mirror selection, failover and health statistics for package downloads
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import json
+import time
+import network
+import requests
+import threading
+from tqdm import tqdm
+from collections import namedtuple
+from urllib.parse import urlparse
+from journal import validator_from_headers
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Health statistics of every mirror host, kept between runs
+STATS_PATH = os.path.join("data", "mirror_stats.json")
+
+# Bytes read from each mirror to estimate its throughput
+PROBE_SIZE = 256 * 1024  # 256 KB
+
+# Timeout (connect, read) in seconds for a mirror probe
+PROBE_TIMEOUT = (5, 10)
+
+# Seconds the other probes may still take once the first mirror answered
+PROBE_GRACE = 2
+
+# Weight of a new sample in the latency and throughput moving averages
+SMOOTHING = 0.3
+
+# A transfer below STALL_RATE for STALL_WINDOW seconds moves to the next mirror
+STALL_RATE = 64 * 1024  # 64 KB/s
+STALL_WINDOW = 10
+
+# Seconds during which a mirror that failed is ranked after every healthy one
+FAILURE_PENALTY = 15 * 60
+
+# Outcome of probing one mirror
+ProbeResult = namedtuple("ProbeResult", ["url", "size", "accepts_ranges", "validator", "latency", "throughput"])
+
+class MirrorStalled(requests.exceptions.RequestException):
+    """Raised when a mirror delivers too slowly while another mirror could take over."""
+
+# Function to get the host a mirror statistic is kept for
+def mirror_host(url):
+    """Function to return the lowercase host[:port] of a URL."""
+    return urlparse(url).netloc.lower()
+
+class MirrorStats:
+    """Moving averages of the latency and throughput of each mirror host, with success and failure counts."""
+
+    def __init__(self, path=STATS_PATH):
+        self.path = path
+        self.hosts = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Function to read the statistics on first use, starting empty when the file is missing or damaged."""
+        if self.hosts is None:
+            try:
+                with open(self.path, 'r') as file:
+                    self.hosts = json.load(file)
+            except (OSError, ValueError):
+                self.hosts = {}
+        return self.hosts
+
+    def entry(self, url):
+        """Function to return the statistics of a URL's host, creating them when unknown."""
+        return self.load().setdefault(mirror_host(url), {"latency": None, "throughput": None, "successes": 0, "failures": 0, "last_failure": 0})
+
+    def record(self, url, size, seconds, latency=None):
+        """Function to fold a finished transfer of size bytes in seconds into the averages of its host."""
+        with self.lock:
+            entry = self.entry(url)
+            if size > 0 and seconds > 0:
+                rate = size / seconds
+                entry["throughput"] = rate if entry["throughput"] is None else (1 - SMOOTHING) * entry["throughput"] + SMOOTHING * rate
+            if latency is not None:
+                entry["latency"] = latency if entry["latency"] is None else (1 - SMOOTHING) * entry["latency"] + SMOOTHING * latency
+            entry["successes"] += 1
+
+    def failure(self, url):
+        """Function to count a failed or stalled transfer against a URL's host."""
+        with self.lock:
+            entry = self.entry(url)
+            entry["failures"] += 1
+            entry["last_failure"] = time.time()
+
+    def rank_key(self, url):
+        """Function to return a sort key putting healthy, fast, responsive hosts first."""
+        with self.lock:
+            entry = self.entry(url)
+            failed_recently = time.time() - entry["last_failure"] < FAILURE_PENALTY
+            return (failed_recently, -(entry["throughput"] or 0), entry["latency"] or float('inf'))
+
+    def save(self):
+        """Function to atomically write the statistics to disk."""
+        with self.lock:
+            if self.hosts is None:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w') as file:
+                json.dump(self.hosts, file, indent=4)
+            os.replace(temp_path, self.path)
+
+# Statistics shared by every download of the process
+stats = MirrorStats()
+
+class MirrorSet:
+    """Mirrors of one file in order of preference, moving on to the next one when the current one fails or stalls."""
+
+    def __init__(self, urls, validators=None, key=None):
+        self.urls = list(urls)
+        self.validators = validators or {}
+        # Resume journals and the download cache identify the file by its primary URL
+        self.key = key or self.urls[0]
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        """Function to return the mirror transfers should use now."""
+        with self.lock:
+            return self.urls[self.index]
+
+    def alternatives(self):
+        """Function to return True when there is another mirror to switch to."""
+        return len(self.urls) > 1
+
+    def timeout(self, default):
+        """Function to return the request timeout, shortening the read timeout so a dead mirror is left quickly."""
+        if self.alternatives():
+            return (default[0], min(default[1], STALL_WINDOW))
+        return default
+
+    def validator(self, url):
+        """Function to return the ETag or Last-Modified a mirror sent for the file."""
+        return self.validators.get(url)
+
+    def failed(self, url):
+        """Function to record a failure of url and switch to the next mirror when url is still the current one."""
+        stats.failure(url)
+        with self.lock:
+            if not self.alternatives() or self.urls[self.index] != url:
+                return
+            self.index = (self.index + 1) % len(self.urls)
+            next_url = self.urls[self.index]
+        tqdm.write(f"Switching {os.path.basename(urlparse(self.key).path)} from {mirror_host(url)} to {mirror_host(next_url)}.")
+
+class StallWatch:
+    """Tracks the rate of one transfer and raises MirrorStalled when it stays below STALL_RATE for STALL_WINDOW seconds."""
+
+    def __init__(self, url):
+        self.url = url
+        self.window_start = time.monotonic()
+        self.window_size = 0
+        self.paused = 0
+
+    def update(self, size, paused=0):
+        """Function to count size received bytes, paused being time spent in the bandwidth limiter."""
+        self.window_size += size
+        self.paused += paused
+        now = time.monotonic()
+        elapsed = now - self.window_start - self.paused
+        if now - self.window_start < STALL_WINDOW:
+            return
+        if elapsed > 0 and self.window_size / elapsed < STALL_RATE:
+            raise MirrorStalled(f"{mirror_host(self.url)} stalled at {self.window_size / elapsed / 1024:.0f} KB/s")
+        self.window_start = now
+        self.window_size = 0
+        self.paused = 0
+
+# Function to measure the latency and throughput of one mirror
+def probe_mirror(url):
+    """Function to read the first PROBE_SIZE bytes of url and return its ProbeResult."""
+    start = time.monotonic()
+    with network.get_session().get(url, headers={'Range': f'bytes=0-{PROBE_SIZE - 1}'}, stream=True, timeout=PROBE_TIMEOUT) as response:
+        response.raise_for_status()
+        latency = time.monotonic() - start
+        received = 0
+        for data in response.iter_content(64 * 1024):
+            received += len(data)
+            if received >= PROBE_SIZE:
+                break
+        seconds = time.monotonic() - start - latency
+
+    accepts_ranges = response.status_code == 206
+    if accepts_ranges:
+        # Content-Range is "bytes 0-262143/123456789"
+        size = int(response.headers.get('content-range', '/0').rsplit('/', 1)[-1] or 0)
+    else:
+        size = int(response.headers.get('content-length', 0))
+
+    network.throttle(received)
+    stats.record(url, received, seconds, latency)
+    return ProbeResult(url, size, accepts_ranges, validator_from_headers(response.headers), latency, received / seconds if seconds > 0 else None)
+
+# Function to probe every mirror of a file and order them by speed
+def rank_mirrors(urls, verified=False):
+    """Function to probe all mirrors at once and return (MirrorSet fastest first, size, accepts_ranges, validator of the fastest).
+
+    Other mirrors only join the fastest one when they serve the same size with the same Range support and,
+    unless verified says integrity data checks every chunk, the same validator.
+    """
+    ranked = threading.Event()
+
+    def attempt(url):
+        try:
+            return probe_mirror(url)
+        except requests.exceptions.RequestException as e:
+            # Probes still running after the ranking were already reported as skipped
+            if not ranked.is_set():
+                tqdm.write(f"Mirror {mirror_host(url)} failed its probe: {e}")
+                stats.failure(url)
+            return None
+
+    executor = ThreadPoolExecutor(max_workers=len(urls))
+    pending = {executor.submit(attempt, url): url for url in urls}
+    results = []
+    deadline = None
+    try:
+        while pending:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                del pending[future]
+                if future.result() is not None:
+                    results.append(future.result())
+            if results and deadline is None:
+                # A dead mirror must not hold up the download once another one answered
+                deadline = time.monotonic() + PROBE_GRACE
+    finally:
+        ranked.set()
+        executor.shutdown(wait=False)
+
+    for url in pending.values():
+        tqdm.write(f"Skipping mirror {mirror_host(url)}, it did not answer its probe in time.")
+        stats.failure(url)
+    if not results:
+        raise requests.exceptions.RequestException(f"No mirror of {os.path.basename(urlparse(urls[0]).path)} answered")
+
+    # Fresh probes were folded into the history, so the ranking weighs both
+    results.sort(key=lambda result: stats.rank_key(result.url))
+    best = results[0]
+    # Only mirrors serving the same file the same way can take over mid-file
+    usable = [best]
+    for result in results[1:]:
+        if result.size != best.size or result.accepts_ranges != best.accepts_ranges:
+            tqdm.write(f"Skipping mirror {mirror_host(result.url)}, it serves a different file.")
+        elif not verified and (best.validator is None or result.validator != best.validator):
+            # A same-sized but different copy would be spliced into the file unnoticed
+            tqdm.write(f"Skipping mirror {mirror_host(result.url)}, its copy cannot be matched to {mirror_host(best.url)} without integrity data.")
+        else:
+            usable.append(result)
+
+    mirrors = MirrorSet([result.url for result in usable], {result.url: result.validator for result in usable}, key=urls[0])
+    return mirrors, best.size, best.accepts_ranges, best.validator
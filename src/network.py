@@ -0,0 +1,158 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Shared HTTP connection pool used by every network path
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import time
+import threading
+import requests
+from urllib.parse import urlsplit
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Default pool tuning values, can be overridden from data/config.json
+DEFAULT_POOL_CONNECTIONS = 8    # Number of distinct hosts kept in the pool
+DEFAULT_POOL_MAXSIZE = 32       # Keep-alive connections kept per host
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5           # Seconds, doubled on every retry
+
+# Responses that are worth retrying after a short pause
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_options = {
+    "pool_connections": DEFAULT_POOL_CONNECTIONS,
+    "pool_maxsize": DEFAULT_POOL_MAXSIZE,
+    "retries": DEFAULT_RETRIES,
+    "backoff_factor": DEFAULT_BACKOFF,
+}
+_session = None
+_session_lock = threading.Lock()
+
+# Base URL of a DarwinFetch LAN proxy (main.py serve) downloads go through, None to download directly
+_lan_proxy = None
+
+# Seconds of unused bandwidth a transfer may catch up on after being idle
+BANDWIDTH_BURST = 1.0
+
+class BandwidthLimiter:
+    """Token bucket shared by every transfer of the process, rate in bytes per second, 0 disables the limit."""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def reserve(self, size):
+        """Function to book size bytes in the bandwidth budget, returning the seconds to wait before going on."""
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time, now - BANDWIDTH_BURST) + size / self.rate
+            return max(0, self.next_time - now)
+
+    def consume(self, size):
+        """Function to block until size bytes fit in the bandwidth budget."""
+        delay = self.reserve(size)
+        if delay > 0:
+            time.sleep(delay)
+
+_bandwidth = BandwidthLimiter()
+
+# Function to change the pool settings before the shared session is used
+def configure(pool_connections=None, pool_maxsize=None, retries=None, backoff_factor=None):
+    """Function to update the pool settings, the next get_session() call builds a new session."""
+    global _session
+
+    updates = {"pool_connections": pool_connections, "pool_maxsize": pool_maxsize, "retries": retries, "backoff_factor": backoff_factor}
+    with _session_lock:
+        for key, value in updates.items():
+            if value is not None:
+                _options[key] = value
+        if _session is not None:
+            _session.close()
+            _session = None
+
+# Function to read the pool settings, for clients that cannot use the shared session
+def options():
+    """Function to return a copy of the pool_connections, pool_maxsize, retries and backoff_factor settings."""
+    with _session_lock:
+        return dict(_options)
+
+# Function to apply the pool settings stored in the DarwinFetch config
+def configure_from_config(config):
+    """Function to configure the shared pool from the http_* keys, the bandwidth cap from bandwidth_limit and the LAN proxy from lan_proxy."""
+    configure(
+        config.get("http_pool_connections"),
+        config.get("http_pool_maxsize"),
+        config.get("http_retries"),
+        config.get("http_backoff"),
+    )
+    set_bandwidth_limit(config.get("bandwidth_limit", 0))
+    set_lan_proxy(config.get("lan_proxy"))
+
+# Function to send downloads through a DarwinFetch LAN proxy
+def set_lan_proxy(base_url):
+    """Function to set the proxy base URL, e.g. http://10.0.0.2:8470, an empty value downloads directly."""
+    global _lan_proxy
+    _lan_proxy = base_url.rstrip('/') if base_url else None
+
+# Function to rewrite a download URL so the LAN proxy serves it
+def via_proxy(url):
+    """Function to return the LAN proxy URL of url, /<scheme>/<host>/<path> below the proxy, or url itself when no proxy is set."""
+    parts = urlsplit(url)
+    if _lan_proxy is None or parts.scheme not in ("http", "https") or url.startswith(_lan_proxy + "/"):
+        return url
+    proxied = f"{_lan_proxy}/{parts.scheme}/{parts.netloc}{parts.path}"
+    return f"{proxied}?{parts.query}" if parts.query else proxied
+
+# Function to cap the combined download speed of every transfer
+def set_bandwidth_limit(rate):
+    """Function to set the shared bandwidth cap in bytes per second, 0 removes it."""
+    _bandwidth.rate = rate or 0
+
+# Function to account for bytes received by a transfer
+def throttle(size):
+    """Function to wait as long as needed to keep all transfers under the bandwidth cap."""
+    _bandwidth.consume(size)
+
+# Function to account for bytes received by a transfer that must not block, e.g. on an event loop
+def throttle_delay(size):
+    """Function to return the seconds a transfer has to wait to stay under the bandwidth cap."""
+    return _bandwidth.reserve(size)
+
+# Function to build a new pooled session
+def create_session():
+    """Function to create a keep-alive session with connection pooling and retry/backoff."""
+    retry = Retry(
+        total=_options["retries"],
+        backoff_factor=_options["backoff_factor"],
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["HEAD", "GET", "POST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=_options["pool_connections"], pool_maxsize=_options["pool_maxsize"], max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    # Cookies are always passed explicitly, never let the jar add its own
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    return session
+
+# Function to get the session shared by main.py, macrecovery.py and the download engine
+def get_session():
+    """Function to return the process-wide pooled session, creating it on first use."""
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
@@ -0,0 +1,420 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Caching LAN proxy for offline packages and recovery images
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import time
+import hashlib
+import network
+import requests
+import threading
+from cache import DownloadCache
+from journal import validator_from_headers
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Default address the proxy listens on
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 8470
+
+# Upstream hosts served by default, together with their subdomains
+DEFAULT_ALLOWED_HOSTS = ("apple.com", "cdn-apple.com")
+
+# Request headers passed on upstream, recovery images need the AssetToken cookie
+FORWARDED_HEADERS = ("Cookie", "User-Agent")
+
+# Amount of data read or sent per iteration
+BLOCK_SIZE = 1024 * 1024  # 1 MB
+
+# Timeout (connect, read) in seconds for upstream requests
+REQUEST_TIMEOUT = (15, 60)
+
+# Seconds a cached file is served before it is checked against upstream again
+DEFAULT_REVALIDATE_AFTER = 5 * 60
+
+# Timeout (connect, read) in seconds for revalidation, an unreachable upstream should not hold up a cached file for long
+REVALIDATE_TIMEOUT = (5, 10)
+
+# Seconds between writes of the cache hits to the index
+USAGE_FLUSH_INTERVAL = 60
+
+# Ranges starting further than this past the cached part are fetched upstream directly instead of waiting
+PASSTHROUGH_GAP = 64 * 1024 * 1024  # 64 MB
+
+# Single "bytes=start-end" range, suffix ranges included
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Function to find the upstream URL of a proxy request path
+def upstream_url(path):
+    """Function to turn /<scheme>/<host>/<path>?<query> into <scheme>://<host>/<path>?<query>, None when it is not one."""
+    parts = urlsplit(path)
+    segments = parts.path.lstrip('/').split('/', 2)
+    if len(segments) != 3 or segments[0] not in ("http", "https") or not segments[1]:
+        return None
+    url = f"{segments[0]}://{segments[1]}/{segments[2]}"
+    return f"{url}?{parts.query}" if parts.query else url
+
+# Function to check an upstream host against the allowed list
+def host_allowed(url, allowed_hosts):
+    """Function to return True when the host of url is one of allowed_hosts or a subdomain of one."""
+    host = (urlsplit(url).hostname or "").lower()
+    return any(host == allowed or host.endswith("." + allowed) for allowed in allowed_hosts)
+
+# Function to read the Range header of a request
+def parse_range(header, size):
+    """Function to return the (start, end) byte range asked for, None for the whole file, or False when it cannot be satisfied."""
+    match = RANGE_PATTERN.match(header or "")
+    if match is None or size is None:
+        return None
+    start, end = match.groups()
+    if not start:
+        # Suffix range, the last `end` bytes
+        if not end:
+            return False
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+# Function to make a HEAD request conditional on a stored validator
+def conditional_headers(headers, validator):
+    """Function to add If-None-Match for an ETag, or If-Modified-Since for a Last-Modified date, to headers."""
+    headers = dict(headers)
+    if validator is None:
+        return headers
+    if validator.startswith('"') or validator.startswith('W/'):
+        headers["If-None-Match"] = validator
+    else:
+        headers["If-Modified-Since"] = validator
+    return headers
+
+# Function to make the validator of a proxied file
+def make_etag(key, size, validator=None):
+    """Function to return an ETag that stays the same while the cached copy of a URL does, so clients can resume.
+
+    The upstream validator is part of it, a file replaced upstream by one of the same size gets a new ETag.
+    """
+    tag = hashlib.sha256(f"{key}\n{validator}".encode('utf-8')).hexdigest()[:16]
+    return f'"{tag}-{size}"'
+
+class Fill:
+    """One upstream transfer into the cache, streamed to every client asking for the same file meanwhile."""
+
+    def __init__(self, key, url, path):
+        self.key = key
+        self.url = url
+        self.path = path
+        self.size = None
+        self.validator = None
+        self.started = False
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def run(self, headers, download_cache, on_finish):
+        """Function to fetch the file into its partial path, add it to the cache and wake every waiting client."""
+        try:
+            with network.get_session().get(self.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                size = int(response.headers.get('content-length', 0)) or None
+                with open(self.path, 'wb') as file:
+                    with self.condition:
+                        self.size = size
+                        self.validator = validator_from_headers(response.headers)
+                        self.started = True
+                        self.condition.notify_all()
+                    for data in response.iter_content(BLOCK_SIZE):
+                        file.write(data)
+                        file.flush()
+                        with self.condition:
+                            self.written += len(data)
+                            self.condition.notify_all()
+                        network.throttle(len(data))
+
+            if size is not None and self.written != size:
+                raise requests.exceptions.RequestException(f"Upstream closed early at byte {self.written} of {size}")
+            download_cache.store(self.key, self.path, self.url, self.validator)
+        except Exception as e:
+            # Reported to every client waiting on this fill
+            self.error = e if isinstance(e, requests.exceptions.RequestException) else requests.exceptions.RequestException(str(e))
+        finally:
+            with self.condition:
+                # Clients that already opened the partial file keep reading it after it is removed
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+                self.done = True
+                self.condition.notify_all()
+            on_finish(self)
+
+    def open(self):
+        """Function to wait for the upstream headers and open the partial file, None once the fill has finished."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.started or self.done)
+            if self.done:
+                return None
+            return open(self.path, 'rb')
+
+    def wait_for(self, offset):
+        """Function to block until the byte at offset is written or the fill ends, returning the bytes written so far."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.written > offset or self.done)
+            if self.error is not None:
+                raise self.error
+            return self.written
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """Serves /<scheme>/<host>/<path> from the cache, filling it from upstream on a miss."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.handle_download(False)
+
+    def do_GET(self):
+        self.handle_download(True)
+
+    def handle_download(self, send_body):
+        url = upstream_url(self.path)
+        if url is None:
+            self.send_error(404, "Expected /<scheme>/<host>/<path>")
+            return
+        if not host_allowed(url, self.server.allowed_hosts):
+            self.send_error(403, f"{urlsplit(url).hostname} is not served by this proxy")
+            return
+
+        key = DownloadCache.key(url, None)
+        try:
+            # A fill that finished between the lookup and open() is in the cache by then
+            for _ in range(2):
+                path = self.server.cache.lookup(key)
+                if path is not None and not self.server.revalidate(key, url, self.upstream_headers()):
+                    # Changed upstream, the old copy was dropped and is fetched again
+                    path = None
+                if path is not None:
+                    self.send_cached(path, key, send_body)
+                    return
+                if not send_body:
+                    self.send_upstream_head(url, key)
+                    return
+                fill = self.server.fill(key, url, self.upstream_headers())
+                reader = fill.open()
+                if reader is not None:
+                    with reader:
+                        self.send_fill(fill, reader)
+                    return
+                if fill.error is not None:
+                    raise fill.error
+            # Both fills ended before this client could read them and neither left the file in the cache,
+            # as happens to files larger than the cache, so there is nothing to send it
+            self.send_error(502, "Upstream file could not be cached")
+        except requests.exceptions.RequestException as e:
+            self.send_error(502, f"Upstream error: {e}")
+        except (ConnectionError, OSError):
+            # The client went away, an upstream fill keeps going for the others
+            self.close_connection = True
+
+    def upstream_headers(self):
+        """Function to return the request headers passed on upstream."""
+        return {name: self.headers[name] for name in FORWARDED_HEADERS if self.headers.get(name)}
+
+    def send_headers(self, etag, size, byte_range):
+        """Function to send the status and headers of a full or partial response."""
+        if byte_range is None:
+            self.send_response(200)
+            length = size
+        else:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {byte_range[0]}-{byte_range[1]}/{size}")
+            length = byte_range[1] - byte_range[0] + 1
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        if size is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(length))
+        else:
+            # Unknown length, the end of the body is the end of the connection
+            self.close_connection = True
+        self.end_headers()
+
+    def requested_range(self, etag, size):
+        """Function to return the range to send, honouring If-Range, or False after answering 416."""
+        if_range = self.headers.get("If-Range")
+        if if_range and size is not None and if_range != etag:
+            return None
+        byte_range = parse_range(self.headers.get("Range"), size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        return byte_range
+
+    def send_cached(self, path, key, send_body):
+        """Function to send a cached file, or a range of it, without copying it through Python."""
+        entry = self.server.cache.entry(key) or {}
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            etag = make_etag(key, size, entry.get("validator"))
+            byte_range = self.requested_range(etag, size)
+            if byte_range is False:
+                return
+            self.send_headers(etag, size, byte_range)
+            if send_body:
+                start, end = byte_range or (0, size - 1)
+                self.connection.sendfile(file, start, end - start + 1)
+
+    def send_upstream_head(self, url, key):
+        """Function to answer HEAD for a file that is not cached with the upstream size."""
+        response = network.get_session().head(url, headers=self.upstream_headers(), allow_redirects=True, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        size = int(response.headers.get('content-length', 0)) or None
+        self.send_headers(make_etag(key, size, validator_from_headers(response.headers)), size, None)
+
+    def send_fill(self, fill, reader):
+        """Function to stream a file to the client while it is still arriving from upstream."""
+        etag = make_etag(fill.key, fill.size, fill.validator)
+        byte_range = self.requested_range(etag, fill.size)
+        if byte_range is False:
+            return
+        if byte_range is not None and byte_range[0] > fill.written + PASSTHROUGH_GAP:
+            self.send_passthrough(fill, etag, byte_range)
+            return
+
+        self.send_headers(etag, fill.size, byte_range)
+        offset, end = byte_range or (0, None)
+        while end is None or offset <= end:
+            try:
+                written = fill.wait_for(offset)
+            except requests.exceptions.RequestException:
+                # The headers are out, all that is left is to cut the response short
+                self.close_connection = True
+                return
+            if offset >= written:
+                # Finished before reaching offset, only happens without a known size
+                break
+            stop = written if end is None else min(written, end + 1)
+            reader.seek(offset)
+            while offset < stop:
+                data = reader.read(min(BLOCK_SIZE, stop - offset))
+                self.wfile.write(data)
+                offset += len(data)
+
+    def send_passthrough(self, fill, etag, byte_range):
+        """Function to fetch a range far ahead of the fill directly from upstream without caching it."""
+        headers = self.upstream_headers()
+        headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        if fill.validator is not None:
+            # A file replaced upstream since the fill started must not be mixed into it
+            headers["If-Range"] = fill.validator
+        with network.get_session().get(fill.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise requests.exceptions.RequestException("Upstream ignored the range request")
+            self.send_headers(etag, fill.size, byte_range)
+            try:
+                for data in response.iter_content(BLOCK_SIZE):
+                    self.wfile.write(data)
+                    network.throttle(len(data))
+            except requests.exceptions.RequestException:
+                self.close_connection = True
+
+class ProxyServer(ThreadingHTTPServer):
+    """Caching HTTP proxy, every file is fetched upstream once however many clients ask for it at the same time."""
+
+    daemon_threads = True
+
+    def __init__(self, address, download_cache, allowed_hosts=DEFAULT_ALLOWED_HOSTS, revalidate_after=DEFAULT_REVALIDATE_AFTER):
+        super().__init__(address, ProxyHandler)
+        self.cache = download_cache
+        self.allowed_hosts = tuple(host.lower() for host in allowed_hosts)
+        self.revalidate_after = revalidate_after
+        self.partial = os.path.join(download_cache.directory, "partial")
+        self.fills = {}
+        # When each cached file was last checked against upstream
+        self.checked = {}
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        os.makedirs(self.partial, exist_ok=True)
+        # Cache hits are written to the index from here rather than by every request
+        self.flusher = threading.Thread(target=self.flush_usage, daemon=True)
+        self.flusher.start()
+
+    def flush_usage(self):
+        """Function to write the cache hits to the index every USAGE_FLUSH_INTERVAL seconds until the server closes."""
+        while not self.closing.wait(USAGE_FLUSH_INTERVAL):
+            try:
+                self.cache.flush()
+            except OSError:
+                # Retried on the next round, hits only decide the eviction order
+                pass
+
+    def server_close(self):
+        """Function to stop listening and write the cache hits not written yet."""
+        super().server_close()
+        self.closing.set()
+        self.cache.flush()
+
+    def revalidate(self, key, url, headers):
+        """Function to check a cached file against upstream with a conditional HEAD, returning False when it changed.
+
+        Each file is checked at most once every revalidate_after seconds. When upstream cannot be
+        reached or refuses the request, the cached copy keeps being served.
+        """
+        now = time.monotonic()
+        with self.lock:
+            checked = self.checked.get(key)
+            if checked is not None and now - checked < self.revalidate_after:
+                return True
+            # Requests arriving during the check are served the cached copy
+            self.checked[key] = now
+
+        entry = self.cache.entry(key)
+        if entry is None:
+            return True
+        try:
+            response = network.get_session().head(url, headers=conditional_headers(headers, entry.get("validator")), allow_redirects=True, timeout=REVALIDATE_TIMEOUT)
+        except requests.exceptions.RequestException:
+            return True
+        if response.status_code == 304 or not response.ok:
+            return True
+
+        validator = validator_from_headers(response.headers)
+        size = int(response.headers.get('content-length', 0)) or None
+        # Entries stored before validators were kept can only be compared by size
+        same_validator = validator is None or entry.get("validator") is None or validator == entry.get("validator")
+        if same_validator and (size is None or size == entry.get("size")):
+            return True
+
+        self.cache.discard(key)
+        with self.lock:
+            self.checked.pop(key, None)
+        return False
+
+    def fill(self, key, url, headers):
+        """Function to return the running fill of a URL, starting one when no client is fetching it yet."""
+        with self.lock:
+            fill = self.fills.get(key)
+            if fill is None:
+                fill = Fill(key, url, os.path.join(self.partial, key))
+                self.fills[key] = fill
+                # Fetched just now, nothing to revalidate yet
+                self.checked[key] = time.monotonic()
+                threading.Thread(target=fill.run, args=(headers, self.cache, self.finish), daemon=True).start()
+            return fill
+
+    def finish(self, fill):
+        """Function to forget a fill once it ended, the next request finds the file in the cache or starts over."""
+        with self.lock:
+            if self.fills.get(fill.key) is fill:
+                del self.fills[fill.key]
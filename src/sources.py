@@ -0,0 +1,444 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Source files and their freshness against the upstream repository
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import json
+import pickle
+import hashlib
+import network
+
+# Upstream URL and local path of every source file
+SOURCES = {
+    "offline": ("https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/offline_sources.json", os.path.join("data", "offline_sources.json")),
+    "recovery": ("https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/recovery_sources.json", os.path.join("data", "recovery_sources.json")),
+    "powerpc": ("https://raw.githubusercontent.com/royalgraphx/DarwinFetch/main/data/ppc_sources.json", os.path.join("data", "ppc_sources.json")),
+}
+
+# Local additions to a source, e.g. installers ingested from a software update catalog, kept out of
+# the upstream file so it still matches upstream and update_source never overwrites them
+LOCAL_SOURCES = {
+    "offline": os.path.join("data", "ingested_sources.json"),
+}
+
+# ETag / Last-Modified seen for each source, used for conditional requests
+STATE_PATH = os.path.join("data", "sources_state.json")
+
+# Timeout (connect, read) in seconds for source requests
+REQUEST_TIMEOUT = (15, 60)
+
+# Changed sources fetched by check_source, kept so update_source does not download them again
+_pending = {}
+
+# Parsed catalogs by source type, with the (mtime, size) of the file they were read from
+_catalogs = {}
+
+# Catalogs with the local additions merged in, with the signatures of both files they were built from
+_merged = {}
+
+# Precompiled catalogs written by update_sources, bump the version when Catalog changes
+INDEX_PATH = os.path.join("data", "sources_index.pickle")
+INDEX_VERSION = 2
+
+# Loaded index sources together with the (mtime, size) of the index file
+_index = None
+
+# Errors meaning the index cannot be used and the JSON files have to be read instead
+INDEX_ERRORS = (OSError, pickle.UnpicklingError, AttributeError, EOFError, ImportError, IndexError, TypeError, ValueError)
+
+# Function to get the local path of a source file
+def source_path(source_type):
+    """Function to return the local path of a source type."""
+    return SOURCES[source_type][1]
+
+# Function to get the local path of the additions to a source
+def local_source_path(source_type):
+    """Function to return the path of the locally added entries of a source type, or None when it takes none."""
+    return LOCAL_SOURCES.get(source_type)
+
+# Function to identify the on-disk version of a file without reading it
+def file_signature(path):
+    """Function to return the (mtime, size) of a file, raising FileNotFoundError when it is missing."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+class Catalog:
+    """Parsed source file with lookup indexes, shared by every menu action."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.by_build = {}
+        self.by_version = {}
+        self.by_identifier = {}
+        self.by_beta = {True: [], False: []}
+
+        for entry in entries:
+            self.by_build.setdefault(entry.get("build"), entry)
+            self.by_version.setdefault(entry.get("version"), []).append(entry)
+            self.by_identifier.setdefault(entry.get("identifier"), []).append(entry)
+            self.by_beta[bool(entry.get("beta"))].append(entry)
+
+    def find_build(self, build):
+        """Function to return the entry for a build, or None."""
+        return self.by_build.get(build)
+
+    def apply(self, entries, delta):
+        """Function to move the catalog to a new entry list, re-indexing only the entries named in delta."""
+        # Unaffected entries keep the objects the indexes already point to
+        affected = delta.keys()
+        current = {entry_key(entry): entry for entry in self.entries}
+        self.entries = [entry if entry_key(entry) in affected else current.get(entry_key(entry), entry) for entry in entries]
+        entries = self.entries
+        touched = [old for old in delta.removed] + [old for old, _ in delta.changed]
+        fresh = [new for new in delta.added] + [new for _, new in delta.changed]
+
+        for entry in touched:
+            if self.by_build.get(entry.get("build")) is entry:
+                del self.by_build[entry.get("build")]
+        for entry in fresh:
+            self.by_build.setdefault(entry.get("build"), entry)
+
+        # Grouped lists keep file order, so only the groups an affected entry belongs to are rebuilt
+        versions = {entry.get("version") for entry in touched + fresh}
+        identifiers = {entry.get("identifier") for entry in touched + fresh}
+        betas = {bool(entry.get("beta")) for entry in touched + fresh}
+        for version in versions:
+            self.by_version.pop(version, None)
+        for identifier in identifiers:
+            self.by_identifier.pop(identifier, None)
+        for beta in betas:
+            self.by_beta[beta] = []
+
+        for entry in entries:
+            if entry.get("version") in versions:
+                self.by_version.setdefault(entry.get("version"), []).append(entry)
+            if entry.get("identifier") in identifiers:
+                self.by_identifier.setdefault(entry.get("identifier"), []).append(entry)
+            if bool(entry.get("beta")) in betas:
+                self.by_beta[bool(entry.get("beta"))].append(entry)
+
+# Function to get the key an entry is tracked by across updates
+def entry_key(entry):
+    """Function to return the (identifier, build) pair identifying a source entry."""
+    return entry.get("identifier"), entry.get("build")
+
+# Function to list the package URLs of an entry
+def package_urls(entry):
+    """Function to return the set of package URLs of a source entry."""
+    return {package.get("url") for package in entry.get("packages", [])}
+
+# Function to list every URL a package can be downloaded from
+def package_mirrors(package):
+    """Function to return the package URL followed by its "mirrors", as the single URL when there are no mirrors."""
+    urls = list(dict.fromkeys(url for url in [package.get("url")] + package.get("mirrors", []) if url))
+    return urls if len(urls) > 1 else package.get("url")
+
+class SourceDelta:
+    """Per-entry changes between two versions of a source file, false when nothing changed."""
+
+    def __init__(self, source_type, added=(), removed=(), changed=()):
+        self.source_type = source_type
+        self.added = list(added)        # New entries
+        self.removed = list(removed)    # Old entries
+        self.changed = list(changed)    # (old entry, new entry) pairs
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def keys(self):
+        """Function to return the (identifier, build) keys of every affected entry."""
+        return {entry_key(entry) for entry in self.added + self.removed} | {entry_key(new) for _, new in self.changed}
+
+    def stale_urls(self):
+        """Function to return the package URLs that are no longer published or now describe a different package, for caches keyed by URL."""
+        stale = set()
+        for entry in self.removed:
+            stale |= package_urls(entry)
+        for old, new in self.changed:
+            published = {package.get("url"): package for package in new.get("packages", [])}
+            stale |= {package.get("url") for package in old.get("packages", []) if published.get(package.get("url")) != package}
+        return stale
+
+    def summary(self):
+        """Function to describe the delta in a short sentence."""
+        return f"{len(self.added)} added, {len(self.removed)} removed, {len(self.changed)} changed"
+
+# Function to compare two versions of a source entry by entry
+def diff_entries(source_type, old_entries, new_entries):
+    """Function to return the SourceDelta turning old_entries into new_entries, matched by (identifier, build)."""
+    old_by_key = {entry_key(entry): entry for entry in old_entries}
+    new_by_key = {entry_key(entry): entry for entry in new_entries}
+
+    added = [entry for key, entry in new_by_key.items() if key not in old_by_key]
+    removed = [entry for key, entry in old_by_key.items() if key not in new_by_key]
+    changed = [(old_by_key[key], entry) for key, entry in new_by_key.items() if key in old_by_key and old_by_key[key] != entry]
+    return SourceDelta(source_type, added, removed, changed)
+
+# Callbacks run with every non-empty SourceDelta applied by update_source
+_listeners = []
+
+# Function to be told which entries of a source changed
+def on_change(callback):
+    """Function to register callback(delta), called after a source update changed some entries."""
+    _listeners.append(callback)
+    return callback
+
+# Function to read the precompiled index without unpickling its catalogs
+def read_index():
+    """Function to return {source_type: (signature, pickled Catalog)} from the index, empty when it is missing or unusable."""
+    try:
+        with open(INDEX_PATH, 'rb') as file:
+            data = pickle.load(file)
+    except INDEX_ERRORS:
+        return {}
+
+    if not isinstance(data, dict) or data.get("version") != INDEX_VERSION:
+        return {}
+    return data["sources"]
+
+# Function to compile the source files into the precompiled index
+def compile_index():
+    """Function to store the catalog of every source in data/sources_index.pickle, pickling only the sources whose file changed."""
+    previous = read_index()
+    compiled = {}
+    for source_type in SOURCES:
+        try:
+            signature = file_signature(source_path(source_type))
+        except FileNotFoundError:
+            continue
+
+        # A source an update left alone keeps its pickled catalog byte for byte
+        stored = previous.get(source_type)
+        if stored is not None and stored[0] == signature:
+            compiled[source_type] = stored
+            continue
+
+        # Catalogs already in memory, e.g. patched by update_source, are stored without parsing again
+        catalog = upstream_catalog(source_type)
+        compiled[source_type] = (_catalogs[source_type][0], pickle.dumps(catalog, protocol=pickle.HIGHEST_PROTOCOL))
+
+    if compiled != previous:
+        write_atomic(INDEX_PATH, pickle.dumps({"version": INDEX_VERSION, "sources": compiled}, protocol=pickle.HIGHEST_PROTOCOL))
+
+# Function to read a catalog from the precompiled index
+def catalog_from_index(source_type, signature):
+    """Function to return the compiled Catalog of a source, or None when the index is missing or stale."""
+    global _index
+
+    try:
+        index_signature = file_signature(INDEX_PATH)
+    except FileNotFoundError:
+        return None
+
+    if _index is None or _index[0] != index_signature:
+        _index = (index_signature, read_index())
+
+    compiled = _index[1].get(source_type)
+    if compiled is None or compiled[0] != signature:
+        return None
+    try:
+        return pickle.loads(compiled[1])
+    except INDEX_ERRORS:
+        return None
+
+# Function to get the parsed catalog of a source file, re-reading it only when the file changed
+def upstream_catalog(source_type):
+    """Function to return the Catalog of the upstream file of a source type, or None when it does not exist."""
+    path = source_path(source_type)
+    try:
+        signature = file_signature(path)
+    except FileNotFoundError:
+        _catalogs.pop(source_type, None)
+        return None
+
+    cached = _catalogs.get(source_type)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    # Prefer the precompiled index, fall back to the JSON file when it is missing or stale
+    catalog = catalog_from_index(source_type, signature)
+    if catalog is None:
+        with open(path, 'r') as file:
+            catalog = Catalog(json.load(file))
+    _catalogs[source_type] = (signature, catalog)
+    return catalog
+
+# Function to fold locally added entries into the entries of a source
+def merge_entries(existing, added):
+    """Function to replace entries with the same build in place and put new builds first."""
+    added_by_build = {entry.get("build"): entry for entry in added}
+    merged = [added_by_build.pop(entry.get("build"), entry) for entry in existing]
+    new_entries = [entry for entry in added if entry.get("build") in added_by_build]
+    return new_entries + merged
+
+# Function to get the catalog of a source together with its local additions
+def get_catalog(source_type):
+    """Function to return the Catalog of a source type with its local additions merged in, or None when neither file exists."""
+    catalog = upstream_catalog(source_type)
+    added_path = local_source_path(source_type)
+    try:
+        added_signature = file_signature(added_path) if added_path else None
+    except FileNotFoundError:
+        added_signature = None
+    if added_signature is None:
+        _merged.pop(source_type, None)
+        return catalog
+
+    signatures = (_catalogs[source_type][0] if catalog is not None else None, added_signature)
+    cached = _merged.get(source_type)
+    if cached is not None and cached[0] == signatures:
+        return cached[1]
+
+    with open(added_path, 'r') as file:
+        added = json.load(file)
+    merged = Catalog(merge_entries(catalog.entries if catalog is not None else [], added))
+    _merged[source_type] = (signatures, merged)
+    return merged
+
+# Function to get the entries of a source in file order
+def load_sources(source_type):
+    """Function to return the list of entries of a source type, or None when its file does not exist."""
+    catalog = get_catalog(source_type)
+    return None if catalog is None else catalog.entries
+
+# Function to write a file so readers never see it half written
+def write_atomic(path, content):
+    """Function to write bytes to path through a temporary file and a rename."""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+# Function to load the stored validators of every source
+def load_state():
+    """Function to read data/sources_state.json, returning an empty state when it is missing."""
+    try:
+        with open(STATE_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+# Function to store the validators of every source
+def save_state(state):
+    """Function to atomically write data/sources_state.json."""
+    write_atomic(STATE_PATH, json.dumps(state, indent=4).encode('utf-8'))
+
+# Function to hash the local copy of a source
+def local_digest(source_type):
+    """Function to return the SHA-256 of a local source file, or None when it does not exist."""
+    try:
+        with open(source_path(source_type), 'rb') as local_file:
+            return hashlib.sha256(local_file.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+# Function to return the signature of a local source file as it is kept in the state
+def local_signature(source_type):
+    """Function to return the [mtime, size] of a local source file, or None when it does not exist."""
+    try:
+        return list(file_signature(source_path(source_type)))
+    except FileNotFoundError:
+        return None
+
+# Function to record the validators returned for a source
+def remember_validators(source_type, headers, content):
+    """Function to store the ETag, Last-Modified and content hash of a source response, the local file holding that content."""
+    state = load_state()
+    state[source_type] = {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "signature": local_signature(source_type),
+    }
+    save_state(state)
+
+# Function to ask upstream whether a source changed since it was last fetched
+def fetch_if_changed(source_type):
+    """Function to send a conditional request, returning None when unchanged, else (content, headers)."""
+    source_url, local_path = SOURCES[source_type]
+    validators = load_state().get(source_type, {})
+
+    # Validators only describe the local file while it is still the one they were stored for,
+    # the file is only hashed when its signature no longer matches
+    if validators.get("signature") != local_signature(source_type) and validators.get("sha256") != local_digest(source_type):
+        validators = {}
+
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    response = network.get_session().get(source_url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    return response.content, response.headers
+
+# Function to check if the local source file matches the remote source file
+def check_source(source_type):
+    """Function to return True when the local source file is up to date, usually at the cost of one 304."""
+    local_path = source_path(source_type)
+    if not os.path.exists(local_path):
+        return False
+
+    result = fetch_if_changed(source_type)
+    if result is None:
+        return True
+
+    content, headers = result
+    with open(local_path, 'rb') as local_file:
+        up_to_date = local_file.read() == content
+
+    if up_to_date:
+        # First check after an upgrade, only the validators were missing
+        remember_validators(source_type, headers, content)
+    else:
+        _pending[source_type] = (content, headers)
+
+    return up_to_date
+
+# Function to bring a source file up to date
+def update_source(source_type):
+    """Function to download a changed source once, write it atomically and return the SourceDelta it applied."""
+    local_path = source_path(source_type)
+
+    if source_type in _pending:
+        content, headers = _pending.pop(source_type)
+    else:
+        result = fetch_if_changed(source_type)
+        if result is None:
+            return SourceDelta(source_type)
+        content, headers = result
+
+    if os.path.exists(local_path):
+        with open(local_path, 'rb') as local_file:
+            if local_file.read() == content:
+                remember_validators(source_type, headers, content)
+                return SourceDelta(source_type)
+
+    catalog = upstream_catalog(source_type)
+    new_entries = json.loads(content)
+    delta = diff_entries(source_type, catalog.entries if catalog is not None else [], new_entries)
+
+    # The file keeps the upstream bytes so its validators stay usable
+    write_atomic(local_path, content)
+    remember_validators(source_type, headers, content)
+
+    if catalog is not None:
+        catalog.apply(new_entries, delta)
+    else:
+        catalog = Catalog(new_entries)
+    _catalogs[source_type] = (file_signature(local_path), catalog)
+
+    if delta:
+        for callback in _listeners:
+            callback(delta)
+    return delta
@@ -0,0 +1,204 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Offline sources built directly from Apple's software update catalog
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import re
+import gzip
+import base64
+import network
+import requests
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+# Catalog listing every public macOS release, beta seeds use their own catalogs
+DEFAULT_CATALOG_URL = "https://swscan.apple.com/content/catalogs/others/index-15-14-13-12-10.16-10.15-10.14-10.13-10.12-10.11-10.10-10.9-mountainlion-lion-snowleopard-leopard.merged-1.sucatalog"
+
+# Timeout (connect, read) in seconds for catalog and distribution requests
+REQUEST_TIMEOUT = (15, 60)
+
+# Number of distribution files fetched at once
+DEFAULT_DIST_WORKERS = 8
+
+# Localized title of a distribution, e.g. "SU_TITLE" = "macOS Sonoma";
+TITLE_PATTERN = re.compile(r'"SU_TITLE"\s*=\s*"([^"]*)";')
+
+# Function to tell URLs apart from local paths
+def is_url(source):
+    """Function to return True when a catalog source is an http(s) URL."""
+    return source.startswith("http://") or source.startswith("https://")
+
+# Function to open a catalog as a byte stream without reading it into memory
+def open_catalog(source):
+    """Function to return a readable binary stream for a catalog path or URL, gunzipping .gz catalogs."""
+    if is_url(source):
+        response = network.get_session().get(source, stream=True, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        stream = response.raw
+    else:
+        stream = open(source, 'rb')
+
+    if source.endswith(".gz"):
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+# Function to convert a plist element into the matching Python value
+def plist_value(element):
+    """Function to decode a plist XML element (dict, array, string, integer, real, true, false, date, data)."""
+    tag = element.tag
+    if tag == "dict":
+        children = list(element)
+        return {children[index].text: plist_value(children[index + 1]) for index in range(0, len(children) - 1, 2)}
+    if tag == "array":
+        return [plist_value(child) for child in element]
+    if tag == "integer":
+        return int(element.text)
+    if tag == "real":
+        return float(element.text)
+    if tag == "true":
+        return True
+    if tag == "false":
+        return False
+    if tag == "data":
+        return base64.b64decode(element.text or "")
+    return element.text or ""
+
+# Function to walk the products of a catalog one at a time
+def iter_products(stream):
+    """Function to yield (product id, product dict) from a sucatalog stream, keeping only one product in memory."""
+    path = []
+    root_key = None
+    product_key = None
+    products = None
+
+    for event, element in ElementTree.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            # The Products dict is the value that follows the Products key of the root dict
+            if path == ["plist", "dict"] and element.tag == "dict" and root_key == "Products":
+                products = element
+            path.append(element.tag)
+            continue
+
+        path.pop()
+        if path == ["plist", "dict"]:
+            if element.tag == "key":
+                root_key = element.text
+            elif element is products:
+                products = None
+        elif products is not None and path == ["plist", "dict", "dict"]:
+            if element.tag == "key":
+                product_key = element.text
+            else:
+                yield product_key, plist_value(element)
+                # Drop the finished product so the tree never grows with the catalog
+                products.clear()
+
+# Function to check if a product is a full macOS installer
+def is_install_assistant(product):
+    """Function to return True when a catalog product ships InstallAssistant.pkg."""
+    extended = product.get("ExtendedMetaInfo", {})
+    if "InstallAssistantPackageIdentifiers" in extended:
+        return True
+    return any(package.get("URL", "").endswith("/InstallAssistant.pkg") for package in product.get("Packages", []))
+
+# Function to read the build, version and name of a product from its distribution file
+def parse_distribution(content):
+    """Function to return {"build", "version", "name"} from English.dist bytes."""
+    info = {"build": None, "version": None, "name": None}
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError:
+        return info
+
+    auxinfo = root.find("auxinfo/dict")
+    if auxinfo is not None:
+        values = plist_value(auxinfo)
+        info["build"] = values.get("BUILD")
+        info["version"] = values.get("VERSION")
+
+    title = root.findtext("title")
+    match = TITLE_PATTERN.search(content.decode('utf-8', 'replace'))
+    if match:
+        info["name"] = match.group(1)
+    elif title and title != "SU_TITLE":
+        info["name"] = title
+
+    return info
+
+# Function to download and parse the distribution file of a product
+def fetch_distribution(url):
+    """Function to fetch a distribution URL and return its build, version and name."""
+    response = network.get_session().get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return parse_distribution(response.content)
+
+# Function to pick the distribution file of a product
+def distribution_url(product):
+    """Function to return the English distribution URL of a product, else any distribution URL."""
+    distributions = product.get("Distributions", {})
+    return distributions.get("English") or distributions.get("en") or next(iter(distributions.values()), None)
+
+# Function to convert a catalog product into an offline source entry
+def make_entry(identifier, product, distribution, info):
+    """Function to build an entry in the data/offline_sources.json schema."""
+    packages = []
+    for package in product.get("Packages", []):
+        entry_package = {"size": package.get("Size", 0), "url": package.get("URL")}
+        if "IntegrityDataURL" in package:
+            entry_package["integrityDataURL"] = package["IntegrityDataURL"]
+            entry_package["integrityDataSize"] = package.get("IntegrityDataSize", 0)
+        packages.append(entry_package)
+
+    build = info["build"] or ""
+    post_date = product.get("PostDate", "")
+
+    return {
+        # Seed builds end with a letter, e.g. 23F5059e
+        "beta": bool(build) and build[-1].isalpha(),
+        "build": build,
+        "compatible": True,
+        "date": post_date[:10],
+        "distribution": distribution,
+        "identifier": identifier,
+        "name": info["name"] or "macOS",
+        "packages": packages,
+        "size": sum(package["size"] for package in packages),
+        "version": info["version"] or "",
+    }
+
+# Function to turn a software update catalog into offline source entries
+def ingest_catalog(source=DEFAULT_CATALOG_URL, workers=DEFAULT_DIST_WORKERS):
+    """Function to stream a sucatalog path or URL and return its installers as offline source entries, newest first."""
+    stream = open_catalog(source)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for identifier, product in iter_products(stream):
+                if not is_install_assistant(product):
+                    continue
+                url = distribution_url(product)
+                # Distribution files are fetched while the rest of the catalog is still being parsed
+                future = executor.submit(fetch_distribution, url) if url else None
+                pending.append((identifier, product, url, future))
+
+            entries = []
+            for identifier, product, url, future in pending:
+                try:
+                    info = future.result() if future is not None else parse_distribution(b"")
+                except requests.exceptions.RequestException as e:
+                    # One unreachable distribution only costs its own product
+                    print(f"Warning: skipped {identifier}, its distribution could not be fetched: {e}")
+                    continue
+                if info["build"] is None:
+                    continue
+                entries.append(make_entry(identifier, product, url, info))
+    finally:
+        stream.close()
+
+    entries.sort(key=lambda entry: entry["date"], reverse=True)
+    return entries
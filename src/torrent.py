@@ -0,0 +1,636 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Minimal BitTorrent client used for magnet sources
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import base64
+import random
+import socket
+import struct
+import hashlib
+import network
+import requests
+import threading
+import downloader
+from tqdm import tqdm
+from collections import namedtuple
+from urllib.parse import urlparse, parse_qs, urlencode, quote_from_bytes
+
+# Size of the blocks requested from peers, the size every client serves
+BLOCK_SIZE = 16 * 1024  # 16 KB
+
+# Number of block requests kept in flight on each peer connection
+PIPELINE_DEPTH = 16
+
+# Number of peers pieces are pulled from at the same time
+DEFAULT_MAX_PEERS = 16
+
+# Seconds to connect to a peer, and to wait for its next message
+CONNECT_TIMEOUT = 10
+PEER_TIMEOUT = 30
+
+# Timeout (connect, read) in seconds for HTTP tracker announces
+TRACKER_TIMEOUT = (15, 30)
+
+# Seconds to wait for a UDP tracker reply, and how often to send the request
+UDP_TIMEOUT = 5
+UDP_RETRIES = 3
+
+# Number of pieces failing their hash check before a peer is dropped
+MAX_BAD_PIECES = 3
+
+# Port announced to trackers, incoming connections are not accepted
+ANNOUNCE_PORT = 6881
+
+# Client prefix of our peer id, Azureus style
+CLIENT_ID = b"-DF0100-"
+
+# Peer wire message ids
+CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD, REQUEST, PIECE, CANCEL = range(9)
+EXTENDED = 20
+
+# Id we assign to the ut_metadata extension in our extended handshake
+UT_METADATA_ID = 1
+
+# Parsed magnet link, peers are (host, port) pairs from x.pe
+Magnet = namedtuple("Magnet", ["info_hash", "name", "trackers", "peers"])
+
+class TorrentError(RuntimeError):
+    """Raised when a torrent cannot be fetched, e.g. no peers, bad metadata or a protocol error."""
+
+# Function to decode one bencoded value starting at index
+def decode_value(data, index=0):
+    """Function to return (value, end index) for the bencoded value at index, dict keys stay bytes."""
+    token = data[index:index + 1]
+    if token == b"i":
+        end = data.index(b"e", index)
+        return int(data[index + 1:end]), end + 1
+    if token == b"l":
+        index += 1
+        items = []
+        while data[index:index + 1] != b"e":
+            item, index = decode_value(data, index)
+            items.append(item)
+        return items, index + 1
+    if token == b"d":
+        index += 1
+        items = {}
+        while data[index:index + 1] != b"e":
+            key, index = decode_value(data, index)
+            items[key], index = decode_value(data, index)
+        return items, index + 1
+    if token.isdigit():
+        colon = data.index(b":", index)
+        start = colon + 1
+        end = start + int(data[index:colon])
+        if end > len(data):
+            raise TorrentError("Truncated bencoded string")
+        return data[start:end], end
+    raise TorrentError("Invalid bencoded data")
+
+# Function to decode a complete bencoded message
+def bdecode(data):
+    """Function to decode bencoded bytes, raising TorrentError when they are malformed."""
+    try:
+        value, end = decode_value(data)
+    except (ValueError, IndexError) as e:
+        raise TorrentError(f"Invalid bencoded data: {e}") from e
+    if end != len(data):
+        raise TorrentError("Trailing data after bencoded value")
+    return value
+
+# Function to bencode a value
+def bencode(value):
+    """Function to bencode ints, bytes, strings, lists and dicts."""
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(bencode(item) for item in value) + b"e"
+    if isinstance(value, dict):
+        items = sorted((key.encode('utf-8') if isinstance(key, str) else key, item) for key, item in value.items())
+        return b"d" + b"".join(bencode(key) + bencode(item) for key, item in items) + b"e"
+    raise TypeError(f"Cannot bencode {type(value).__name__}")
+
+# Function to split a host:port string
+def parse_address(value):
+    """Function to return (host, port) for "host:port" or "[v6]:port", raising TorrentError for anything else."""
+    host, _, port = value.rpartition(":")
+    host = host.strip("[]")
+    try:
+        number = int(port)
+    except ValueError:
+        number = 0
+    if not host or not 0 < number < 65536:
+        raise TorrentError(f"Invalid peer address: {value}")
+    return host, number
+
+# Function to read a magnet link
+def parse_magnet(uri):
+    """Function to return the Magnet of a magnet:?xt=urn:btih:... link."""
+    parsed = urlparse(uri)
+    if parsed.scheme != "magnet":
+        raise TorrentError(f"Not a magnet link: {uri}")
+    params = parse_qs(parsed.query)
+
+    info_hash = None
+    for topic in params.get("xt", []):
+        if topic.startswith("urn:btih:"):
+            value = topic[len("urn:btih:"):]
+            # Info hashes come as 40 hex digits or 32 base32 characters
+            try:
+                info_hash = bytes.fromhex(value) if len(value) == 40 else base64.b32decode(value.upper())
+            except ValueError as e:
+                # binascii.Error from base64 is a ValueError as well
+                raise TorrentError(f"Invalid BitTorrent info hash {value!r} in magnet link") from e
+    if info_hash is None or len(info_hash) != 20:
+        raise TorrentError(f"Magnet link has no BitTorrent info hash: {uri}")
+
+    name = params.get("dn", [None])[0]
+    peers = [parse_address(peer) for peer in params.get("x.pe", [])]
+    return Magnet(info_hash, name, params.get("tr", []), peers)
+
+# Function to read the peer list of a tracker reply
+def parse_peers(peers):
+    """Function to return (host, port) pairs from a compact or dictionary peer list."""
+    if isinstance(peers, bytes):
+        return [(socket.inet_ntoa(peers[index:index + 4]), struct.unpack(">H", peers[index + 4:index + 6])[0])
+                for index in range(0, len(peers) - 5, 6)]
+    return [(peer[b"ip"].decode(), peer[b"port"]) for peer in peers]
+
+# Function to ask an HTTP tracker for peers
+def announce_http(tracker, info_hash, peer_id, left):
+    """Function to announce to an http(s) tracker and return its peers."""
+    query = urlencode({"port": ANNOUNCE_PORT, "uploaded": 0, "downloaded": 0, "left": left, "compact": 1, "event": "started"})
+    separator = "&" if "?" in tracker else "?"
+    url = f"{tracker}{separator}info_hash={quote_from_bytes(info_hash)}&peer_id={quote_from_bytes(peer_id)}&{query}"
+
+    response = network.get_session().get(url, timeout=TRACKER_TIMEOUT)
+    response.raise_for_status()
+    reply = bdecode(response.content)
+    if b"failure reason" in reply:
+        raise TorrentError(reply[b"failure reason"].decode('utf-8', 'replace'))
+    return parse_peers(reply.get(b"peers", b""))
+
+# Function to send a UDP tracker request until the matching reply arrives
+def udp_exchange(sock, address, request, transaction, minimum):
+    """Function to return the reply to a UDP tracker request, retrying lost datagrams."""
+    for _ in range(UDP_RETRIES):
+        sock.sendto(request, address)
+        try:
+            reply, _ = sock.recvfrom(65536)
+        except socket.timeout:
+            continue
+        if len(reply) < 8:
+            continue
+        action, reply_transaction = struct.unpack(">II", reply[:8])
+        if reply_transaction != transaction:
+            continue
+        if action == 3:
+            raise TorrentError(reply[8:].decode('utf-8', 'replace'))
+        if len(reply) >= minimum:
+            return reply
+    raise TorrentError(f"No reply from tracker {address[0]}:{address[1]}")
+
+# Function to ask a UDP tracker for peers
+def announce_udp(tracker, info_hash, peer_id, left):
+    """Function to announce to a udp:// tracker (BEP 15) and return its peers."""
+    parsed = urlparse(tracker)
+    address = (parsed.hostname, parsed.port)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(UDP_TIMEOUT)
+        transaction = random.getrandbits(32)
+        reply = udp_exchange(sock, address, struct.pack(">QII", 0x41727101980, 0, transaction), transaction, 16)
+        connection_id = struct.unpack(">Q", reply[8:16])[0]
+
+        transaction = random.getrandbits(32)
+        request = struct.pack(">QII20s20sQQQIIIiH", connection_id, 1, transaction, info_hash, peer_id,
+                              0, left, 0, 2, 0, random.getrandbits(32), -1, ANNOUNCE_PORT)
+        reply = udp_exchange(sock, address, request, transaction, 20)
+        return parse_peers(reply[20:])
+
+# Function to ask any kind of tracker for peers
+def announce(tracker, info_hash, peer_id, left=0):
+    """Function to announce to an http(s) or udp tracker and return its peers."""
+    if tracker.startswith("udp://"):
+        return announce_udp(tracker, info_hash, peer_id, left)
+    return announce_http(tracker, info_hash, peer_id, left)
+
+# Function to collect the peers of a magnet link
+def find_peers(magnet, peer_id):
+    """Function to return the unique peers from the x.pe list and every tracker that answered."""
+    peers = list(magnet.peers)
+    for tracker in magnet.trackers:
+        try:
+            peers.extend(announce(tracker, magnet.info_hash, peer_id))
+        except (TorrentError, OSError, requests.exceptions.RequestException) as e:
+            tqdm.write(f"Tracker {tracker} failed: {e}")
+    return list(dict.fromkeys(peers))
+
+class PeerConnection:
+    """Peer wire connection tracking the choke state and the pieces the peer has."""
+
+    def __init__(self, address, info_hash, peer_id):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+        self.sock.settimeout(PEER_TIMEOUT)
+        self.choked = True
+        self.pieces = set()
+        self.extensions = {}
+        self.metadata_size = None
+
+        try:
+            # Advertise the extension protocol (BEP 10) so the peer can send us the metadata
+            reserved = bytearray(8)
+            reserved[5] |= 0x10
+            self.sock.sendall(b"\x13BitTorrent protocol" + bytes(reserved) + info_hash + peer_id)
+            reply = self.receive_exact(68)
+            if reply[1:20] != b"BitTorrent protocol" or reply[28:48] != info_hash:
+                raise TorrentError(f"Peer {address[0]}:{address[1]} does not serve this torrent")
+            if reply[25] & 0x10:
+                self.send(EXTENDED, b"\x00" + bencode({"m": {"ut_metadata": UT_METADATA_ID}}))
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """Function to close the socket, which also wakes up a thread blocked on it."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def receive_exact(self, size):
+        """Function to read exactly size bytes from the peer."""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = self.sock.recv_into(view[received:])
+            if not count:
+                raise TorrentError(f"Peer {self.address[0]}:{self.address[1]} closed the connection")
+            received += count
+        return bytes(buffer)
+
+    def send(self, message_id, payload=b""):
+        """Function to send one peer wire message."""
+        self.sock.sendall(struct.pack(">IB", len(payload) + 1, message_id) + payload)
+
+    def receive(self):
+        """Function to read the next message, update the peer state from it and return (message_id, payload)."""
+        while True:
+            length = struct.unpack(">I", self.receive_exact(4))[0]
+            # Zero length messages are keep-alives
+            if length:
+                break
+        data = self.receive_exact(length)
+        message_id, payload = data[0], data[1:]
+
+        if message_id == CHOKE:
+            self.choked = True
+        elif message_id == UNCHOKE:
+            self.choked = False
+        elif message_id == HAVE:
+            self.pieces.add(struct.unpack(">I", payload)[0])
+        elif message_id == BITFIELD:
+            self.pieces.update(index * 8 + bit for index, byte in enumerate(payload) for bit in range(8) if byte & (0x80 >> bit))
+        elif message_id == EXTENDED and payload[:1] == b"\x00":
+            handshake = bdecode(payload[1:])
+            self.extensions = handshake.get(b"m", {})
+            self.metadata_size = handshake.get(b"metadata_size")
+        return message_id, payload
+
+    def request_metadata(self, info_hash):
+        """Function to download the info dictionary of the torrent from this peer (BEP 9)."""
+        # The extended handshake arrives right after the BitTorrent one
+        while self.metadata_size is None:
+            self.receive()
+        extension_id = self.extensions.get(b"ut_metadata")
+        if not extension_id:
+            raise TorrentError(f"Peer {self.address[0]}:{self.address[1]} does not share metadata")
+
+        metadata = bytearray()
+        for piece in range((self.metadata_size + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            self.send(EXTENDED, bytes([extension_id]) + bencode({"msg_type": 0, "piece": piece}))
+            while True:
+                message_id, payload = self.receive()
+                if message_id == EXTENDED and payload[:1] == bytes([UT_METADATA_ID]):
+                    break
+            try:
+                header, end = decode_value(payload, 1)
+            except (ValueError, IndexError) as e:
+                raise TorrentError(f"Invalid metadata message: {e}") from e
+            if header.get(b"msg_type") != 1 or header.get(b"piece") != piece:
+                raise TorrentError(f"Peer {self.address[0]}:{self.address[1]} rejected the metadata request")
+            metadata += payload[end:]
+
+        if hashlib.sha1(metadata).digest() != info_hash:
+            raise TorrentError(f"Metadata from {self.address[0]}:{self.address[1]} does not match the info hash")
+        return bdecode(bytes(metadata))
+
+# Function to check a path component taken from torrent metadata
+def safe_component(component):
+    """Function to decode a path component, refusing ones that could leave the download folder."""
+    name = component.decode('utf-8', 'replace') if isinstance(component, bytes) else component
+    if name in ("", ".", "..") or "/" in name or "\\" in name:
+        raise TorrentError(f"Unsafe path in torrent: {name!r}")
+    return name
+
+class TorrentInfo:
+    """Piece layout and files of a torrent, read from its info dictionary."""
+
+    def __init__(self, info):
+        self.name = safe_component(info[b"name"])
+        self.piece_length = info[b"piece length"]
+        pieces = info[b"pieces"]
+        self.hashes = [pieces[index:index + 20] for index in range(0, len(pieces), 20)]
+
+        if b"files" in info:
+            self.files = [(os.path.join(self.name, *[safe_component(part) for part in file[b"path"]]), file[b"length"]) for file in info[b"files"]]
+        else:
+            self.files = [(self.name, info[b"length"])]
+        self.total_size = sum(length for _, length in self.files)
+
+    def piece_size(self, index):
+        """Function to return the size of a piece, the last one is usually shorter."""
+        return min(self.piece_length, self.total_size - index * self.piece_length)
+
+class TorrentStorage:
+    """Files of a torrent below a folder, written piece by piece as pieces arrive."""
+
+    def __init__(self, info, folder_path):
+        self.info = info
+        self.files = []
+        self.existing = set()
+        offset = 0
+
+        for index, (path, length) in enumerate(info.files):
+            path = os.path.join(folder_path, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                self.existing.add(index)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+            if os.fstat(fd).st_size != length:
+                os.ftruncate(fd, length)
+            self.files.append((path, fd, offset, length))
+            offset += length
+
+    def close(self):
+        """Function to close every file."""
+        for _, fd, _, _ in self.files:
+            os.close(fd)
+
+    def spans(self, index):
+        """Function to yield (file index, file offset, size, piece offset) for the parts of a piece in each file."""
+        start = index * self.info.piece_length
+        stop = start + self.info.piece_size(index)
+        for file_index, (_, _, offset, length) in enumerate(self.files):
+            low, high = max(start, offset), min(stop, offset + length)
+            if low < high:
+                yield file_index, low - offset, high - low, low - start
+
+    def file_pieces(self, file_index):
+        """Function to return the range of pieces a file overlaps."""
+        _, _, offset, length = self.files[file_index]
+        if not length:
+            return range(0)
+        return range(offset // self.info.piece_length, (offset + length - 1) // self.info.piece_length + 1)
+
+    def read(self, index):
+        """Function to read a piece back from disk."""
+        data = bytearray()
+        for file_index, offset, size, _ in self.spans(index):
+            with open(self.files[file_index][0], 'rb') as file:
+                file.seek(offset)
+                data += file.read(size)
+        return bytes(data)
+
+    def write(self, index, data):
+        """Function to write a verified piece into the files it spans."""
+        for file_index, offset, size, piece_offset in self.spans(index):
+            downloader.write_at(self.files[file_index][1], data[piece_offset:piece_offset + size], offset)
+
+    def check(self):
+        """Function to return the pieces already on disk with a matching hash, only reading files that existed before."""
+        done = set()
+        for index, expected in enumerate(self.info.hashes):
+            if all(file_index in self.existing for file_index, _, _, _ in self.spans(index)):
+                if hashlib.sha1(self.read(index)).digest() == expected:
+                    done.add(index)
+        return done
+
+class Swarm:
+    """Pulls the missing pieces of a torrent from several peers at once, one thread per peer."""
+
+    def __init__(self, info, storage, info_hash, peer_id, done, progress, on_complete=None):
+        self.info = info
+        self.storage = storage
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.progress = progress
+        self.on_complete = on_complete
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.connections = set()
+        self.done = set(done)
+        # Pieces are handed out in order so files complete, and can be unpacked, one after another
+        self.missing = [index for index in range(len(info.hashes)) if index not in self.done]
+        self.active = {}
+        self.errors = []
+
+        for file_index in range(len(storage.files)):
+            self.file_done(file_index)
+        if not self.missing:
+            self.finished.set()
+
+    def file_done(self, file_index):
+        """Function to report a file once every piece it overlaps is on disk."""
+        if self.on_complete is not None and all(index in self.done for index in self.storage.file_pieces(file_index)):
+            self.on_complete(self.storage.files[file_index][0])
+
+    def pick(self, available):
+        """Function to reserve the first missing piece a peer has, sharing pieces others are on only at the end."""
+        with self.lock:
+            candidates = [index for index in self.missing if index in available]
+            if not candidates:
+                return None
+            # Endgame, every remaining piece is already being fetched, so race the slowest ones
+            index = min(candidates, key=lambda index: self.active.get(index, 0))
+            self.active[index] = self.active.get(index, 0) + 1
+            return index
+
+    def release(self, index):
+        with self.lock:
+            self.active[index] -= 1
+            if not self.active[index]:
+                del self.active[index]
+
+    def complete(self, index, data):
+        """Function to store a verified piece, ignoring duplicates from the endgame."""
+        with self.lock:
+            if index in self.done:
+                return
+            self.storage.write(index, data)
+            self.done.add(index)
+            self.missing.remove(index)
+            finished = not self.missing
+        self.progress.update(len(data))
+
+        for file_index, _, _, _ in self.storage.spans(index):
+            self.file_done(file_index)
+        if finished:
+            self.finished.set()
+
+    def fetch_piece(self, connection, index):
+        """Function to download one piece from a peer with several block requests in flight."""
+        size = self.info.piece_size(index)
+        buffer = bytearray(size)
+        queued = list(range(0, size, BLOCK_SIZE))
+        requested = set()
+
+        while queued or requested:
+            while queued and len(requested) < PIPELINE_DEPTH and not connection.choked:
+                begin = queued.pop(0)
+                connection.send(REQUEST, struct.pack(">III", index, begin, min(BLOCK_SIZE, size - begin)))
+                requested.add(begin)
+            if self.finished.is_set() or index in self.done:
+                return None
+
+            message_id, payload = connection.receive()
+            if message_id == PIECE:
+                piece, begin = struct.unpack(">II", payload[:8])
+                block = payload[8:]
+                if piece == index and begin in requested:
+                    buffer[begin:begin + len(block)] = block
+                    requested.discard(begin)
+                    network.throttle(len(block))
+            elif message_id == CHOKE:
+                # A choking peer drops our pending requests, ask again once unchoked
+                queued = sorted(requested) + queued
+                requested.clear()
+
+        return bytes(buffer)
+
+    def run_peer(self, address):
+        """Function to pull pieces from one peer until the torrent is complete or the peer fails."""
+        try:
+            connection = PeerConnection(address, self.info_hash, self.peer_id)
+        except (OSError, TorrentError):
+            return
+
+        with self.lock:
+            self.connections.add(connection)
+        bad_pieces = 0
+        try:
+            connection.send(INTERESTED)
+            while not self.finished.is_set():
+                if connection.choked:
+                    connection.receive()
+                    continue
+                index = self.pick(connection.pieces)
+                if index is None:
+                    # Wait for the peer to announce more pieces, it times out if it has nothing left for us
+                    connection.receive()
+                    continue
+                try:
+                    data = self.fetch_piece(connection, index)
+                finally:
+                    self.release(index)
+                if data is None:
+                    continue
+                if hashlib.sha1(data).digest() == self.info.hashes[index]:
+                    self.complete(index, data)
+                else:
+                    bad_pieces += 1
+                    if bad_pieces >= MAX_BAD_PIECES:
+                        raise TorrentError(f"Peer {address[0]}:{address[1]} sent {bad_pieces} corrupt pieces")
+        except (OSError, TorrentError, struct.error) as e:
+            if not self.finished.is_set():
+                with self.lock:
+                    self.errors.append(e)
+        finally:
+            with self.lock:
+                self.connections.discard(connection)
+            connection.close()
+
+    def run(self, peers):
+        """Function to download from the peers until every piece is on disk, raising TorrentError when they all drop out first."""
+        threads = [threading.Thread(target=self.run_peer, args=(address,), daemon=True) for address in peers]
+        for thread in threads:
+            thread.start()
+
+        while not self.finished.wait(1):
+            if not any(thread.is_alive() for thread in threads):
+                break
+
+        # Unblock peers still waiting on a socket
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+        for thread in threads:
+            thread.join()
+
+        if not self.finished.is_set():
+            reason = f": {self.errors[-1]}" if self.errors else ""
+            raise TorrentError(f"{len(self.missing)} pieces of {self.info.name} could not be fetched from {len(peers)} peers{reason}")
+
+# Function to fetch the info dictionary of a magnet link
+def fetch_metadata(magnet, peers, peer_id):
+    """Function to ask the peers in turn for the torrent metadata until one of them serves it."""
+    errors = []
+    for address in peers:
+        try:
+            connection = PeerConnection(address, magnet.info_hash, peer_id)
+        except (OSError, TorrentError) as e:
+            errors.append(e)
+            continue
+        try:
+            return TorrentInfo(connection.request_metadata(magnet.info_hash))
+        except (OSError, TorrentError, KeyError, struct.error) as e:
+            errors.append(e)
+        finally:
+            connection.close()
+    reason = f": {errors[-1]}" if errors else ""
+    raise TorrentError(f"No peer served the metadata of {magnet.name or magnet.info_hash.hex()}{reason}")
+
+# Function to download the files of a magnet link
+def download_magnet(uri, folder_path, max_peers=DEFAULT_MAX_PEERS, on_start=None, on_complete=None, progress_factory=downloader.default_progress):
+    """Function to download a magnet link into folder_path, pulling pieces from several peers, and return the file paths.
+
+    on_start(destination, size) runs once the size is known, on_complete(path) as soon as each file is complete.
+    Pieces already on disk from an earlier run are kept after their hash is checked.
+    """
+    magnet = parse_magnet(uri)
+    peer_id = CLIENT_ID + "".join(random.choice("0123456789") for _ in range(12)).encode()
+
+    peers = find_peers(magnet, peer_id)
+    if not peers:
+        raise TorrentError(f"No peers found for {magnet.name or magnet.info_hash.hex()}")
+
+    info = fetch_metadata(magnet, peers, peer_id)
+    if on_start is not None:
+        on_start(os.path.join(folder_path, info.name), info.total_size)
+
+    storage = TorrentStorage(info, folder_path)
+    try:
+        done = storage.check()
+        progress = progress_factory(info.total_size, sum(info.piece_size(index) for index in done))
+        try:
+            Swarm(info, storage, magnet.info_hash, peer_id, done, progress, on_complete).run(peers[:max_peers])
+        finally:
+            progress.close()
+    finally:
+        storage.close()
+
+    return [path for path, _, _, _ in storage.files]
@@ -0,0 +1,150 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Transfer backends picked by the method field of a source
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import cache
+import torrent
+import sources
+import downloader
+from abc import ABC, abstractmethod
+from urllib.parse import unquote_plus
+
+# Method used by sources that do not name one
+DEFAULT_METHOD = "https"
+
+# Registered backend classes by method name
+_backends = {}
+
+class TransferError(RuntimeError):
+    """Raised when a source asks for a transfer method no backend handles."""
+
+# Function to register a backend class for its method
+def register(backend_class):
+    """Function to make a TransferBackend subclass available under its method name, usable as a class decorator."""
+    _backends[backend_class.method] = backend_class
+    return backend_class
+
+# Function to create the backend for a transfer method
+def get_backend(method, config):
+    """Function to return the backend handling method, configured from the config."""
+    backend_class = _backends.get(method or DEFAULT_METHOD)
+    if backend_class is None:
+        raise TransferError(f"Unsupported transfer method: {method}")
+    return backend_class(config)
+
+# Function to extract the filename from a given URL
+def extract_filename_from_url(url):
+    """Extracts the filename from a given URL."""
+    return unquote_plus(os.path.basename(url))
+
+# Function to read the download engine settings from the config
+def download_options(config):
+    """Function to return the segment count, minimum segment size and resume flag from the config."""
+    segments = config.get("download_segments", downloader.DEFAULT_SEGMENTS)
+    min_segment_size = config.get("min_segment_size", downloader.DEFAULT_MIN_SEGMENT_SIZE)
+    resume = config.get("resume_downloads", True)
+    return segments, min_segment_size, resume
+
+# Function to download several files at once via HTTP/HTTPS
+def download_files(jobs, config, on_start=None, on_complete=None):
+    """Function to download (url, destination, size, integrity_url) jobs concurrently using the settings from the config, returning True when all succeeded."""
+    parallel = config.get("parallel_downloads", downloader.DEFAULT_PARALLEL_DOWNLOADS)
+    verify = config.get("verify_integrity", True)
+    download_cache = None
+    if config.get("cache_enabled", True):
+        download_cache = cache.DownloadCache(config.get("cache_dir", cache.DEFAULT_CACHE_DIR), config.get("cache_max_size", cache.DEFAULT_CACHE_MAX_SIZE))
+    results = downloader.download_all(jobs, parallel, *download_options(config), verify, download_cache, on_start, on_complete)
+
+    for destination, error in results:
+        if error is None:
+            print(f"Downloaded to: {destination}")
+        else:
+            print(f"Error downloading file: {error}")
+
+    return all(error is None for _, error in results)
+
+class TransferBackend(ABC):
+    """Base class of the transfer backends.
+
+    jobs() turns the packages of a source into jobs, download() runs the jobs of any number of sources
+    as one batch and returns True when all succeeded. on_start(destination, size) may block to hold a
+    job back, on_complete(path) is called for every file as soon as it is on disk.
+    """
+
+    method = None
+
+    def __init__(self, config):
+        self.config = config
+
+    @abstractmethod
+    def jobs(self, source, folder_path):
+        """Function to return the jobs downloading the packages of source into folder_path."""
+
+    @abstractmethod
+    def download(self, jobs, on_start=None, on_complete=None):
+        """Function to run jobs, returning True when all of them succeeded."""
+
+@register
+class HttpsBackend(TransferBackend):
+    """Plain HTTP/HTTPS downloads of the package URLs through the shared download engine."""
+
+    method = "https"
+
+    def jobs(self, source, folder_path):
+        """Function to return a (url, destination, size, integrity_url) job for each package with a URL."""
+        jobs = []
+        for package in source.get("packages", []):
+            package_name = package.get("name", "Unknown Package")
+            package_url = package.get("url")
+
+            if package_url:
+                # Extract filename from package URL
+                filename = extract_filename_from_url(package_url)
+
+                # Print initialization text
+                print(f"\nInitializing download of {package_name}")
+
+                jobs.append((sources.package_mirrors(package), os.path.join(folder_path, filename), package.get("size"), None))
+            else:
+                print(f"No URL found for package: {package_name}")
+
+        return jobs
+
+    def download(self, jobs, on_start=None, on_complete=None):
+        return download_files(jobs, self.config, on_start, on_complete)
+
+@register
+class MagnetBackend(TransferBackend):
+    """BitTorrent downloads of the magnet link of a source, pulling pieces from several peers at once."""
+
+    method = "magnet"
+
+    def jobs(self, source, folder_path):
+        """Function to return a (magnet, folder_path, size) job for the source's magnet link."""
+        magnet = source.get("magnet")
+        if not magnet or not magnet.startswith("magnet:"):
+            print(f"No magnet link found for source: {source.get('name', 'Unknown Name')}")
+            return []
+
+        print(f"\nInitializing torrent of {source.get('name', 'Unknown Name')}")
+        return [(magnet, folder_path, source.get("size"))]
+
+    def download(self, jobs, on_start=None, on_complete=None):
+        max_peers = self.config.get("torrent_max_peers", torrent.DEFAULT_MAX_PEERS)
+        success = True
+
+        for magnet, folder_path, _ in jobs:
+            try:
+                for path in torrent.download_magnet(magnet, folder_path, max_peers, on_start, on_complete):
+                    print(f"Downloaded to: {path}")
+            except (torrent.TorrentError, OSError) as e:
+                print(f"Error downloading torrent: {e}")
+                success = False
+
+        return success
@@ -0,0 +1,273 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Parallel extraction of downloaded .zip and .7z archives
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import stat
+import time
+import py7zr
+import shutil
+import zipfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Archive types handled by the extractor
+ARCHIVE_EXTENSIONS = (".zip", ".7z")
+
+# Size of the buffer used to copy each zip member to disk
+BUFFER_SIZE = 1024 * 1024  # 1 MB
+
+# Seconds between two disk usage samples while archives are being extracted
+SAMPLE_INTERVAL = 0.2
+
+# Free space kept on top of a download's own size before it may start
+DEFAULT_DISK_RESERVE = 1024 * 1024 * 1024  # 1 GB
+
+# Extracted bytes per archive byte assumed until an archive of the run has been unpacked
+DEFAULT_EXPANSION = 2.0
+
+# Outcome of extracting one archive, sizes in bytes
+ExtractResult = namedtuple("ExtractResult", ["archive", "destination", "archive_size", "extracted_size", "seconds", "peak_size"])
+
+# Function to check if a file is an archive the extractor handles
+def is_archive(path):
+    """Function to return True for visible .zip and .7z files."""
+    name = os.path.basename(path)
+    return not name.startswith('.') and name.endswith(ARCHIVE_EXTENSIONS)
+
+# Function to stream the members of a zip file to disk
+def extract_zip(archive, destination):
+    """Function to extract a zip member by member through a bounded buffer, returning the bytes written."""
+    root = os.path.realpath(destination)
+    written = 0
+
+    with zipfile.ZipFile(archive, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            target = os.path.realpath(os.path.join(root, member.filename))
+            # Never write outside the extraction folder, like ZipFile.extractall
+            if os.path.commonpath([root, target]) != root:
+                continue
+
+            if member.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with zip_ref.open(member) as source, open(target, 'wb') as output:
+                shutil.copyfileobj(source, output, BUFFER_SIZE)
+            written += member.file_size
+
+    return written
+
+# Function to add up the size of an extracted tree
+def tree_size(path):
+    """Function to return the total size of the files below path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+# Function to get the space a file already takes on disk
+def allocated_size(path):
+    """Function to return the bytes allocated to a regular file, preallocated blocks included where the platform reports them, 0 for anything else."""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return 0
+    if not stat.S_ISREG(info.st_mode):
+        return 0
+    blocks = getattr(info, "st_blocks", None)
+    return blocks * 512 if blocks is not None else info.st_size
+
+# Function to extract one archive next to itself and delete it
+def extract_archive(archive):
+    """Function to extract archive into a folder named after it, remove the archive and return an ExtractResult."""
+    destination = os.path.splitext(archive)[0]
+    archive_size = os.path.getsize(archive)
+    os.makedirs(destination, exist_ok=True)
+    start = time.monotonic()
+
+    if archive.endswith(".zip"):
+        extracted_size = extract_zip(archive, destination)
+    else:
+        with py7zr.SevenZipFile(archive, mode='r') as z:
+            z.extractall(destination)
+        extracted_size = tree_size(destination)
+
+    # The archive and its extracted tree both exist until this point
+    os.remove(archive)
+    return ExtractResult(archive, destination, archive_size, extracted_size, time.monotonic() - start, archive_size + extracted_size)
+
+# Function to format a byte count for reports
+def format_size(size):
+    """Function to format a byte count in MB."""
+    return f"{size / (1024 * 1024):.1f} MB"
+
+# Function to describe the result of one extraction
+def describe(result):
+    """Function to return a one-line report with the throughput and peak disk use of an extraction."""
+    rate = result.extracted_size / result.seconds if result.seconds > 0 else 0
+    return (f"Successfully unpacked: {os.path.basename(result.archive)} "
+            f"({format_size(result.extracted_size)} in {result.seconds:.1f}s, {format_size(rate)}/s, peak disk {format_size(result.peak_size)})")
+
+class DiskSampler:
+    """Background thread recording the peak disk usage growth of a filesystem."""
+
+    def __init__(self, path):
+        self.path = path
+        self.baseline = shutil.disk_usage(path).used
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.sample()
+            if self.stop_event.wait(SAMPLE_INTERVAL):
+                return
+
+    def sample(self):
+        self.peak = max(self.peak, shutil.disk_usage(self.path).used - self.baseline)
+
+    def stop(self):
+        """Function to stop sampling and return the peak growth in bytes."""
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+        return self.peak
+
+class ArchiveExtractor:
+    """Process pool extracting archives as they are submitted, e.g. as soon as each download finishes."""
+
+    def __init__(self, folder_path, workers=None):
+        self.folder_path = folder_path
+        self.executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+        self.futures = []
+        self.lock = threading.Lock()
+        self.sampler = DiskSampler(folder_path)
+        self.start = time.monotonic()
+
+    def submit(self, path):
+        """Function to queue an archive for extraction, ignoring files that are not archives."""
+        if is_archive(path):
+            size = os.path.getsize(path)
+            with self.lock:
+                self.futures.append((path, size, self.executor.submit(extract_archive, path)))
+
+    def pending(self):
+        """Function to return the futures of archives that are still being extracted."""
+        with self.lock:
+            return [future for _, _, future in self.futures if not future.done()]
+
+    def backlog(self):
+        """Function to return the sizes of the archives that are still queued or being extracted."""
+        with self.lock:
+            return [size for _, size, future in self.futures if not future.done()]
+
+    def expansion(self, default):
+        """Function to return the largest extracted to archive size ratio of this run, default until an archive is done."""
+        with self.lock:
+            finished = [future for _, _, future in self.futures if future.done() and not future.cancelled() and future.exception() is None]
+        ratios = [result.extracted_size / result.archive_size for result in (future.result() for future in finished) if result.archive_size > 0]
+        return max(ratios) if ratios else default
+
+    def submit_folder(self):
+        """Function to queue every archive below the folder."""
+        for root, _, files in os.walk(self.folder_path):
+            for file in files:
+                self.submit(os.path.join(root, file))
+
+    def wait(self):
+        """Function to wait for every queued archive, print a report per archive and return the ExtractResults."""
+        results = []
+        try:
+            for path, _, future in self.futures:
+                file = os.path.basename(path)
+                try:
+                    result = future.result()
+                    results.append(result)
+                    print(describe(result))
+                except zipfile.BadZipFile:
+                    print(f"Error: {file} is not a valid zip file.")
+                except py7zr.exceptions.Bad7zFile:
+                    print(f"Error: {file} is not a valid 7z file.")
+                except Exception as e:
+                    print(f"Error unpacking {file}: {e}")
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            peak = self.sampler.stop()
+
+        if results:
+            total = sum(result.extracted_size for result in results)
+            seconds = time.monotonic() - self.start
+            print(f"Unpacked {len(results)} archives, {format_size(total)} in {seconds:.1f}s, peak disk growth {format_size(peak)}.")
+        return results
+
+class DiskGuard:
+    """Backpressure for a download-then-extract pipeline, holding a download back until it fits on disk together with what it unpacks to.
+
+    An archive and its extracted tree exist side by side until the archive is removed, so an archive
+    download needs its size times (1 + expansion) free, expansion being the largest ratio seen in this
+    run. Space that running downloads and queued extractions will still take is set aside first.
+    """
+
+    def __init__(self, folder_path, extractor, reserve=DEFAULT_DISK_RESERVE, expansion=DEFAULT_EXPANSION):
+        self.folder_path = folder_path
+        self.extractor = extractor
+        self.reserve = reserve
+        self.expansion = expansion
+        self.downloads = {}
+        self.lock = threading.Lock()
+
+    def footprint(self, destination, size, expansion):
+        """Function to return the most space a download takes on disk, its extraction included for archives."""
+        return size * (1 + expansion) if is_archive(destination) else size
+
+    def committed(self, expansion):
+        """Function to return the bytes running downloads and queued extractions will still add to the disk."""
+        with self.lock:
+            downloads = list(self.downloads.items())
+        total = sum(self.footprint(destination, size, expansion) - min(size, allocated_size(destination)) for destination, size in downloads)
+        return total + sum(size * expansion for size in self.extractor.backlog())
+
+    def wait(self, destination, size):
+        """Function to block until the download and its extraction fit next to everything already committed, for as long as extractions can still make room."""
+        announced = False
+        while True:
+            expansion = self.extractor.expansion(self.expansion)
+            needed = self.footprint(destination, size, expansion) + self.reserve
+            if shutil.disk_usage(self.folder_path).free - self.committed(expansion) >= needed:
+                break
+            pending = self.extractor.pending()
+            if not pending:
+                # Finished extractions free their archives, without any left the download tries anyway
+                print(f"Warning: {os.path.basename(destination)} and its unpacked files may not fit in the free disk space.")
+                break
+            if not announced:
+                print(f"Waiting for extractions to finish before downloading {os.path.basename(destination)}, disk space is low.")
+                announced = True
+            wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+
+        with self.lock:
+            self.downloads[destination] = size
+
+    def submit(self, path):
+        """Function to hand a finished download to the extractor, moving its space from the download to the extraction."""
+        with self.lock:
+            if path in self.downloads:
+                del self.downloads[path]
+            else:
+                # A file of a torrent folder, the rest of the folder is still downloading
+                for destination, size in self.downloads.items():
+                    if path.startswith(destination + os.sep):
+                        self.downloads[destination] = max(0, size - os.path.getsize(path))
+                        break
+        self.extractor.submit(path)
@@ -0,0 +1,30 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Shared pytest setup, makes the flat modules in src importable
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+import mirrors
+from tqdm import tqdm
+
+@pytest.fixture(autouse=True)
+def mirror_stats(tmp_path, monkeypatch):
+    """Keep mirror health statistics of a test out of data/ and away from the other tests."""
+    stats = mirrors.MirrorStats(str(tmp_path / "mirror_stats.json"))
+    monkeypatch.setattr(mirrors, "stats", stats)
+    return stats
+
+@pytest.fixture
+def quiet_progress():
+    """Progress factory for the download engine that draws nothing."""
+    return lambda total, initial=0: tqdm(total=total, initial=initial, disable=True)
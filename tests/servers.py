@@ -0,0 +1,255 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Local HTTP servers standing in for Apple's CDN in the tests
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import re
+import time
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Amount of data written to the socket per iteration
+BLOCK_SIZE = 64 * 1024  # 64 KB
+
+# Amount written per iteration by a server trickling after a stall
+TRICKLE_SIZE = 1024  # 1 KB
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serves the files of its FileServer with the behaviour the server was configured with."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def serve(self, send_body):
+        server = self.server.owner
+        path = self.path.split('?', 1)[0]
+        with server.lock:
+            server.requests.append((self.command, path, self.headers.get("Range")))
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.fail_after is not None and server.served >= server.fail_after:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        data = server.files.get(path)
+        if data is None or (not send_body and not server.head):
+            self.send_response(404 if data is None else 405)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        size = len(data)
+        etag = server.etag_of(path)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        start, end, status = 0, size - 1, 200
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get("Range") or "")
+        if_range = self.headers.get("If-Range")
+        if server.ranges and match and (if_range is None or if_range == etag):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            status = 206
+
+        self.send_response(status)
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(end - start + 1))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        offset = start
+        try:
+            while offset <= end:
+                if server.fail_after is not None and server.served >= server.fail_after:
+                    # Drop the connection halfway through the body
+                    self.close_connection = True
+                    return
+                stalled = server.stall_after is not None and server.served >= server.stall_after
+                if stalled and not server.stall_rate:
+                    # Keep the connection open without sending anything, like a dead CDN edge
+                    server.released.wait()
+                    return
+                block = data[offset:min(offset + (TRICKLE_SIZE if stalled else BLOCK_SIZE), end + 1)]
+                self.wfile.write(block)
+                offset += len(block)
+                with server.lock:
+                    server.served += len(block)
+                rate = server.stall_rate if stalled else server.rate
+                if rate:
+                    time.sleep(len(block) / rate)
+        except (ConnectionError, OSError):
+            pass
+
+class FileServer:
+    """Threaded HTTP server on 127.0.0.1 serving in-memory files, optionally slow, stalling, failing or without HEAD and Range support.
+
+    latency is added before every response, rate caps each connection in bytes per second.
+    Once the server as a whole has sent stall_after bytes it trickles at stall_rate bytes per second,
+    or sends nothing more when stall_rate is 0. Once it has sent fail_after bytes it drops its
+    connections and answers 503. Every request is recorded in requests as (method, path, range).
+    """
+
+    def __init__(self, files, ranges=True, head=True, latency=0, rate=0, stall_after=None, etag=None, stall_rate=0, fail_after=None):
+        self.files = dict(files)
+        self.ranges = ranges
+        self.head = head
+        self.latency = latency
+        self.rate = rate
+        self.stall_after = stall_after
+        self.stall_rate = stall_rate
+        self.fail_after = fail_after
+        self.etag = etag
+        self.requests = []
+        self.served = 0
+        self.lock = threading.Lock()
+        self.released = threading.Event()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), FileHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.owner = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def etag_of(self, path):
+        """Function to return the ETag of a file, derived from its content unless one was configured."""
+        if self.etag is not None:
+            return self.etag
+        return '"' + hashlib.sha1(self.files[path]).hexdigest()[:16] + '"'
+
+    def url(self, path):
+        """Function to return the URL of a served path."""
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+
+    def gets(self, path=None):
+        """Function to return the recorded GET requests, only those of path when given."""
+        with self.lock:
+            return [entry for entry in self.requests if entry[0] == "GET" and (path is None or entry[1] == path)]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.released.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class RecoveryHandler(BaseHTTPRequestHandler):
+    """Answers session and RecoveryImage queries the way osrecovery.apple.com does."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server.owner
+        with server.lock:
+            server.sessions += 1
+            cookie = f"session=stand-in-{server.sessions}"
+            server.issued.add(cookie)
+        self.send_response(200)
+        self.send_header("Set-Cookie", f"{cookie}; Max-Age=900; Path=/")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server.owner
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        query = dict(line.split("=", 1) for line in body.split("\n") if "=" in line)
+        if self.headers.get("Cookie") not in server.issued:
+            self.send_response(403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with server.lock:
+            server.queries.append(query)
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(server.latency(query) if callable(server.latency) else server.latency)
+            product = server.products.get((query.get("bid"), query.get("sn"), query.get("os")))
+            if product is None:
+                product = server.products.get((query.get("bid"), None, query.get("os")))
+        finally:
+            with server.lock:
+                server.active -= 1
+
+        if product is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        answer = "\n".join(f"{key}: {value}" for key, value in server.image_info(product).items()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+class RecoveryServer:
+    """Local stand-in for osrecovery.apple.com returning canned AP/AU/AH/... answers.
+
+    products maps (bid, sn, os) to a product name, sn None matching any serial. Queries without a
+    product get a 404, queries with a session cookie the server did not hand out a 403. latency is a number of seconds or a function of the parsed query, and peak
+    records the highest number of queries that were answered at the same time.
+    """
+
+    def __init__(self, products, latency=0):
+        self.products = dict(products)
+        self.latency = latency
+        self.queries = []
+        self.sessions = 0
+        self.issued = set()
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), RecoveryHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.owner = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def image_info(self, product):
+        """Function to return the canned image info of a product."""
+        return {
+            "AP": product,
+            "AU": f"{self.url}/{product}/BaseSystem.dmg",
+            "AH": hashlib.sha1(product.encode("utf-8")).hexdigest().upper(),
+            "AT": f"image-token-{product}",
+            "CU": f"{self.url}/{product}/BaseSystem.chunklist",
+            "CH": hashlib.sha1(product.encode("utf-8") + b"cnk").hexdigest().upper(),
+            "CT": f"chunklist-token-{product}",
+        }
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
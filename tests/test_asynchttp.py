@@ -0,0 +1,48 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of the asyncio HTTP client against local stand-in servers
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import asyncio
+import pytest
+import network
+import asynchttp
+from servers import FileServer
+
+PAYLOAD = os.urandom(256 * 1024)
+
+def fetch(url):
+    async def run():
+        async with asynchttp.AsyncHttpClient() as client:
+            response = await client.request("GET", url, {})
+            try:
+                return await response.content()
+            finally:
+                response.close()
+
+    return asyncio.run(run())
+
+def test_requests_go_through_the_environment_proxy(monkeypatch):
+    # The stand-in proxy only knows the file by its absolute URL, as a forward proxy receives it
+    with FileServer({"http://upstream.invalid/big.pkg": PAYLOAD}) as proxy_server:
+        for name in ("HTTP_PROXY", "NO_PROXY", "no_proxy"):
+            monkeypatch.delenv(name, raising=False)
+        monkeypatch.setenv("http_proxy", f"http://127.0.0.1:{proxy_server.httpd.server_address[1]}")
+
+        assert fetch("http://upstream.invalid/big.pkg") == PAYLOAD
+        assert proxy_server.gets() == [("GET", "http://upstream.invalid/big.pkg", None)]
+
+def test_retry_statuses_are_retried_like_the_shared_session(monkeypatch):
+    monkeypatch.setitem(network._options, "retries", 2)
+    monkeypatch.setitem(network._options, "backoff_factor", 0)
+    with FileServer({"/big.pkg": PAYLOAD}, fail_after=0) as server:
+        with pytest.raises(asynchttp.HttpStatusError) as err:
+            fetch(server.url("/big.pkg"))
+
+        assert err.value.status == 503
+        assert len(server.gets()) == 3
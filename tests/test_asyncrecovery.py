@@ -0,0 +1,160 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of the asyncio recovery client against local stand-in servers
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import asyncio
+import hashlib
+import pytest
+import journal
+import integrity
+import macrecovery
+from servers import FileServer, RecoveryServer
+
+# Boards the stand-in knows, each with its own product
+BOARDS = [f"Mac-{index:016X}" for index in range(200)]
+PRODUCTS = {(board, None, "default"): f"041-{index:04d}" for index, board in enumerate(BOARDS)}
+
+@pytest.fixture
+def recovery(tmp_path, monkeypatch):
+    """Point macrecovery at a stand-in server with 50 ms of latency per query."""
+    with RecoveryServer(PRODUCTS, latency=0.05) as server:
+        monkeypatch.setattr(macrecovery, "RECOVERY_URL", server.url)
+        monkeypatch.setattr(macrecovery, "session_manager", macrecovery.SessionManager(str(tmp_path / "session.json")))
+        monkeypatch.setattr(macrecovery, "info_cache", None)
+        yield server
+
+def test_queries_run_concurrently_on_one_loop(recovery):
+    targets = [macrecovery.RecoveryTarget(board) for board in BOARDS] + [macrecovery.RecoveryTarget("Mac-UNKNOWN")]
+
+    start = time.monotonic()
+    results = macrecovery.resolve_images(targets, jobs=32)
+    elapsed = time.monotonic() - start
+
+    assert [results[target][macrecovery.INFO_PRODUCT] for target in targets[:-1]] == [f"041-{index:04d}" for index in range(200)]
+    assert isinstance(results[targets[-1]], macrecovery.RecoveryError)
+    assert 1 < recovery.peak <= 32
+    # 201 queries one after the other would take over 10 s
+    assert elapsed < 5
+    assert recovery.sessions == 1
+
+def test_rejected_session_is_renewed_once(recovery):
+    # A cookie the server never handed out, still valid as far as the client knows
+    macrecovery.session_manager.store("session=stale", time.time() + 600)
+
+    async def resolve():
+        async with macrecovery.AsyncRecoveryClient(16) as client:
+            return await client.get_image_infos([macrecovery.RecoveryTarget(board) for board in BOARDS[:50]])
+
+    results = asyncio.run(resolve())
+    assert all(not isinstance(info, Exception) for info in results.values())
+    assert recovery.sessions == 1
+    assert macrecovery.session_manager.cached() == "session=stand-in-1"
+
+def test_cancelled_stream_resumes(tmp_path):
+    payload = os.urandom(4 * 1024 * 1024)
+    chunks = [(1024 * 1024, hashlib.sha256(payload[offset:offset + 1024 * 1024]).digest()) for offset in range(0, len(payload), 1024 * 1024)]
+    with FileServer({"/BaseSystem.dmg": payload}, rate=4 * 1024 * 1024) as server:
+        url = server.url("/BaseSystem.dmg")
+
+        async def cancel_midway():
+            async with macrecovery.AsyncRecoveryClient() as client:
+                task = asyncio.create_task(client.save_image(url, "token", directory=str(tmp_path), chunks=chunks))
+                await asyncio.sleep(0.4)
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+
+        asyncio.run(cancel_midway())
+        path = tmp_path / "BaseSystem.dmg"
+        assert os.path.exists(journal.journal_path(str(path)))
+        kept = path.stat().st_size
+        assert 0 < kept < len(payload)
+
+        async def finish():
+            async with macrecovery.AsyncRecoveryClient() as client:
+                return await client.save_image(url, "token", directory=str(tmp_path), chunks=chunks)
+
+        assert asyncio.run(finish()) == str(path)
+        assert path.read_bytes() == payload
+        assert server.gets()[-1][2] == f"bytes={kept}-"
+        assert not os.path.exists(journal.journal_path(str(path)))
+
+def test_corrupt_stream_is_not_resumed(tmp_path):
+    payload = os.urandom(2 * 1024 * 1024)
+    chunks = [(1024 * 1024, hashlib.sha256(payload[:1024 * 1024]).digest()), (1024 * 1024, b"\0" * 32)]
+    with FileServer({"/BaseSystem.dmg": payload}) as server:
+        async def download():
+            async with macrecovery.AsyncRecoveryClient() as client:
+                await client.save_image(server.url("/BaseSystem.dmg"), "token", directory=str(tmp_path), chunks=chunks)
+
+        with pytest.raises(integrity.IntegrityError, match="chunk 2 failed verification"):
+            asyncio.run(download())
+        assert not os.path.exists(journal.journal_path(str(tmp_path / "BaseSystem.dmg")))
+
+def test_corrupt_kept_bytes_fail_the_resumed_stream(tmp_path):
+    payload = os.urandom(4 * 1024 * 1024)
+    chunks = [(1024 * 1024, hashlib.sha256(payload[offset:offset + 1024 * 1024]).digest()) for offset in range(0, len(payload), 1024 * 1024)]
+    with FileServer({"/BaseSystem.dmg": payload}, rate=4 * 1024 * 1024) as server:
+        url = server.url("/BaseSystem.dmg")
+
+        async def download(cancel_after=None):
+            async with macrecovery.AsyncRecoveryClient() as client:
+                task = asyncio.create_task(client.save_image(url, "token", directory=str(tmp_path), chunks=chunks))
+                if cancel_after is None:
+                    return await task
+                await asyncio.sleep(cancel_after)
+                task.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await task
+
+        asyncio.run(download(0.4))
+        path = tmp_path / "BaseSystem.dmg"
+        with open(path, "r+b") as file:
+            file.write(bytes([payload[0] ^ 0xFF]))
+
+        # The bytes kept from the first run are read back and checked before the image is accepted
+        with pytest.raises(integrity.IntegrityError, match="chunk 1 failed verification"):
+            asyncio.run(download())
+        assert not os.path.exists(journal.journal_path(str(path)))
+
+def test_stalled_stream_times_out(tmp_path):
+    with FileServer({"/BaseSystem.dmg": os.urandom(1024 * 1024)}, stall_after=256 * 1024) as server:
+        async def download():
+            async with macrecovery.AsyncRecoveryClient() as client:
+                await client.save_image(server.url("/BaseSystem.dmg"), "token", directory=str(tmp_path), timeout=1)
+
+        with pytest.raises(macrecovery.RecoveryTimeout):
+            asyncio.run(download())
+        # The partial file stays resumable
+        assert os.path.exists(journal.journal_path(str(tmp_path / "BaseSystem.dmg")))
+
+def test_disk_errors_fail_only_their_targets(recovery, tmp_path, monkeypatch):
+    async def fake_fetch(client, info, outdir, basename='', resume=True, verify_after=False):
+        if info[macrecovery.INFO_PRODUCT] == PRODUCTS[(BOARDS[1], None, "default")]:
+            raise OSError(28, "No space left on device")
+        os.makedirs(outdir, exist_ok=True)
+        paths = [os.path.join(outdir, name) for name in ("BaseSystem.dmg", "BaseSystem.chunklist")]
+        for path in paths:
+            open(path, 'wb').close()
+        return macrecovery.RecoveryResult(info[macrecovery.INFO_PRODUCT], *paths, info)
+
+    monkeypatch.setattr(macrecovery.AsyncRecoveryClient, "fetch_image", fake_fetch)
+    # An outdir that is a file cannot hold the links to the shared image
+    (tmp_path / "blocked").write_bytes(b"")
+    shared = macrecovery.RecoveryTarget(BOARDS[0], outdir=str(tmp_path / "a"))
+    blocked = macrecovery.RecoveryTarget(BOARDS[0], outdir=str(tmp_path / "blocked"))
+    full = macrecovery.RecoveryTarget(BOARDS[1], outdir=str(tmp_path / "b"))
+    fine = macrecovery.RecoveryTarget(BOARDS[2], outdir=str(tmp_path / "c"))
+
+    results = macrecovery.download_recovery_batch([shared, blocked, full, fine])
+    assert isinstance(results[shared], macrecovery.RecoveryResult)
+    assert isinstance(results[blocked], OSError)
+    assert isinstance(results[full], OSError) and results[full].errno == 28
+    assert isinstance(results[fine], macrecovery.RecoveryResult)
@@ -0,0 +1,69 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of the segmented download engine against a local Range server
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import downloader
+from servers import FileServer
+
+# 6 MB of non-repeating data, so a misplaced segment cannot go unnoticed
+PAYLOAD = os.urandom(6 * 1024 * 1024)
+
+def test_plan_segments_covers_every_gap():
+    ranges = downloader.plan_segments([(0, 1000), (2000, 2500)], 4, 100)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 2500
+    assert sum(stop - start for start, stop in ranges) == 1500
+    assert all(start < stop for start, stop in ranges)
+
+def test_plan_segments_keeps_integrity_chunks_whole():
+    boundaries = [0, 300, 600, 900, 1000]
+    for start, stop in downloader.plan_segments([(0, 1000)], 4, 100, boundaries):
+        assert start in boundaries and stop in boundaries
+
+def test_segmented_download_matches_source(tmp_path, quiet_progress):
+    with FileServer({"/big.pkg": PAYLOAD}) as server:
+        destination = str(tmp_path / "big.pkg")
+        downloader.download(server.url("/big.pkg"), destination, segments=4, min_segment_size=512 * 1024, progress_factory=quiet_progress)
+
+        ranged = [entry for entry in server.gets("/big.pkg") if entry[2]]
+        assert len(ranged) == 4
+    with open(destination, 'rb') as file:
+        assert file.read() == PAYLOAD
+    assert not os.path.exists(destination + ".journal")
+
+def test_resume_fetches_only_missing_ranges(tmp_path, quiet_progress):
+    destination = str(tmp_path / "big.pkg")
+    with FileServer({"/big.pkg": PAYLOAD}) as server:
+        url = server.url("/big.pkg")
+        size, _, validator = downloader.probe_url(url)
+        # First half on disk from an earlier run, second half still zeroed
+        with open(destination, 'wb') as file:
+            file.write(PAYLOAD[:size // 2] + bytes(size - size // 2))
+        journal = downloader.ResumeJournal(destination, url, size, validator, [[0, size // 2]])
+        journal.save()
+
+        downloader.download(url, destination, segments=1, min_segment_size=size, progress_factory=quiet_progress)
+        assert [entry[2] for entry in server.gets("/big.pkg")] == [f"bytes={size // 2}-{size - 1}"]
+    with open(destination, 'rb') as file:
+        assert file.read() == PAYLOAD
+
+def test_head_refused_falls_back_to_get(tmp_path, quiet_progress):
+    with FileServer({"/big.pkg": PAYLOAD}, head=False) as server:
+        assert downloader.probe_url(server.url("/big.pkg"))[:2] == (len(PAYLOAD), True)
+        destination = str(tmp_path / "big.pkg")
+        downloader.download(server.url("/big.pkg"), destination, segments=2, min_segment_size=1024 * 1024, progress_factory=quiet_progress)
+    with open(destination, 'rb') as file:
+        assert file.read() == PAYLOAD
+
+def test_server_without_ranges_uses_one_stream(tmp_path, quiet_progress):
+    with FileServer({"/big.pkg": PAYLOAD}, ranges=False) as server:
+        destination = str(tmp_path / "big.pkg")
+        downloader.download(server.url("/big.pkg"), destination, segments=4, min_segment_size=512 * 1024, progress_factory=quiet_progress)
+        assert [entry[2] for entry in server.gets("/big.pkg")] == [None]
+    with open(destination, 'rb') as file:
+        assert file.read() == PAYLOAD
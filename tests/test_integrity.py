@@ -0,0 +1,87 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of integrityDataV1 parsing and verification of resumed downloads
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import hashlib
+import pytest
+import downloader
+from journal import ResumeJournal
+from chunklist import ChunkListHeader, Chunk
+from integrity import IntegrityError, IntegrityVerifier, parse_integrity_data, verify_file
+from servers import FileServer
+
+CHUNK_SIZE = 256 * 1024
+PAYLOAD = os.urandom(16 * CHUNK_SIZE)
+
+# Function to build unsigned integrityDataV1 bytes for some data
+def integrity_data(data, chunk_size=CHUNK_SIZE):
+    """Function to return integrityDataV1 bytes describing data in chunk_size chunks."""
+    chunks = [data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)]
+    body = ChunkListHeader.pack(b'CNKL', ChunkListHeader.size, 1, 1, 2, len(chunks), ChunkListHeader.size, ChunkListHeader.size + Chunk.size * len(chunks))
+    body += b''.join(Chunk.pack(len(chunk), hashlib.sha256(chunk).digest()) for chunk in chunks)
+    return body + hashlib.sha256(body).digest()
+
+def test_parse_integrity_data():
+    chunks = parse_integrity_data(integrity_data(PAYLOAD))
+    assert len(chunks) == 16
+    assert chunks[3] == (3 * CHUNK_SIZE, CHUNK_SIZE, hashlib.sha256(PAYLOAD[3 * CHUNK_SIZE:4 * CHUNK_SIZE]).digest())
+
+    damaged = bytearray(integrity_data(PAYLOAD))
+    damaged[ChunkListHeader.size + 4] ^= 0xff
+    with pytest.raises(IntegrityError, match="digest mismatch"):
+        parse_integrity_data(bytes(damaged))
+
+def test_verify_file_finds_bad_chunk(tmp_path):
+    path = tmp_path / "package.pkg"
+    data = bytearray(PAYLOAD)
+    data[5 * CHUNK_SIZE + 7] ^= 0xff
+    path.write_bytes(bytes(data))
+    with pytest.raises(IntegrityError, match="chunk 6 failed"):
+        verify_file(str(path), parse_integrity_data(integrity_data(PAYLOAD)))
+
+def resumable(tmp_path, url, verified):
+    """Function to leave a half-written package on disk whose first chunk is corrupt, as a run without verification could."""
+    destination = str(tmp_path / "package.pkg")
+    half = len(PAYLOAD) // 2
+    data = bytearray(PAYLOAD[:half] + bytes(len(PAYLOAD) - half))
+    data[100] ^= 0xff
+    with open(destination, 'wb') as file:
+        file.write(bytes(data))
+    size, _, validator = downloader.probe_url(url)
+    ResumeJournal(destination, url, size, validator, [[0, half]], verified).save()
+    return destination
+
+def test_unverified_resume_refetches_bad_chunks(tmp_path, quiet_progress):
+    chunks = parse_integrity_data(integrity_data(PAYLOAD))
+    with FileServer({"/package.pkg": PAYLOAD}) as server:
+        url = server.url("/package.pkg")
+        destination = resumable(tmp_path, url, verified=False)
+        downloader.download(url, destination, 1, len(PAYLOAD), True, quiet_progress, verifier=IntegrityVerifier(chunks, destination))
+        # Only the corrupt first chunk and the missing half were fetched
+        ranges = sorted(entry[2] for entry in server.gets("/package.pkg"))
+        assert ranges == [f"bytes=0-{CHUNK_SIZE - 1}", f"bytes={len(PAYLOAD) // 2}-{len(PAYLOAD) - 1}"]
+    with open(destination, 'rb') as file:
+        assert file.read() == PAYLOAD
+
+def test_verified_journal_is_trusted(tmp_path, quiet_progress):
+    chunks = parse_integrity_data(integrity_data(PAYLOAD))
+    with FileServer({"/package.pkg": PAYLOAD}) as server:
+        url = server.url("/package.pkg")
+        destination = resumable(tmp_path, url, verified=True)
+        downloader.download(url, destination, 1, len(PAYLOAD), True, quiet_progress, verifier=IntegrityVerifier(chunks, destination))
+        assert [entry[2] for entry in server.gets("/package.pkg")] == [f"bytes={len(PAYLOAD) // 2}-{len(PAYLOAD) - 1}"]
+
+def test_check_completed_keeps_good_chunks(tmp_path):
+    destination = str(tmp_path / "package.pkg")
+    with open(destination, 'wb') as file:
+        file.write(PAYLOAD)
+    journal = ResumeJournal(destination, "http://example/package.pkg", len(PAYLOAD), '"v"', [[0, CHUNK_SIZE]])
+    verifier = IntegrityVerifier(parse_integrity_data(integrity_data(PAYLOAD)), destination)
+    verifier.check_completed(journal)
+    assert journal.verified and journal.ranges == [[0, CHUNK_SIZE]]
@@ -0,0 +1,120 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of the recovery board sweep against a local stand-in server
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import json
+import hashlib
+import time
+import random
+import argparse
+import pytest
+import integrity
+import macrecovery
+from servers import RecoveryServer
+
+MLB = "C02749200YGJ803AX"
+LATEST = "041-LATEST"
+
+# Boards of the sweep in database order, with what the stand-in answers for them
+BOARDS = {
+    "Mac-00000000000000A1": "10.15",    # Older default for the MLB, supported
+    "Mac-00000000000000A2": "current",  # Same default and latest for the MLB, not reported
+    "Mac-00000000000000A3": "11",       # Not reported either
+    "Mac-00000000000000A4": "12",       # Unknown to the server, fails with a warning
+    "Mac-00000000000000A5": "13",       # Supported as well, reported after A1
+}
+PRODUCTS = {
+    (macrecovery.RECENT_MAC, None, "latest"): LATEST,
+    ("Mac-00000000000000A1", None, "latest"): "041-A1-LATEST",
+    ("Mac-00000000000000A1", None, "default"): "041-A1-DEFAULT",
+    ("Mac-00000000000000A2", None, "latest"): "041-A2-LATEST",
+    ("Mac-00000000000000A2", None, "default"): "041-A2-LATEST",
+    ("Mac-00000000000000A3", None, "latest"): "041-A3",
+    ("Mac-00000000000000A3", None, "default"): "041-A3",
+    ("Mac-00000000000000A5", None, "latest"): "041-A5-LATEST",
+    ("Mac-00000000000000A5", None, "default"): "041-A5-DEFAULT",
+}
+
+@pytest.fixture
+def recovery(tmp_path, monkeypatch):
+    """Point macrecovery at a fresh stand-in server, with its session and answer caches in tmp_path."""
+    # Random latency so boards finish out of order
+    with RecoveryServer(PRODUCTS, latency=lambda query: random.uniform(0.05, 0.2)) as server:
+        monkeypatch.setattr(macrecovery, "RECOVERY_URL", server.url)
+        monkeypatch.setattr(macrecovery, "session_manager", macrecovery.SessionManager(str(tmp_path / "session.json")))
+        monkeypatch.setattr(macrecovery, "info_cache", None)
+        yield server
+
+def guess_args(tmp_path, jobs=8, rate=0):
+    board_db = tmp_path / "boards.json"
+    board_db.write_text(json.dumps(BOARDS))
+    return argparse.Namespace(mlb=MLB, board_db=str(board_db), jobs=jobs, rate=rate, verbose=False)
+
+def test_guess_reports_in_board_order(recovery, tmp_path, capsys):
+    assert macrecovery.action_guess(guess_args(tmp_path)) == 0
+    lines = capsys.readouterr().out.splitlines()
+
+    assert lines[0].startswith("WARN: Failed to check Mac-00000000000000A4")
+    assert lines[1:] == [
+        f"SUCCESS: MLB {MLB} looks supported for:",
+        "- Mac-00000000000000A1, up to 10.15, default: 041-A1-DEFAULT, latest: 041-A1-LATEST",
+        "- Mac-00000000000000A5, up to 13, default: 041-A5-DEFAULT, latest: 041-A5-LATEST",
+    ]
+    assert recovery.sessions == 1
+
+def test_guess_checks_boards_concurrently(recovery, tmp_path, capsys):
+    macrecovery.action_guess(guess_args(tmp_path, jobs=8))
+    assert recovery.peak > 1
+
+    recovery.peak = 0
+    macrecovery.action_guess(guess_args(tmp_path, jobs=1))
+    assert recovery.peak == 1
+
+def test_guess_respects_rate_limit(recovery, tmp_path, capsys):
+    start = time.monotonic()
+    macrecovery.action_guess(guess_args(tmp_path, rate=20))
+    # One query for the generic latest, then ten board queries spread at 20 per second
+    board_queries = len(recovery.queries) - 1
+    assert time.monotonic() - start >= (board_queries - 1) / 20
+
+def test_verify_chunks_reports_first_bad_chunk(tmp_path):
+    chunks = [bytes([index]) * 4096 for index in range(64)]
+    image = tmp_path / "BaseSystem.dmg"
+    image.write_bytes(b"".join(chunks))
+    cnklist = [(len(chunk), hashlib.sha256(chunk).digest()) for chunk in chunks]
+    macrecovery.verify_chunks(str(image), cnklist, workers=4)
+
+    data = bytearray(image.read_bytes())
+    data[40 * 4096] ^= 0xff
+    data[50 * 4096] ^= 0xff
+    image.write_bytes(bytes(data))
+    with pytest.raises(integrity.IntegrityError, match="chunk 41 failed verification"):
+        macrecovery.verify_chunks(str(image), cnklist, workers=4)
+
+def test_parse_command_raises_instead_of_exiting():
+    args = macrecovery.parse_command("-b Mac-7BA5B2D9E42DDD94 -e J803 -o out download")
+    assert args.board_id == "Mac-7BA5B2D9E42DDD94" and args.mlb == "00000000000J80300"
+
+    for command in ["download --no-such-option", "-os newest download", "-e J8 download", "-m 123 download", "-b 'unterminated download"]:
+        with pytest.raises(macrecovery.RecoveryError):
+            macrecovery.parse_command(command)
+
+def test_menu_download_survives_bad_command(capsys):
+    import main
+    assert main.recovery_download("-e J8 download") is None
+    assert "Invalid EEEE code length" in capsys.readouterr().out
+
+def test_menu_download_survives_disk_errors(monkeypatch, capsys):
+    import main
+
+    def disk_full(*args):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(macrecovery, "download_recovery", disk_full)
+    assert main.recovery_download("-b Mac-7BA5B2D9E42DDD94 -o out download") is None
+    assert "No space left on device" in capsys.readouterr().out
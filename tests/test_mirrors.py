@@ -0,0 +1,85 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of mirror ranking, failover and stall switching against local mirrors
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import re
+import time
+import mirrors
+import downloader
+from servers import FileServer
+
+# 4 MB of non-repeating data, so a misplaced range cannot go unnoticed
+PAYLOAD = os.urandom(4 * 1024 * 1024)
+
+# Same size as PAYLOAD but other bytes, as a mirror holding another build would serve
+OTHER_BUILD = os.urandom(len(PAYLOAD))
+
+def resumed_offsets(server):
+    """Return the start offsets of the download requests a mirror received, leaving out its probe."""
+    offsets = []
+    for _, _, requested in server.gets("/big.pkg"):
+        start, stop = re.match(r'^bytes=(\d+)-(\d*)$', requested).groups()
+        if stop != str(mirrors.PROBE_SIZE - 1):
+            offsets.append(int(start))
+    return offsets
+
+def test_fastest_mirror_ranks_first():
+    with FileServer({"/big.pkg": PAYLOAD}, latency=0.2, rate=1024 * 1024) as slow, FileServer({"/big.pkg": PAYLOAD}) as fast:
+        mirror_set, size, accepts_ranges, validator = mirrors.rank_mirrors([slow.url("/big.pkg"), fast.url("/big.pkg")])
+
+    assert mirror_set.urls == [fast.url("/big.pkg"), slow.url("/big.pkg")]
+    # Resume journals still know the file by the first URL of the list
+    assert mirror_set.key == slow.url("/big.pkg")
+    assert (size, accepts_ranges, validator) == (len(PAYLOAD), True, fast.etag_of("/big.pkg"))
+
+def test_mirror_missing_the_grace_period_is_skipped(monkeypatch, mirror_stats):
+    monkeypatch.setattr(mirrors, "PROBE_GRACE", 0.3)
+    with FileServer({"/big.pkg": PAYLOAD}, latency=1.5) as dead, FileServer({"/big.pkg": PAYLOAD}) as alive:
+        mirror_set = mirrors.rank_mirrors([dead.url("/big.pkg"), alive.url("/big.pkg")])[0]
+
+    assert mirror_set.urls == [alive.url("/big.pkg")]
+    assert mirror_stats.entry(dead.url("/big.pkg"))["failures"] == 1
+
+def test_unmatched_copies_need_integrity_data():
+    with FileServer({"/big.pkg": PAYLOAD}) as fast, FileServer({"/big.pkg": OTHER_BUILD}, rate=1024 * 1024) as other:
+        urls = [fast.url("/big.pkg"), other.url("/big.pkg")]
+        # Equal sizes but different ETags, the copies cannot be told apart without chunk hashes
+        assert mirrors.rank_mirrors(urls)[0].urls == [fast.url("/big.pkg")]
+        assert mirrors.rank_mirrors(urls, verified=True)[0].urls == urls
+
+def test_mirror_of_another_size_is_never_mixed_in():
+    with FileServer({"/big.pkg": PAYLOAD}) as fast, FileServer({"/big.pkg": PAYLOAD[:-1]}, rate=1024 * 1024) as other:
+        urls = [fast.url("/big.pkg"), other.url("/big.pkg")]
+        assert mirrors.rank_mirrors(urls, verified=True)[0].urls == [fast.url("/big.pkg")]
+
+def test_failed_mirror_hands_over_mid_file(tmp_path, quiet_progress):
+    destination = str(tmp_path / "big.pkg")
+    with FileServer({"/big.pkg": PAYLOAD}, fail_after=len(PAYLOAD) // 2) as failing, FileServer({"/big.pkg": PAYLOAD}, rate=8 * 1024 * 1024) as backup:
+        downloader.download([failing.url("/big.pkg"), backup.url("/big.pkg")], destination, segments=1, min_segment_size=len(PAYLOAD), progress_factory=quiet_progress)
+
+        # The backup only sent what the failing mirror had not
+        offsets = resumed_offsets(backup)
+        assert len(offsets) == 1 and 0 < offsets[0] <= len(PAYLOAD) // 2
+    with open(destination, 'rb') as file:
+        assert file.read() == PAYLOAD
+
+def test_stalled_mirror_hands_over_mid_file(tmp_path, monkeypatch, quiet_progress):
+    monkeypatch.setattr(mirrors, "STALL_WINDOW", 1)
+    destination = str(tmp_path / "big.pkg")
+    # After 1 MB the first mirror trickles 1 KB blocks at 16 KB/s, alive but far below STALL_RATE
+    with FileServer({"/big.pkg": PAYLOAD}, stall_after=1024 * 1024, stall_rate=16 * 1024) as trickling, FileServer({"/big.pkg": PAYLOAD}, rate=8 * 1024 * 1024) as backup:
+        start = time.monotonic()
+        downloader.download([trickling.url("/big.pkg"), backup.url("/big.pkg")], destination, segments=1, min_segment_size=len(PAYLOAD), progress_factory=quiet_progress)
+        # The switch came from the stall window, not from a 1 MB read block or the read timeout running out
+        assert time.monotonic() - start < 5
+
+        offsets = resumed_offsets(backup)
+        assert len(offsets) == 1 and 1024 * 1024 - mirrors.PROBE_SIZE <= offsets[0] < len(PAYLOAD)
+    with open(destination, 'rb') as file:
+        assert file.read() == PAYLOAD
@@ -0,0 +1,136 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of the caching LAN proxy and the cache index it shares with clients
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import threading
+import subprocess
+import pytest
+import proxy
+import requests
+from cache import DownloadCache
+from servers import FileServer
+
+OLD_BUILD = os.urandom(2 * 1024 * 1024)
+
+# Same size as OLD_BUILD, only the validator tells them apart
+NEW_BUILD = os.urandom(len(OLD_BUILD))
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+@pytest.fixture
+def upstream():
+    with FileServer({"/big.pkg": OLD_BUILD}) as server:
+        yield server
+
+def start_proxy(tmp_path, revalidate_after):
+    """Start a proxy allowed to reach 127.0.0.1 and return it with its /http/<host>/big.pkg URL maker."""
+    server = proxy.ProxyServer(("127.0.0.1", 0), DownloadCache(str(tmp_path / "cache")), ("127.0.0.1",), revalidate_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, lambda upstream: f"http://127.0.0.1:{server.server_address[1]}/http/127.0.0.1:{upstream.httpd.server_address[1]}/big.pkg"
+
+def stop_proxy(server):
+    server.shutdown()
+    server.server_close()
+
+def heads(server):
+    return [entry for entry in server.requests if entry[0] == "HEAD"]
+
+def test_changed_upstream_file_replaces_the_cached_one(tmp_path, upstream):
+    server, proxied = start_proxy(tmp_path, 0)
+    try:
+        first = requests.get(proxied(upstream))
+        assert first.content == OLD_BUILD
+        # Unchanged upstream answers the conditional HEAD with 304, the copy is served from the cache
+        assert requests.get(proxied(upstream)).content == OLD_BUILD
+        assert len(upstream.gets()) == 1
+
+        upstream.files["/big.pkg"] = NEW_BUILD
+        second = requests.get(proxied(upstream))
+        assert second.content == NEW_BUILD
+        assert len(upstream.gets()) == 2
+        # A client resuming the old copy must not get a range of the new one
+        assert second.headers["ETag"] != first.headers["ETag"]
+        resumed = requests.get(proxied(upstream), headers={"Range": "bytes=100-", "If-Range": first.headers["ETag"]})
+        assert resumed.status_code == 200 and resumed.content == NEW_BUILD
+    finally:
+        stop_proxy(server)
+
+def test_cached_file_is_revalidated_once_per_interval(tmp_path, upstream):
+    server, proxied = start_proxy(tmp_path, 60)
+    try:
+        for _ in range(3):
+            assert requests.get(proxied(upstream), headers={"Range": "bytes=0-1023"}).content == OLD_BUILD[:1024]
+        assert heads(upstream) == []
+
+        server.checked.clear()
+        assert requests.get(proxied(upstream)).content == OLD_BUILD
+        assert requests.get(proxied(upstream)).content == OLD_BUILD
+        assert len(heads(upstream)) == 1
+    finally:
+        stop_proxy(server)
+
+def test_unreachable_upstream_keeps_serving_the_cache(tmp_path, upstream):
+    server, proxied = start_proxy(tmp_path, 0)
+    try:
+        url = proxied(upstream)
+        assert requests.get(url).content == OLD_BUILD
+        upstream.httpd.shutdown()
+        upstream.httpd.server_close()
+        assert requests.get(url).content == OLD_BUILD
+    finally:
+        stop_proxy(server)
+
+def test_lookup_does_not_rewrite_the_index(tmp_path):
+    download_cache = DownloadCache(str(tmp_path / "cache"))
+    source = tmp_path / "big.pkg"
+    source.write_bytes(OLD_BUILD)
+    download_cache.store("key", str(source), "https://example.com/big.pkg")
+    before = os.stat(download_cache.index_path).st_mtime_ns
+    stored = json.loads(open(download_cache.index_path).read())["key"]["last_used"]
+
+    for _ in range(100):
+        assert download_cache.lookup("key") == download_cache.object_path("key")
+    assert os.stat(download_cache.index_path).st_mtime_ns == before
+
+    download_cache.flush()
+    assert json.loads(open(download_cache.index_path).read())["key"]["last_used"] > stored
+
+def test_processes_sharing_the_cache_keep_every_entry(tmp_path):
+    directory = str(tmp_path / "cache")
+    source = tmp_path / "small.pkg"
+    source.write_bytes(b"x" * 1024)
+    # Two processes storing at the same time, without the lock one would overwrite the other's entries
+    script = (f"import sys; sys.path.insert(0, {SRC!r}); from cache import DownloadCache; "
+              f"cache = DownloadCache({directory!r}); "
+              f"[cache.store(sys.argv[1] + str(n), {str(source)!r}) for n in range(100)]")
+    workers = [subprocess.Popen([sys.executable, "-c", script, name]) for name in ("a", "b")]
+    assert [worker.wait(60) for worker in workers] == [0, 0]
+
+    index = DownloadCache(directory).load_index()
+    assert sorted(index) == sorted(f"{name}{n}" for name in ("a", "b") for n in range(100))
+
+def test_fill_missed_by_the_client_is_answered(tmp_path, upstream, monkeypatch):
+    # A fill finishing before the reader attaches, for a file too large for the cache to keep
+    original = proxy.Fill.open
+
+    def open_late(fill):
+        with fill.condition:
+            fill.condition.wait_for(lambda: fill.done)
+        return original(fill)
+
+    monkeypatch.setattr(proxy.Fill, "open", open_late)
+    server = proxy.ProxyServer(("127.0.0.1", 0), DownloadCache(str(tmp_path / "cache"), 1024), ("127.0.0.1",))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/http/127.0.0.1:{upstream.httpd.server_address[1]}/big.pkg"
+        assert requests.get(url, timeout=10).status_code == 502
+    finally:
+        stop_proxy(server)
@@ -0,0 +1,126 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of source deltas, the precompiled index and cache invalidation
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import json
+import pickle
+import pytest
+import main
+import sources
+from cache import DownloadCache
+from servers import FileServer
+
+def entry(build, *urls, version="14.5"):
+    return {"identifier": "com.apple.InstallAssistant", "build": build, "version": version,
+            "packages": [{"name": os.path.basename(url), "url": url, "size": 100} for url in urls]}
+
+OLD = [entry("23F79", "https://cdn/a/InstallAssistant.pkg", "https://cdn/a/Info.plist"), entry("23G80", "https://cdn/b/InstallAssistant.pkg")]
+NEW = [entry("23F79", "https://cdn/c/InstallAssistant.pkg", "https://cdn/a/Info.plist"), entry("24A335", "https://cdn/d/InstallAssistant.pkg")]
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty folder with data/ and no sources loaded yet."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    monkeypatch.setattr(sources, "_catalogs", {})
+    monkeypatch.setattr(sources, "_merged", {})
+    monkeypatch.setattr(sources, "_pending", {})
+    monkeypatch.setattr(sources, "_index", None)
+    monkeypatch.setattr(sources, "_listeners", [])
+    return tmp_path
+
+def write_source(source_type, entries):
+    with open(sources.source_path(source_type), 'w') as file:
+        json.dump(entries, file)
+
+def test_diff_entries_and_stale_urls():
+    delta = sources.diff_entries("offline", OLD, NEW)
+    assert delta.summary() == "1 added, 1 removed, 1 changed"
+    assert delta.stale_urls() == {"https://cdn/a/InstallAssistant.pkg", "https://cdn/b/InstallAssistant.pkg"}
+
+def test_compile_index_keeps_unchanged_sources(workdir):
+    write_source("offline", OLD)
+    write_source("recovery", [entry("R1", "https://cdn/r/BaseSystem.dmg")])
+    sources.compile_index()
+    before = sources.read_index()
+
+    write_source("offline", NEW)
+    os.utime(sources.source_path("offline"), ns=(1, 1))
+    sources.compile_index()
+    after = sources.read_index()
+
+    assert after["recovery"] is not None and after["recovery"][1] == before["recovery"][1]
+    assert after["offline"][1] != before["offline"][1]
+    assert [item["build"] for item in pickle.loads(after["offline"][1]).entries] == ["23F79", "24A335"]
+
+    # A fresh process reads the catalog from the index, not the JSON file
+    sources._catalogs.clear()
+    sources._index = None
+    signature = sources.file_signature(sources.source_path("offline"))
+    assert sources.catalog_from_index("offline", signature).find_build("24A335") is not None
+
+def test_update_source_invalidates_cache_entries(workdir, monkeypatch):
+    write_source("offline", OLD)
+    (workdir / "data" / "config.json").write_text(json.dumps({"cache_dir": "cache"}))
+    download_cache = DownloadCache("cache")
+    for url in ("https://cdn/a/InstallAssistant.pkg", "https://cdn/a/Info.plist", "https://cdn/b/InstallAssistant.pkg"):
+        package = workdir / "package"
+        package.write_bytes(url.encode("utf-8"))
+        download_cache.store(DownloadCache.key(url, 100), str(package), url)
+
+    deltas = []
+    sources.on_change(deltas.append)
+    sources.on_change(main.invalidate_download_cache)
+
+    with FileServer({"/offline_sources.json": json.dumps(NEW).encode("utf-8")}) as server:
+        monkeypatch.setitem(sources.SOURCES, "offline", (server.url("/offline_sources.json"), sources.source_path("offline")))
+        delta = sources.update_source("offline")
+
+    assert deltas == [delta] and delta.summary() == "1 added, 1 removed, 1 changed"
+    assert [entry["url"] for entry in download_cache.load_index().values()] == ["https://cdn/a/Info.plist"]
+    assert sources.get_catalog("offline").find_build("23G80") is None
+
+def test_unchanged_source_is_not_hashed(workdir, monkeypatch):
+    content = json.dumps(OLD).encode("utf-8")
+    with FileServer({"/offline_sources.json": content}) as server:
+        monkeypatch.setitem(sources.SOURCES, "offline", (server.url("/offline_sources.json"), sources.source_path("offline")))
+        write_source("offline", OLD)
+        # First check stores the validators together with the file's signature
+        assert sources.check_source("offline")
+
+        hashed = []
+        monkeypatch.setattr(sources, "local_digest", lambda source_type: hashed.append(source_type))
+        assert sources.check_source("offline")
+        assert hashed == []
+        assert len(server.gets()) == 2
+
+        # An edited file is hashed again and its stale validators are not sent
+        write_source("offline", NEW)
+        assert not sources.check_source("offline")
+        assert hashed == ["offline"]
+
+def test_ingested_entries_stay_out_of_the_upstream_file(workdir, monkeypatch):
+    content = json.dumps(OLD).encode("utf-8")
+    with FileServer({"/offline_sources.json": content}) as server:
+        monkeypatch.setitem(sources.SOURCES, "offline", (server.url("/offline_sources.json"), sources.source_path("offline")))
+        write_source("offline", OLD)
+        assert sources.check_source("offline")
+
+        ingested = [entry("24A335", "https://cdn/d/InstallAssistant.pkg", version="15.0")]
+        sources.write_atomic(sources.local_source_path("offline"), json.dumps(ingested).encode("utf-8"))
+
+        # Listed together with the upstream entries, while the upstream file still matches
+        assert [item["build"] for item in sources.load_sources("offline")] == ["24A335", "23F79", "23G80"]
+        assert sources.check_source("offline")
+
+        server.files["/offline_sources.json"] = json.dumps(NEW[:1]).encode("utf-8")
+        delta = sources.update_source("offline")
+
+    assert delta.summary() == "0 added, 1 removed, 1 changed"
+    assert [item["build"] for item in sources.load_sources("offline")] == ["24A335", "23F79"]
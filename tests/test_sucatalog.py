@@ -0,0 +1,115 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of building offline sources from a software update catalog
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import io
+import os
+import gzip
+import json
+import sucatalog
+from servers import FileServer
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+def distribution(build, version, title):
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<installer-gui-script minSpecVersion="2">
+    <title>SU_TITLE</title>
+    <auxinfo><dict><key>BUILD</key><string>{build}</string><key>VERSION</key><string>{version}</string></dict></auxinfo>
+    <localization><strings language="English">"SU_TITLE" = "{title}";</strings></localization>
+</installer-gui-script>""".encode("utf-8")
+
+def package(url, size, integrity=True):
+    integrity_keys = f"<key>IntegrityDataURL</key><string>{url}.integrityDataV1</string><key>IntegrityDataSize</key><integer>104</integer>" if integrity else ""
+    return f"<dict><key>URL</key><string>{url}</string><key>Size</key><integer>{size}</integer>{integrity_keys}</dict>"
+
+def product(identifier, date, packages, dist_url, extended=""):
+    return (f"<key>{identifier}</key><dict><key>PostDate</key><date>{date}</date>"
+            f"<key>Packages</key><array>{''.join(packages)}</array>"
+            f"<key>Distributions</key><dict><key>English</key><string>{dist_url}</string></dict>{extended}</dict>")
+
+def catalog(server):
+    cdn = "https://swcdn.apple.com/content/downloads"
+    products = [
+        # Found through its package identifiers
+        product("052-00001", "2024-05-13T17:00:00Z", [package(f"{cdn}/a/InstallAssistant.pkg", 13000), package(f"{cdn}/a/Info.plist", 5, False)],
+                server.url("/052-00001.English.dist"),
+                "<key>ExtendedMetaInfo</key><dict><key>InstallAssistantPackageIdentifiers</key><dict/></dict>"),
+        # Found through the InstallAssistant.pkg package only
+        product("052-00002", "2024-06-10T17:00:00Z", [package(f"{cdn}/b/InstallAssistant.pkg", 14000)], server.url("/052-00002.English.dist")),
+        # Its distribution is missing on the server
+        product("052-00003", "2024-06-20T17:00:00Z", [package(f"{cdn}/c/InstallAssistant.pkg", 15000)], server.url("/052-00003.English.dist")),
+        # Not an installer
+        product("041-00004", "2024-06-21T17:00:00Z", [package(f"{cdn}/d/SafariUpdate.pkg", 100)], server.url("/041-00004.English.dist")),
+    ]
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0"><dict>
+<key>CatalogVersion</key><integer>2</integer>
+<key>Products</key><dict>{''.join(products)}</dict>
+<key>IndexDate</key><date>2024-06-21T18:00:00Z</date>
+</dict></plist>""".encode("utf-8")
+
+def serve():
+    """Start a server holding the distributions, the catalog is added once its URLs are known."""
+    server = FileServer({
+        "/052-00001.English.dist": distribution("23F79", "14.5", "macOS Sonoma"),
+        "/052-00002.English.dist": distribution("24A5264n", "15.0", "macOS Sequoia beta"),
+    })
+    server.files["/index.sucatalog"] = catalog(server)
+    server.files["/index.sucatalog.gz"] = gzip.compress(server.files["/index.sucatalog"])
+    return server
+
+def test_iter_products_streams_the_catalog():
+    with serve() as server:
+        stream = sucatalog.open_catalog(server.url("/index.sucatalog.gz"))
+        try:
+            products = list(sucatalog.iter_products(stream))
+        finally:
+            stream.close()
+
+    assert [identifier for identifier, _ in products] == ["052-00001", "052-00002", "052-00003", "041-00004"]
+    first = products[0][1]
+    assert first["PostDate"] == "2024-05-13T17:00:00Z"
+    assert first["Packages"][0]["Size"] == 13000
+    assert first["Distributions"]["English"].endswith("/052-00001.English.dist")
+
+def test_is_install_assistant():
+    with serve() as server:
+        products = dict(sucatalog.iter_products(io.BytesIO(server.files["/index.sucatalog"])))
+
+    assert [identifier for identifier, item in products.items() if sucatalog.is_install_assistant(item)] == ["052-00001", "052-00002", "052-00003"]
+
+def test_make_entry_matches_the_offline_sources_schema():
+    with open(os.path.join(DATA, "offline_sources.json"), 'r') as file:
+        shipped = json.load(file)[0]
+
+    with serve() as server:
+        products = dict(sucatalog.iter_products(io.BytesIO(server.files["/index.sucatalog"])))
+        url = sucatalog.distribution_url(products["052-00002"])
+        entry = sucatalog.make_entry("052-00002", products["052-00002"], url, sucatalog.fetch_distribution(url))
+
+    assert entry.keys() == shipped.keys()
+    assert entry["packages"][0].keys() == shipped["packages"][0].keys()
+    assert (entry["build"], entry["version"], entry["name"], entry["date"]) == ("24A5264n", "15.0", "macOS Sequoia beta", "2024-06-10")
+    assert entry["beta"] is True and entry["size"] == 14000
+
+def test_ingest_catalog_skips_unreachable_distributions(capsys):
+    with serve() as server:
+        entries = sucatalog.ingest_catalog(server.url("/index.sucatalog"), workers=2)
+
+    # Newest first, the product without a distribution is left out instead of failing the ingest
+    assert [entry["identifier"] for entry in entries] == ["052-00002", "052-00001"]
+    assert "052-00003" in capsys.readouterr().out
+
+    release = entries[1]
+    assert release["beta"] is False
+    assert release["packages"] == [
+        {"url": "https://swcdn.apple.com/content/downloads/a/InstallAssistant.pkg", "size": 13000,
+         "integrityDataURL": "https://swcdn.apple.com/content/downloads/a/InstallAssistant.pkg.integrityDataV1", "integrityDataSize": 104},
+        {"url": "https://swcdn.apple.com/content/downloads/a/Info.plist", "size": 5},
+    ]
@@ -0,0 +1,186 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of the magnet downloader against three local seeders
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import os
+import socket
+import struct
+import hashlib
+import threading
+import pytest
+import torrent
+from torrent import bencode, decode_value
+
+# Small pieces so the metadata spans two ut_metadata blocks
+PIECE_LENGTH = 4096
+
+# Id the seeders assign to ut_metadata in their extended handshake
+SEEDER_METADATA_ID = 3
+
+FILES = [("BaseSystem.dmg", os.urandom(PIECE_LENGTH * 900 + 123)), ("InstallInfo.plist", os.urandom(PIECE_LENGTH * 200 + 7))]
+
+def receive_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+class Seeders:
+    """Three peers on 127.0.0.1 seeding FILES, seeder k lacking every piece with index % 3 == k.
+
+    No seeder alone has the whole torrent. Seeders in corrupt send garbage for every block, those in
+    no_metadata do not offer ut_metadata. Block requests are recorded as (seeder, piece).
+    """
+
+    def __init__(self, corrupt=(), no_metadata=()):
+        data = b"".join(content for _, content in FILES)
+        self.pieces = [data[index:index + PIECE_LENGTH] for index in range(0, len(data), PIECE_LENGTH)]
+        info = {"name": "Leopard", "piece length": PIECE_LENGTH,
+                "pieces": b"".join(hashlib.sha1(piece).digest() for piece in self.pieces),
+                "files": [{"path": [name], "length": len(content)} for name, content in FILES]}
+        self.metadata = bencode(info)
+        self.info_hash = hashlib.sha1(self.metadata).digest()
+        self.corrupt = set(corrupt)
+        self.no_metadata = set(no_metadata)
+        self.requests = []
+        self.metadata_requests = []
+        self.lock = threading.Lock()
+        self.listeners = []
+        for _ in range(3):
+            listener = socket.create_server(("127.0.0.1", 0))
+            self.listeners.append(listener)
+
+    @property
+    def magnet(self):
+        peers = "".join(f"&x.pe=127.0.0.1:{listener.getsockname()[1]}" for listener in self.listeners)
+        return f"magnet:?xt=urn:btih:{self.info_hash.hex()}&dn=Leopard{peers}"
+
+    def has(self, seeder, index):
+        return index % 3 != seeder
+
+    def serve(self, conn, seeder):
+        with conn:
+            try:
+                handshake = receive_exact(conn, 68)
+                if handshake[28:48] != self.info_hash:
+                    return
+                conn.sendall(b"\x13BitTorrent protocol" + bytes([0, 0, 0, 0, 0, 0x10, 0, 0]) + self.info_hash + (b"-SEED%d-" % seeder).ljust(20, b"0"))
+                extensions = {} if seeder in self.no_metadata else {"ut_metadata": SEEDER_METADATA_ID}
+                extended = b"\x00" + bencode({"m": extensions, "metadata_size": len(self.metadata)})
+                conn.sendall(struct.pack(">IB", len(extended) + 1, torrent.EXTENDED) + extended)
+                bitfield = bytearray((len(self.pieces) + 7) // 8)
+                for index in range(len(self.pieces)):
+                    if self.has(seeder, index):
+                        bitfield[index // 8] |= 0x80 >> (index % 8)
+                conn.sendall(struct.pack(">IB", len(bitfield) + 1, torrent.BITFIELD) + bitfield)
+                conn.sendall(struct.pack(">IB", 1, torrent.UNCHOKE))
+
+                while True:
+                    length = struct.unpack(">I", receive_exact(conn, 4))[0]
+                    if not length:
+                        continue
+                    message = receive_exact(conn, length)
+                    message_id, payload = message[0], message[1:]
+                    if message_id == torrent.REQUEST:
+                        index, begin, size = struct.unpack(">III", payload)
+                        with self.lock:
+                            self.requests.append((seeder, index))
+                        block = self.pieces[index][begin:begin + size]
+                        if seeder in self.corrupt:
+                            block = bytes(len(block))
+                        conn.sendall(struct.pack(">IBII", len(block) + 9, torrent.PIECE, index, begin) + block)
+                    elif message_id == torrent.EXTENDED and payload[:1] == bytes([SEEDER_METADATA_ID]):
+                        request, _ = decode_value(payload, 1)
+                        piece = request[b"piece"]
+                        with self.lock:
+                            self.metadata_requests.append((seeder, piece))
+                        block = self.metadata[piece * torrent.BLOCK_SIZE:(piece + 1) * torrent.BLOCK_SIZE]
+                        body = bytes([torrent.UT_METADATA_ID]) + bencode({"msg_type": 1, "piece": piece, "total_size": len(self.metadata)}) + block
+                        conn.sendall(struct.pack(">IB", len(body) + 1, torrent.EXTENDED) + body)
+            except (EOFError, OSError):
+                pass
+
+    def accept(self, listener, seeder):
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn, seeder), daemon=True).start()
+
+    def __enter__(self):
+        for seeder, listener in enumerate(self.listeners):
+            threading.Thread(target=self.accept, args=(listener, seeder), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        for listener in self.listeners:
+            listener.close()
+
+def test_downloads_from_three_partial_seeders(tmp_path, quiet_progress):
+    completed = []
+    with Seeders() as seeders:
+        paths = torrent.download_magnet(seeders.magnet, str(tmp_path), on_complete=completed.append, progress_factory=quiet_progress)
+
+    assert [open(path, 'rb').read() for path in paths] == [content for _, content in FILES]
+    assert sorted(completed) == sorted(paths)
+    # The metadata came in both of its blocks, and pieces from every seeder
+    assert sorted(piece for _, piece in seeders.metadata_requests) == [0, 1]
+    assert {seeder for seeder, _ in seeders.requests} == {0, 1, 2}
+    assert all(seeders.has(seeder, index) for seeder, index in seeders.requests)
+
+def test_metadata_comes_from_a_peer_that_shares_it(tmp_path, quiet_progress):
+    with Seeders(no_metadata={0, 1}) as seeders:
+        paths = torrent.download_magnet(seeders.magnet, str(tmp_path), progress_factory=quiet_progress)
+
+    assert {seeder for seeder, _ in seeders.metadata_requests} == {2}
+    assert [open(path, 'rb').read() for path in paths] == [content for _, content in FILES]
+
+def test_corrupt_pieces_are_rejected(tmp_path, quiet_progress):
+    # Every piece is on two seeders, so the others make up for the corrupt one
+    with Seeders(corrupt={1}) as seeders:
+        paths = torrent.download_magnet(seeders.magnet, str(tmp_path), progress_factory=quiet_progress)
+
+    assert [open(path, 'rb').read() for path in paths] == [content for _, content in FILES]
+    # Pieces fit in one block, so the corrupt seeder is dropped after MAX_BAD_PIECES requests
+    assert len([seeder for seeder, _ in seeders.requests if seeder == 1]) <= torrent.MAX_BAD_PIECES
+
+def test_resumes_from_partial_pieces(tmp_path, quiet_progress):
+    folder = tmp_path / "Leopard"
+    folder.mkdir()
+    name, content = FILES[0]
+    # The first 500 pieces survive from an earlier run, except piece 10 which was torn
+    partial = bytearray(content[:PIECE_LENGTH * 500] + bytes(len(content) - PIECE_LENGTH * 500))
+    partial[PIECE_LENGTH * 10] ^= 0xff
+    (folder / name).write_bytes(bytes(partial))
+
+    with Seeders() as seeders:
+        paths = torrent.download_magnet(seeders.magnet, str(tmp_path), progress_factory=quiet_progress)
+
+    assert [open(path, 'rb').read() for path in paths] == [content for _, content in FILES]
+    fetched = {index for _, index in seeders.requests}
+    assert fetched == {10} | set(range(500, len(seeders.pieces)))
+
+def test_all_seeders_corrupt_fails(tmp_path, quiet_progress):
+    with Seeders(corrupt={0, 1, 2}) as seeders:
+        with pytest.raises(torrent.TorrentError, match="could not be fetched"):
+            torrent.download_magnet(seeders.magnet, str(tmp_path), progress_factory=quiet_progress)
+
+@pytest.mark.parametrize("uri", [
+    "magnet:?xt=urn:btih:zz6c88b33dbf8d4c8c08287857f38bc18009a2d8",
+    "magnet:?xt=urn:btih:not-base32-at-all!!!!!!!!!!!!!!!",
+    "magnet:?xt=urn:btih:606c88b33dbf8d4c8c08287857f38bc18009a2d8&x.pe=10.0.0.2:",
+    "magnet:?xt=urn:btih:606c88b33dbf8d4c8c08287857f38bc18009a2d8&x.pe=10.0.0.2",
+    "https://example.com/Leopard.torrent",
+])
+def test_malformed_magnets_raise_torrent_error(uri):
+    with pytest.raises(torrent.TorrentError):
+        torrent.parse_magnet(uri)
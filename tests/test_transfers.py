@@ -0,0 +1,29 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of the transfer backends picked by a source's method
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import pytest
+import transfers
+
+def test_backend_missing_a_method_fails_when_created():
+    class HalfBackend(transfers.TransferBackend):
+        method = "half"
+
+        def jobs(self, source, folder_path):
+            return []
+
+    with pytest.raises(TypeError):
+        HalfBackend({})
+
+def test_https_jobs_name_files_like_offline_jobs(tmp_path):
+    import main
+    url = "https://swcdn.apple.com/content/downloads/Install%20macOS+Sonoma.pkg"
+    source = {"packages": [{"name": "Installer", "url": url, "size": 1}]}
+    [(_, destination, _, _)] = transfers.get_backend("https", {}).jobs(source, str(tmp_path))
+    assert destination == str(tmp_path / main.extract_filename_from_url(url))
+    assert destination.endswith("Install macOS Sonoma.pkg")
@@ -0,0 +1,79 @@
+# -----------------------------------------------------------------------------
+#
+# DarwinFetch - Tests of the disk space backpressure of download-then-extract runs
+#
+# Copyright (c) 2024 RoyalGraphX - BSD 3-Clause License
+# See LICENSE file for more detailed information.
+#
+# -----------------------------------------------------------------------------
+
+import shutil
+import threading
+import unpack
+from concurrent.futures import Future
+
+GB = 1024 ** 3
+
+class FakeExtractor:
+    """Stands in for ArchiveExtractor with extractions the test finishes by hand."""
+
+    def __init__(self):
+        self.futures = []
+        self.submitted = []
+
+    def submit(self, path):
+        self.submitted.append(path)
+
+    def add(self, size):
+        future = Future()
+        self.futures.append((size, future))
+        return future
+
+    def pending(self):
+        return [future for _, future in self.futures if not future.done()]
+
+    def backlog(self):
+        return [size for size, future in self.futures if not future.done()]
+
+    def expansion(self, default):
+        ratios = [future.result().extracted_size / future.result().archive_size for _, future in self.futures if future.done()]
+        return max(ratios) if ratios else default
+
+def fake_disk(monkeypatch, free):
+    """Make shutil.disk_usage report free[0] bytes free."""
+    monkeypatch.setattr(shutil, "disk_usage", lambda path: shutil._ntuple_diskusage(100 * GB, 100 * GB - free[0], free[0]))
+
+def test_download_waits_for_room_to_extract(tmp_path, monkeypatch):
+    free = [10 * GB]
+    fake_disk(monkeypatch, free)
+    extractor = FakeExtractor()
+    running = extractor.add(3 * GB)
+    guard = unpack.DiskGuard(str(tmp_path), extractor, reserve=GB, expansion=2.0)
+
+    # 10 GB free covers the 2 GB archive itself, but not its 4 GB of files next to the 6 GB the running extraction still writes
+    started = threading.Event()
+    thread = threading.Thread(target=lambda: (guard.wait(str(tmp_path / "MacOS9.zip"), 2 * GB), started.set()))
+    thread.start()
+    assert not started.wait(0.5)
+
+    # The extraction wrote 3 GB and removed its 3 GB archive, and showed archives only expand 1x
+    running.set_result(unpack.ExtractResult("a.zip", "a", 3 * GB, 3 * GB, 1.0, 6 * GB))
+    thread.join(5)
+    assert started.is_set()
+
+    # The running download keeps its extraction set aside, 2 GB of files still to come
+    assert guard.committed(1.0) == 4 * GB
+    guard.submit(str(tmp_path / "MacOS9.zip"))
+    assert extractor.submitted == [str(tmp_path / "MacOS9.zip")]
+    assert guard.committed(1.0) == 0
+
+def test_plain_files_need_only_their_size(tmp_path, monkeypatch, capsys):
+    fake_disk(monkeypatch, [4 * GB])
+    guard = unpack.DiskGuard(str(tmp_path), FakeExtractor(), reserve=GB, expansion=2.0)
+
+    guard.wait(str(tmp_path / "MacOS.dmg"), 2 * GB)
+    assert "Warning" not in capsys.readouterr().out
+
+    # Nothing is extracting that could make room, so an archive that does not fit warns and goes ahead
+    guard.wait(str(tmp_path / "MacOS.zip"), 2 * GB)
+    assert "may not fit" in capsys.readouterr().out